@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""
+Usage:
+  search_index.py [-n <docs>] [-w <workers>]
+
+Compares building the static site's search index with `elasticlunr.SearchIndexBuilder` against
+the node script it replaced (`generate_search_index.js`, which needs node), on a corpus of
+<docs> generated messages [default: 20000]. The builder is run with one process and with
+<workers> processes [default: the number of CPU cores]. Reports the wall time and peak memory
+of each, and the size of the index files. Run from the repository root.
+
+Also checks that the site would load the same index from each, by decompressing the index files
+with the site's lz-string under node and comparing the parsed JSON. They are known to differ for
+the terms `constructor` and `__proto__`, which the generated corpus doesn't have: the node script
+counts terms in a plain object, so it gives `constructor` a `tf` of null and leaves `__proto__` out,
+where the builder indexes them like any other term.
+"""
+import json
+import os
+import os.path as P
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = P.dirname(P.dirname(P.abspath(__file__)))
+NODE_SCRIPT = P.join(ROOT, 'yahoo_groups_backup', 'subcommands', 'generate_search_index.js')
+LZ_STRING = P.join(ROOT, 'static_site_template', 'js', 'lz-string.min.js')
+
+BUILD_SCRIPT = """
+import json, sys
+from yahoo_groups_backup.elasticlunr import SearchIndexBuilder
+builder = SearchIndexBuilder(sys.argv[2], workers=int(sys.argv[3]))
+with open(sys.argv[1]) as f:
+    for line in f:
+        builder.add(json.loads(line))
+builder.finish()
+"""
+
+# prints where the indices with the two prefixes first differ, or nothing if they're the same
+COMPARE_SCRIPT = """
+var fs = require('fs');
+var LZString = require(process.argv[1]);
+
+function load(prefix) {
+  var json = '';
+  for (var i = 0; fs.existsSync(prefix + '-part' + i + '.lz-b64.js'); i++) {
+    var chunk = null;
+    var dataLoaded = function (data) { chunk = data; };
+    eval(fs.readFileSync(prefix + '-part' + i + '.lz-b64.js', 'utf8'));
+    json += LZString.decompressFromBase64(chunk.chunkData);
+  }
+  return JSON.parse(json);
+}
+
+function compare(a, b, path) {
+  if (a === null || b === null || typeof a !== 'object' || typeof b !== 'object') {
+    return a === b ? null : path + ': ' + JSON.stringify(a) + ' != ' + JSON.stringify(b);
+  }
+  var keys = Object.keys(a).concat(Object.keys(b).filter(function (key) { return !(key in a); }));
+  for (var i = 0; i < keys.length; i++) {
+    if (!(keys[i] in a) || !(keys[i] in b)) {
+      return path + '.' + keys[i] + ': only in one of them';
+    }
+    var difference = compare(a[keys[i]], b[keys[i]], path + '.' + keys[i]);
+    if (difference) {
+      return difference;
+    }
+  }
+  return null;
+}
+
+var difference = compare(load(process.argv[2]), load(process.argv[3]), '');
+if (difference) {
+  console.log(difference.slice(0, 200));
+}
+"""
+
+
+def make_corpus(path, num_docs):
+    """Write `num_docs` search index documents with random text, one JSON line each."""
+    rand = random.Random(0)
+    vocabulary = [''.join(rand.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rand.randint(2, 10)))
+                  for _ in range(50000)]
+    # make some words much more common than others, as in real text
+    weights = [1.0 / (rank + 1) for rank in range(len(vocabulary))]
+
+    def text(num_words):
+        return ' '.join(rand.choices(vocabulary, weights, k=num_words))
+
+    with open(path, 'w') as f:
+        for message_id in range(1, num_docs + 1):
+            f.write(json.dumps({
+                'id': message_id,
+                'subject': text(rand.randint(2, 10)),
+                'shortDisplayAuthor': text(3),
+                'messageBody': text(rand.randint(20, 400)),
+            }) + '\n')
+
+
+def run(args, stdin_path, out_dir):
+    """Run the command, returning the wall time, the peak memory in MB, and the total size of the
+    files it wrote."""
+    os.makedirs(out_dir)
+    start = time.perf_counter()
+    with open(stdin_path) as stdin:
+        process = subprocess.Popen(args, cwd=ROOT, stdin=stdin, stdout=subprocess.DEVNULL)
+        _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    if status != 0:
+        return None
+
+    size = sum(P.getsize(P.join(out_dir, fn)) for fn in os.listdir(out_dir))
+    # ru_maxrss is in kB on Linux, and doesn't include the worker processes
+    return elapsed, usage.ru_maxrss / 1024, size
+
+
+def main(argv):
+    num_docs = 20000
+    workers = os.cpu_count()
+    while argv:
+        if argv[0] == '-n':
+            num_docs = int(argv[1])
+        elif argv[0] == '-w':
+            workers = int(argv[1])
+        else:
+            sys.exit(__doc__)
+        argv = argv[2:]
+
+    tmp_dir = tempfile.mkdtemp(prefix='search-index-benchmark-')
+    try:
+        corpus_path = P.join(tmp_dir, 'docs.jsonl')
+        make_corpus(corpus_path, num_docs)
+        print("%d documents, %.1f MB" % (num_docs, P.getsize(corpus_path) / 1024 / 1024))
+
+        node_dir = P.join(tmp_dir, 'node')
+        runs = [('node', ['node', NODE_SCRIPT, node_dir], node_dir)]
+        for n in sorted({1, workers}):
+            out_dir = P.join(tmp_dir, 'python-%d' % (n,))
+            runs.append(('python, %d workers' % (n,), [
+                sys.executable, '-c', BUILD_SCRIPT, corpus_path, P.join(out_dir, 'data.searchIndex'), str(n),
+            ], out_dir))
+
+        print("%-20s %10s %10s %12s" % ("builder", "seconds", "peak MB", "index kB"))
+        built = []
+        for name, args, out_dir in runs:
+            if args[0] == 'node' and not shutil.which('node'):
+                print("%-20s %10s %10s %12s" % (name, "-", "-", "(no node)"))
+                continue
+            result = run(args, corpus_path, out_dir)
+            if result is None:
+                print("%-20s %10s %10s %12s" % (name, "-", "-", "(failed)"))
+                continue
+            elapsed, peak_mb, size = result
+            print("%-20s %10.1f %10.1f %12.1f" % (name, elapsed, peak_mb, size / 1024))
+            built.append((name, P.join(out_dir, 'data.searchIndex')))
+
+        if built and built[0][0] == 'node':
+            for name, prefix in built[1:]:
+                difference = subprocess.check_output(
+                    ['node', '-e', COMPARE_SCRIPT, LZ_STRING, built[0][1], prefix]).decode('utf8').strip()
+                print("%s: %s" % (name, "differs from node's index at %s" % (difference,) if difference
+                                  else "same index as node's"))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
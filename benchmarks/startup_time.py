@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Usage:
+  startup_time.py [-n <runs>] [<command>...]
+  startup_time.py [-n <runs>] --open-db <sqlite_file>
+
+Measures how long importing each subcommand takes in a fresh interpreter, i.e. the startup time
+of `yahoo-groups-backup.py <command>` before it does any work, and which of the heavy libraries
+it imports. Run from the repository root. Defaults to all the subcommands, 10 runs each.
+
+With --open-db, measures how long opening a SQLite backup takes in a fresh interpreter instead:
+the given backup as it is, a copy of it without the message stats and threads, as made before
+they were introduced, and a new backup.
+"""
+import os
+import os.path as P
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = P.dirname(P.dirname(P.abspath(__file__)))
+
+# libraries which take long to import, and which only some subcommands need
+HEAVY_MODULES = ('selenium', 'splinter', 'dateutil', 'requests', 'pymongo', 'gridfs')
+
+IMPORT_SCRIPT = """
+import sys
+import yahoo_groups_backup.subcommands.%s
+print(' '.join(name for name in %r if name in sys.modules))
+"""
+
+
+OPEN_DB_SCRIPT = """
+from yahoo_groups_backup.sqlite_db import SQLiteBackupDB
+SQLiteBackupDB(%r, 'benchmark')
+"""
+
+
+def all_commands():
+    subcommands_dir = P.join(ROOT, 'yahoo_groups_backup', 'subcommands')
+    return sorted(fn[:-3] for fn in os.listdir(subcommands_dir) if fn.endswith('.py') and fn != '__init__.py')
+
+
+def time_import(command):
+    """Import the subcommand in a new interpreter, returning the time taken and the heavy modules
+    which got imported."""
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-c', IMPORT_SCRIPT % (command, HEAVY_MODULES)],
+        cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        return None, result.stderr.strip().splitlines()[-1]
+    return elapsed, result.stdout.strip()
+
+
+def time_open_db(path):
+    """Open the SQLite backup in a new interpreter, returning the time taken."""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', OPEN_DB_SCRIPT % (path,)], cwd=ROOT, check=True)
+    return time.perf_counter() - start
+
+
+def copy_without_derived_data(path, copy_path):
+    """Copy the SQLite backup, leaving out the message stats and the threads."""
+    with sqlite3.connect(path) as source, sqlite3.connect(copy_path) as copy:
+        source.backup(copy)
+        copy.execute("DELETE FROM stats")
+        copy.execute("DELETE FROM threads")
+        copy.execute("DELETE FROM thread_links")
+
+
+def main_open_db(path, runs):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        def as_it_is(run):
+            return path
+
+        def not_migrated(run):
+            # a new copy each time, as opening it may migrate it
+            copy_path = P.join(tmp_dir, 'old-%s.sqlite3' % run)
+            copy_without_derived_data(path, copy_path)
+            return copy_path
+
+        def new(run):
+            return P.join(tmp_dir, 'new-%s.sqlite3' % run)
+
+        print("%-20s %10s %10s" % ("backup", "median ms", "min ms"))
+        for name, make_path in [("as it is", as_it_is), ("not migrated", not_migrated), ("new", new)]:
+            times = [time_open_db(make_path(run)) * 1000 for run in range(runs)]
+            print("%-20s %10.1f %10.1f" % (name, statistics.median(times), min(times)))
+
+
+def main(argv):
+    runs = 10
+    if argv[:1] == ['-n']:
+        runs = int(argv[1])
+        argv = argv[2:]
+    if argv[:1] == ['--open-db']:
+        main_open_db(P.abspath(argv[1]), runs)
+        return
+    commands = argv or all_commands()
+
+    print("%-20s %10s %10s  %s" % ("command", "median ms", "min ms", "heavy imports"))
+    for command in commands:
+        times = []
+        for _ in range(runs):
+            elapsed, info = time_import(command)
+            if elapsed is None:
+                break
+            times.append(elapsed * 1000)
+
+        if not times:
+            print("%-20s %10s %10s  (failed: %s)" % (command, "-", "-", info))
+            continue
+        print("%-20s %10.1f %10.1f  %s" % (command, statistics.median(times), min(times), info or "-"))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
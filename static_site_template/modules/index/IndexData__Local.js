@@ -116,16 +116,21 @@ angular.module('staticyahoo.index')
         }
 
         // resolve the data
-        var sortedData = indexView.data();
+        locals.sortedData = indexView.data();
+
+        // search, if there is search text. this loads the parts of the search index it needs,
+        // so it's asynchronous
+        if (request.searchText) {
+          // inject here to avoid circular dependency
+          return $injector.get('MessageSearch__Local').getSearchResults(request.searchText);
+        }
+      }).then(function (sortedSearchResults) {
+        var sortedData = locals.sortedData;
 
         // filter these results if there is search text
         var sortedFilteredData = null;
 
         if (request.searchText) {
-          // inject here to avoid circular dependency
-          var MessageSearch__Local = $injector.get('MessageSearch__Local');
-          var sortedSearchResults = MessageSearch__Local.getSearchResults(request.searchText);
-
           if (request.sortColumn === 'searchRelevance') {
             // keep in same order, just fill in row data
             sortedFilteredData = [];
@@ -11,17 +11,15 @@ angular.module('staticyahoo.search')
         $rootScope, $promiseForEach, $q, $timeout,
         LocalJSONP, IndexData, MessageData, memoize) {
 
+    // the index is split into shards of consecutive terms. The shard directory
+    // has the first term of each shard, and the index starts out empty, with
+    // each shard merged into it the first time a search needs it
     var index = null;
+    var shardStarts = null;
+    var loadedShards = {};
 
     var loadingStarted = false;
 
-    var chunkI = 0;
-    var totalChunks = 0;
-    var progress = function (cur, total) {
-      chunkI = cur;
-      totalChunks = total;
-    };
-
     elasticlunr.clearStopWords();
 
     return {
@@ -43,8 +41,21 @@ angular.module('staticyahoo.search')
 
       loadingStarted = true;
 
-      LocalJSONP.loadCompressed('./data/data.searchIndex', progress).then(function (obj) {
-        index = elasticlunr.Index.load(obj);
+      LocalJSONP('./data/data.searchIndex-shards.js').then(function (directory) {
+        var emptyIndex = {};
+        directory.fields.forEach(function (field) {
+          emptyIndex[field] = {root: {docs: {}, df: 0}, length: 0};
+        });
+
+        index = elasticlunr.Index.load({
+          version: directory.version,
+          fields: directory.fields,
+          ref: directory.ref,
+          documentStore: {docs: {}, docInfo: {}, length: directory.numDocs, save: false},
+          index: emptyIndex,
+          pipeline: directory.pipeline
+        });
+        shardStarts = directory.shardStarts;
       });
     }
 
@@ -53,11 +64,7 @@ angular.module('staticyahoo.search')
      * @returns {boolean}
      */
     function finishedLoading() {
-      if (!totalChunks) {
-        return false;
-      }
-
-      return chunkI === totalChunks;
+      return index !== null;
     }
 
     /**
@@ -65,11 +72,85 @@ angular.module('staticyahoo.search')
      * @returns {number}
      */
     function getLoadingProgress() {
-      if (!totalChunks) {
-        return 0;
+      return index === null ? 0 : 1;
+    }
+
+    /**
+     * Return the numbers of the shards with the terms starting with the
+     * given token, which are what an expanded search for it looks at.
+     */
+    function shardsForToken(token) {
+      // the shard the token would be in...
+      var lo = 0, hi = shardStarts.length;
+      while (hi - lo > 1) {
+        var mid = (lo + hi) >> 1;
+        if (shardStarts[mid] <= token) {
+          lo = mid;
+        } else {
+          hi = mid;
+        }
       }
 
-      return chunkI / totalChunks;
+      // ...and the following ones which start with it
+      var shards = [lo];
+      for (var i = lo + 1; i < shardStarts.length && shardStarts[i].indexOf(token) === 0; i++) {
+        shards.push(i);
+      }
+      return shards;
+    }
+
+    /**
+     * Merge a node of the inverted index of a shard into the index.
+     */
+    function mergeNode(target, node) {
+      if (node.df) {
+        target.docs = node.docs;
+        target.df = node.df;
+      }
+
+      for (var key in node) {
+        if (key === 'docs' || key === 'df') {
+          continue;
+        }
+
+        if (key in target) {
+          mergeNode(target[key], node[key]);
+        } else {
+          target[key] = node[key];
+        }
+      }
+    }
+
+    /**
+     * Load the shards which a search for the text needs, if they aren't loaded
+     * yet. Returns a promise which resolves once they are.
+     */
+    function loadShardsFor(searchText) {
+      if (!shardStarts.length) {
+        return $q.resolve();
+      }
+
+      var needed = {};
+      index.pipeline.run(elasticlunr.tokenizer(searchText)).forEach(function (token) {
+        shardsForToken(token).forEach(function (shardI) {
+          if (!loadedShards[shardI]) {
+            needed[shardI] = true;
+          }
+        });
+      });
+
+      return $promiseForEach(Object.keys(needed), function (shardI) {
+        return LocalJSONP.loadCompressed('./data/data.searchIndex-shard' + shardI).then(function (shard) {
+          if (loadedShards[shardI]) {
+            return;
+          }
+
+          for (var field in shard.index) {
+            mergeNode(index.index[field].root, shard.index[field].root);
+          }
+          loadedShards[shardI] = true;
+        });
+      });
     }
 
     /** Parse a search string.
@@ -173,11 +254,28 @@ angular.module('staticyahoo.search')
     }
 
     /**
-     * Get search results for a given text. Assumes indexing has finished.
+     * Get a promise for the search results for a given text. Assumes the shard
+     * directory has loaded.
      */
     function getSearchResults(searchText) {
       var search = parseSearchText(searchText);
 
+      // the text of all the fields is searched with the same pipeline, so all
+      // the shards needed can be found from all of it at once
+      var allText = [];
+      for (var field in search) {
+        allText = allText.concat(search[field]);
+      }
+
+      return loadShardsFor(allText.join(" ")).then(function () {
+        return searchIndex(search);
+      });
+    }
+
+    /**
+     * Search the parsed search, once the shards it needs are loaded.
+     */
+    function searchIndex(search) {
       var results = [];
       for (var field in search) {
         var thisSearch = search[field].join(" ");
@@ -0,0 +1,102 @@
+import datetime
+import os
+import random
+
+import pytest
+
+from yahoo_groups_backup.archive import ArchiveError, ArchiveReader, ArchiveWriter, export_backup, import_backup
+from yahoo_groups_backup.sqlite_db import SQLiteBackupDB
+
+
+def make_backup(path):
+    rand = random.Random(17)
+    db = SQLiteBackupDB(str(path), 'group')
+    for message_id in range(1, 41):
+        if message_id % 7 == 0:
+            db.upsert_message(message_id, None)
+            continue
+        topic = (message_id - 1) // 4 * 4
+        db.upsert_message(message_id, {
+            'msgId': message_id,
+            'subject': 'Subject %d' % (topic,),
+            'authorName': 'author %d' % (message_id % 3,),
+            'postDate': str(1000000000 + message_id),
+            'rawEmail': 'From: someone\n\nmessage %d %s\n' % (message_id, 'x' * rand.randrange(2000)),
+            'messageBody': '<div>message %d</div>' % (message_id,),
+            'prevInTopic': message_id - 1 if message_id > topic + 1 else 0,
+            'nextInTopic': message_id + 1 if message_id < topic + 4 else 0,
+        })
+
+    shared_data = os.urandom(1000)
+    files = [
+        ('/a.txt', b'some text'),
+        ('/dir/b.bin', os.urandom(600 * 1024)),
+        ('/dir/c.bin', shared_data),
+        ('/dir/copy of c.bin', shared_data),
+        ('/empty', b''),
+        ('/no data', None),
+    ]
+    for file_path, data in files:
+        db.upsert_file_entry({
+            'filePath': file_path,
+            'size': len(data) if data is not None else 5,
+            'date': datetime.datetime(2001, 2, 3, 4, 5, 6),
+            'mime': 'application/octet-stream',
+        })
+        if data is not None:
+            db.update_file_data(file_path, data)
+    return db
+
+
+def backup_contents(db):
+    files = []
+    for entry, data in db.yield_all_files():
+        files.append((entry, data.read() if data is not None else None))
+    return {
+        'messages': list(db.yield_stored_messages()),
+        'files': files,
+        'stats': db.message_stats().to_doc(),
+        'threads': sorted(db.yield_all_threads(), key=lambda thread: thread['_id']),
+    }
+
+
+def export(db, path):
+    # small chunks, so there are several of each
+    export_backup(db, ArchiveWriter(str(path), 'group', chunk_size=7, pack_size=100 * 1024))
+
+
+def test_archive_round_trip(tmp_path):
+    source = make_backup(tmp_path / 'source.sqlite3')
+    export(source, tmp_path / 'archive')
+
+    reader = ArchiveReader(str(tmp_path / 'archive'))
+    assert reader.group_name == 'group'
+    assert len(reader.chunks('messages')) > 1 and len(reader.chunks('blobs')) > 1
+
+    imported = SQLiteBackupDB(str(tmp_path / 'imported.sqlite3'), 'group')
+    import_backup(imported, reader, workers=2, batch_size=5)
+
+    expected = backup_contents(source)
+    assert len(expected['messages']) == 40 and len(expected['files']) == 6
+    assert backup_contents(imported) == expected
+
+
+def test_corrupt_archive(tmp_path):
+    export(make_backup(tmp_path / 'source.sqlite3'), tmp_path / 'archive')
+    reader = ArchiveReader(str(tmp_path / 'archive'))
+    chunk_path = tmp_path / 'archive' / reader.chunks('files')[0]['name']
+    data = bytearray(chunk_path.read_bytes())
+    data[len(data) // 2] ^= 1
+    chunk_path.write_bytes(bytes(data))
+
+    imported = SQLiteBackupDB(str(tmp_path / 'imported.sqlite3'), 'group')
+    with pytest.raises(ArchiveError):
+        import_backup(imported, reader)
+    # nothing is imported if any chunk is corrupt
+    assert list(imported.yield_stored_messages()) == []
+
+
+def test_incomplete_archive(tmp_path):
+    (tmp_path / 'archive').mkdir()
+    with pytest.raises(ArchiveError):
+        ArchiveReader(str(tmp_path / 'archive'))
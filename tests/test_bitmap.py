@@ -0,0 +1,25 @@
+import random
+
+from yahoo_groups_backup.bitmap import IdBitmap
+
+
+def test_bitmap_matches_set():
+    rng = random.Random(4)
+    for _ in range(50):
+        ids = {rng.randrange(200) for _ in range(rng.randrange(60))}
+        bitmap = IdBitmap(ids)
+
+        assert len(bitmap) == len(ids)
+        for id_ in range(210):
+            assert (id_ in bitmap) == (id_ in ids)
+        for _ in range(30):
+            start, end = rng.randrange(210), rng.randrange(210)
+            assert bitmap.count(start, end) == sum(1 for id_ in ids if start <= id_ < end)
+            assert bitmap.count(start) == sum(1 for id_ in ids if start <= id_)
+
+
+def test_empty_bitmap():
+    bitmap = IdBitmap()
+    assert len(bitmap) == 0
+    assert 0 not in bitmap
+    assert bitmap.count(5, 100) == 0
@@ -0,0 +1,59 @@
+import pytest
+
+from yahoo_groups_backup.compression import MessageDoc, compress_message, compress_text, decompress_text, \
+    needs_compression
+
+
+MESSAGE = {
+    '_id': 7,
+    'subject': 'Re: hello',
+    'rawEmail': 'From: someone@example.com\n\nHi there, café \U0001f600\n' * 20,
+    'messageBody': '<div>Hi there</div>' * 20,
+    'postDate': '1200000000',
+}
+
+
+def test_compress_text_round_trip():
+    for text in ('', 'a', MESSAGE['rawEmail']):
+        assert decompress_text(compress_text(text)) == text
+    assert len(compress_text(MESSAGE['rawEmail'])) < len(MESSAGE['rawEmail'])
+
+
+def test_unknown_compression_version():
+    with pytest.raises(ValueError):
+        decompress_text(b'\xff' + compress_text('a')[1:])
+
+
+def test_compressed_message_reads_the_same():
+    doc = compress_message(MESSAGE)
+    assert isinstance(doc['rawEmail'], bytes) and isinstance(doc['messageBody'], bytes)
+    assert doc['subject'] == MESSAGE['subject']
+    assert needs_compression(MESSAGE) and not needs_compression(doc)
+
+    message = MessageDoc(doc)
+    assert message['rawEmail'] == MESSAGE['rawEmail']
+    assert message.get('messageBody') == MESSAGE['messageBody']
+    assert dict(message) == MESSAGE
+    assert {**message} == MESSAGE
+    assert message.copy() == MESSAGE
+    assert 'rawEmail' in message and len(message) == len(MESSAGE)
+
+
+def test_empty_and_old_messages():
+    missing = {'_id': 3}
+    assert compress_message(missing) == missing and not needs_compression(missing)
+    assert dict(MessageDoc(missing)) == missing
+
+    empty = {'_id': 4, 'rawEmail': '', 'messageBody': ''}
+    assert compress_message(empty) == empty and not needs_compression(empty)
+
+    # stored before compression was introduced
+    assert dict(MessageDoc(MESSAGE)) == MESSAGE
+
+
+def test_message_doc_writes():
+    message = MessageDoc(compress_message(MESSAGE))
+    message['subject'] = 'changed'
+    del message['postDate']
+    assert message['subject'] == 'changed' and 'postDate' not in message
+    assert message['rawEmail'] == MESSAGE['rawEmail']
@@ -0,0 +1,76 @@
+import json
+import os.path as P
+import random
+import shutil
+import subprocess
+
+import pytest
+
+from yahoo_groups_backup.elasticlunr import SearchIndexBuilder
+
+
+ROOT = P.dirname(P.dirname(P.abspath(__file__)))
+NODE_SCRIPT = P.join(ROOT, 'yahoo_groups_backup', 'subcommands', 'generate_search_index.js')
+LZ_STRING = P.join(ROOT, 'static_site_template', 'js', 'lz-string.min.js')
+
+# prints the index JSON with the given prefix, decompressed by the site's lz-string
+LOAD_SCRIPT = """
+var fs = require('fs');
+var LZString = require(process.argv[1]);
+var json = '';
+for (var i = 0; fs.existsSync(process.argv[2] + '-part' + i + '.lz-b64.js'); i++) {
+  var chunk = null;
+  var dataLoaded = function (data) { chunk = data; };
+  eval(fs.readFileSync(process.argv[2] + '-part' + i + '.lz-b64.js', 'utf8'));
+  json += LZString.decompressFromBase64(chunk.chunkData);
+}
+process.stdout.write(json);
+"""
+
+# words the tokenizer, the stemmer and the compressor treat specially
+WORDS = ['hello', 'Hello,', 'running', 'runs', 'ran', 'happiness', 'generalizations', 'e-mail', 'café',
+         'naïve', 'don\'t', 'a', 'I', 'the', '日本語', '\U0001f600', 'x' * 40, '42', '3.14', 'Re:', '--',
+         '<b>bold</b>', '&amp;', 'relational', 'conditional', 'sky', 'agreed', 'feed', 'hopping']
+
+
+def make_docs(num_docs):
+    rand = random.Random(24)
+
+    def text(num_words):
+        return ' '.join(rand.choice(WORDS) for _ in range(num_words))
+
+    return [{
+        'id': message_id,
+        'subject': text(rand.randint(0, 6)),
+        'shortDisplayAuthor': text(2),
+        'messageBody': text(rand.randint(0, 80)),
+    } for message_id in range(1, num_docs + 1)]
+
+
+def load_index(prefix):
+    """Return the index with the given prefix as the site loads it. The JSON itself may differ from
+    node's in the order of the keys, since JS objects put the keys which are numbers first."""
+    return json.loads(subprocess.check_output(['node', '-e', LOAD_SCRIPT, LZ_STRING, prefix]).decode('utf8'))
+
+
+@pytest.mark.skipif(not shutil.which('node'), reason="needs node")
+@pytest.mark.parametrize('workers', [1, 2])
+def test_same_index_as_node(tmp_path, workers):
+    docs = make_docs(300)
+    node_dir = tmp_path / 'node'
+    node_dir.mkdir()
+    subprocess.run(['node', NODE_SCRIPT, str(node_dir)], input=''.join(json.dumps(doc) + '\n' for doc in docs),
+                   check=True, universal_newlines=True, stdout=subprocess.DEVNULL)
+
+    python_dir = tmp_path / 'python'
+    python_dir.mkdir()
+    # spill runs to disk, with a few postings per run, and write the index in several pieces
+    builder = SearchIndexBuilder(str(python_dir / 'data.searchIndex'), workers=workers, batch_size=7,
+                                 max_run_postings=500, chunk_size=20000)
+    for doc in docs:
+        builder.add(doc)
+    builder.finish()
+
+    node_index = load_index(str(node_dir / 'data.searchIndex'))
+    assert node_index['documentStore']['length'] == len(docs)
+    assert load_index(str(python_dir / 'data.searchIndex')) == node_index
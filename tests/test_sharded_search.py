@@ -0,0 +1,173 @@
+import json
+import os.path as P
+import random
+import shutil
+import subprocess
+
+import pytest
+
+from yahoo_groups_backup.elasticlunr import SearchIndexBuilder
+
+
+ROOT = P.dirname(P.dirname(P.abspath(__file__)))
+TEMPLATE = P.join(ROOT, 'static_site_template')
+
+# searches the full index the way the site did before it was sharded, and the sharded index with the
+# site's search module, printing the results of both for each search
+SEARCH_SCRIPT = """
+var fs = require('fs');
+var path = require('path');
+var template = process.argv[1], dataDir = process.argv[2], searches = JSON.parse(process.argv[3]);
+var LZString = require(path.join(template, 'js', 'lz-string.min.js'));
+global.elasticlunr = require(path.join(template, 'js', 'elasticlunr.min.js'));
+
+var FIELDS = {
+  any: {shortDisplayAuthor: {boost: 10}, messageBody: {boost: 3}, subject: {boost: 1}},
+  shortDisplayAuthor: {shortDisplayAuthor: {boost: 1}},
+  subject: {subject: {boost: 1}},
+  messageBody: {messageBody: {boost: 1}}
+};
+var TAGS = {any: '', shortDisplayAuthor: 'author:', subject: 'subject:', messageBody: 'body:'};
+
+function loadJSONP(file) {
+  var data = null;
+  var dataLoaded = function (d) { data = d; };
+  eval(fs.readFileSync(path.join(dataDir, file), 'utf8'));
+  return data;
+}
+
+function loadCompressed(prefix) {
+  var json = '';
+  for (var i = 0; fs.existsSync(path.join(dataDir, prefix + '-part' + i + '.lz-b64.js')); i++) {
+    json += LZString.decompressFromBase64(loadJSONP(prefix + '-part' + i + '.lz-b64.js').chunkData);
+  }
+  return JSON.parse(json);
+}
+
+function searchFull(index, search) {
+  var merged = null;
+  Object.keys(search).forEach(function (field) {
+    var results = index.search(search[field], {fields: FIELDS[field], expand: true, bool: 'AND'});
+    if (merged === null) {
+      merged = results;
+      return;
+    }
+    var refToScore = {};
+    results.forEach(function (doc) { refToScore[doc.ref] = doc.score; });
+    merged = merged.filter(function (doc) { return doc.ref in refToScore; }).map(function (doc) {
+      return {ref: doc.ref, score: doc.score + refToScore[doc.ref]};
+    });
+  });
+  return merged;
+}
+
+// the site's search module, with what it's given by angular
+var factory = null;
+global.angular = {module: function () {
+  var module = {
+    constant: function () { return module; },
+    factory: function (name, f) { factory = f; return module; }
+  };
+  return module;
+}};
+require(path.join(template, 'modules', 'search', 'MessageSearch__Local.js'));
+
+var shardsLoaded = 0;
+var LocalJSONP = function (file) { return Promise.resolve(loadJSONP(path.basename(file))); };
+LocalJSONP.loadCompressed = function (prefix) {
+  shardsLoaded++;
+  return Promise.resolve(loadCompressed(path.basename(prefix)));
+};
+var promiseForEach = function (arr, f) {
+  return arr.reduce(function (p, value, i) { return p.then(function () { return f(value, i); }); }, Promise.resolve());
+};
+var MessageSearch = factory(null, promiseForEach, {resolve: function (v) { return Promise.resolve(v); }}, null,
+                            LocalJSONP, null, null, function (f) { return f; });
+
+var fullIndex = elasticlunr.Index.load(loadCompressed('data.searchIndex'));
+MessageSearch.startLoading();
+
+var output = [];
+searches.reduce(function (p, search) {
+  return p.then(function () {
+    var searchText = Object.keys(search).map(function (field) {
+      return search[field].split(' ').map(function (word) { return TAGS[field] + word; }).join(' ');
+    }).join(' ');
+    var before = shardsLoaded;
+    return MessageSearch.getSearchResults(searchText).then(function (results) {
+      output.push({full: searchFull(fullIndex, search), sharded: results, shardsLoaded: shardsLoaded - before});
+    });
+  });
+}, new Promise(function (resolve) {
+  var wait = function () { MessageSearch.finishedLoading() ? resolve() : setTimeout(wait, 1); };
+  wait();
+})).then(function () {
+  process.stdout.write(JSON.stringify(output));
+}).catch(function (err) {
+  console.error(err);
+  process.exit(1);
+});
+"""
+
+WORDS = ['apple', 'application', 'apply', 'applied', 'banana', 'band', 'bandwidth', 'cat', 'catalog', 'category',
+         'dog', 'dogma', 'email', 'emails', 'running', 'runner', 'zebra', 'zero', 'zeroes', 'x', 'xylophone',
+         'meeting', 'meet', 'met', '2001', '2002', '20']
+# only in the documents, since the site splits searches on the characters which aren't in `\w`
+OTHER_WORDS = ['e-mail', 'café', "don't"]
+
+
+def build_index(data_dir, docs, sharded):
+    builder = SearchIndexBuilder(P.join(data_dir, 'data.searchIndex'), batch_size=13)
+    for doc in docs:
+        builder.add(doc)
+    if sharded:
+        builder.finish_sharded(shard_postings=40)
+    else:
+        builder.finish()
+
+
+@pytest.mark.skipif(not shutil.which('node'), reason="needs node")
+def test_sharded_search_matches_full_search(tmp_path):
+    rand = random.Random(25)
+    # some words much more common than others
+    weights = [1.0 / (rank + 1) for rank in range(len(WORDS))]
+
+    def text(num_words, words=WORDS + OTHER_WORDS):
+        return ' '.join(rand.choices(words, weights + [0.1] * (len(words) - len(weights)), k=num_words))
+
+    docs = [{
+        'id': message_id,
+        'subject': text(rand.randint(1, 5)),
+        'shortDisplayAuthor': text(2),
+        'messageBody': text(rand.randint(0, 40)),
+    } for message_id in range(1, 201)]
+    build_index(str(tmp_path), docs, sharded=False)
+    build_index(str(tmp_path), docs, sharded=True)
+    num_shards = len(json.loads(
+        (tmp_path / 'data.searchIndex-shards.js').read_text()[len('dataLoaded('):-len(');')])['shardStarts'])
+    assert num_shards > 5
+
+    # whole words, prefixes which expand to the terms of several shards, and several fields at once
+    searches = [{'any': word} for word in WORDS] + [{'any': prefix} for prefix in ('a', 'ap', 'ba', 'z', 'ze', '2')]
+    searches += [{rand.choice(['any', 'subject', 'shortDisplayAuthor', 'messageBody']): text(rand.randint(1, 3), WORDS)}
+                 for _ in range(30)]
+    searches += [{'any': text(1, WORDS), 'subject': text(1, WORDS), 'messageBody': text(2, WORDS)} for _ in range(10)]
+
+    output = json.loads(subprocess.check_output(
+        ['node', '-e', SEARCH_SCRIPT, TEMPLATE, str(tmp_path), json.dumps(searches)]).decode('utf8'))
+    assert len(output) == len(searches)
+    num_results = 0
+    for search, result in zip(searches, output):
+        full = {doc['ref']: doc['score'] for doc in result['full']}
+        sharded = {doc['ref']: doc['score'] for doc in result['sharded']}
+        assert sharded.keys() == full.keys(), search
+        for ref, score in full.items():
+            assert sharded[ref] == pytest.approx(score, rel=1e-9), (search, ref)
+        # in the same order, but for documents with the same score
+        assert [round(doc['score'], 9) for doc in result['sharded']] == \
+            [round(doc['score'], 9) for doc in result['full']], search
+        num_results += len(full)
+    assert num_results
+
+    # a search for one word only loads the shards it's in
+    assert output[0]['shardsLoaded'] < num_shards
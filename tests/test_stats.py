@@ -0,0 +1,48 @@
+import random
+
+from yahoo_groups_backup.stats import MessageStats, yield_missing_ranges
+
+
+def brute_force_missing_ranges(ids, last_id):
+    ranges = []
+    for id_ in range(1, last_id + 1):
+        if id_ in ids:
+            continue
+        if ranges and ranges[-1][1] == id_ - 1:
+            ranges[-1][1] = id_
+        else:
+            ranges.append([id_, id_])
+    return [tuple(r) for r in ranges]
+
+
+def test_missing_ranges_match_brute_force():
+    rng = random.Random(13)
+    for _ in range(200):
+        ids = {rng.randrange(1, 60) for _ in range(rng.randrange(40))}
+        last_id = rng.randrange(70)
+        assert list(yield_missing_ranges(sorted(ids), last_id)) == brute_force_missing_ranges(ids, last_id)
+
+
+def test_updated_stats_match_computed_stats():
+    rng = random.Random(13)
+    for _ in range(200):
+        # whether each message has a body, and its date, don't change when it's stored again
+        has_body = {id_: rng.random() < 0.7 for id_ in range(1, 80)}
+        stored = {}
+        stats = MessageStats()
+        for _ in range(rng.randrange(60)):
+            id_ = rng.randrange(1, 80)
+            post_date = 1000 + id_ if has_body[id_] else None
+            stats.add(id_, has_body[id_], post_date,
+                      was_present=id_ in stored, had_body=bool(stored.get(id_)))
+            stored[id_] = has_body[id_]
+
+            # round-trip through the stored document as well
+            stats = MessageStats(stats.to_doc())
+
+        rows = [(id_, stored[id_], 1000 + id_ if stored[id_] else None) for id_ in sorted(stored)]
+        expected = MessageStats.from_messages(rows)
+        assert stats.to_doc() == expected.to_doc()
+        assert expected.missing_ranges == [
+            list(r) for r in brute_force_missing_ranges(stored, max(stored, default=0))]
+        assert expected.num_messages == sum(stored.values())
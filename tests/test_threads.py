@@ -0,0 +1,62 @@
+import random
+
+from yahoo_groups_backup.threads import build_threads, merge_thread_updates, merge_threads, topic_links
+
+
+def random_messages(rng):
+    """Return `(message_id, prev_in_topic, next_in_topic, post_date)` for some messages of random
+    topics, in random order."""
+    ids = list(range(1, 60))
+    rng.shuffle(ids)
+    rows = []
+    while ids:
+        topic = sorted(ids[:rng.randrange(1, 6)])
+        del ids[:len(topic)]
+        for i, message_id in enumerate(topic):
+            rows.append((message_id, topic[i - 1] if i else 0, topic[i + 1] if i + 1 < len(topic) else 0,
+                         rng.choice([None, rng.randrange(1000)])))
+    rng.shuffle(rows)
+    # leave some out, as if they were missing
+    return rows[:rng.randrange(len(rows) + 1)]
+
+
+def linking_threads(threads, links):
+    return [thread for thread in threads.values() if set(thread['linkedIds']) & set(links)]
+
+
+def test_merged_threads_match_built_threads():
+    rng = random.Random(16)
+    for _ in range(200):
+        rows = random_messages(rng)
+        threads = {}
+        for message_id, prev_in_topic, next_in_topic, post_date in rows:
+            links = topic_links(message_id, prev_in_topic, next_in_topic)
+            merged = linking_threads(threads, links)
+            for thread in merged:
+                del threads[thread['_id']]
+            thread = merge_threads(merged, links, post_date)
+            threads[thread['_id']] = thread
+
+        assert sorted(threads.values(), key=lambda t: t['_id']) == \
+            sorted(build_threads(rows), key=lambda t: t['_id'])
+
+
+def test_merged_thread_updates_match_built_threads():
+    rng = random.Random(16)
+    for _ in range(200):
+        rows = random_messages(rng)
+        threads = {}
+        i = 0
+        while i < len(rows):
+            batch = rows[i:i + rng.randrange(1, 8)]
+            i += len(batch)
+            updates = [(topic_links(message_id, prev_in_topic, next_in_topic), post_date)
+                       for message_id, prev_in_topic, next_in_topic, post_date in batch]
+            merged = linking_threads(threads, [link for links, _ in updates for link in links])
+            for thread, replaced in merge_thread_updates(merged, updates):
+                for old in replaced:
+                    del threads[old['_id']]
+                threads[thread['_id']] = thread
+
+        assert sorted(threads.values(), key=lambda t: t['_id']) == \
+            sorted(build_threads(rows), key=lambda t: t['_id'])
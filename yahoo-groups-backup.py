@@ -3,8 +3,9 @@
 Yahoo! Groups scraper and static backup site generator.
 
 Usage:
-  yahoo-groups-backup.py [-h|--help] [--config=<file>]
+  yahoo-groups-backup.py [-h|--help] [--config=<file>] [--backend=<backend>]
                          [--mongo-host=<host>] [--mongo-port=<port>]
+                         [--sqlite-dir=<dir>]
                          <command> [<args>...]
 
 Commands:
@@ -15,6 +16,11 @@ Commands:
   dump_site           Dump the entire backup as a static website at the given
                       root directory
   show_redaction      Show what the effects of a redaction would be
+  compress_messages   Compress and hash the messages of a backup made before
+                      messages were stored compressed and hashed
+  export_archive      Export a backup into a compressed archive directory
+  import_archive      Load an archive made by export_archive into a backup
+  search              Search the messages of a backup
 
 Options:
   -h --help                      Show this screen
@@ -25,6 +31,11 @@ Options:
                                  file. [default: settings.yaml]
   --mongo-host=<hostname>        Host for mongo database [default: localhost]
   --mongo-port=<port>            Port for mongo database [default: 27017]
+  --backend=<backend>            Where to store the backup: "mongo" for a
+                                 MongoDB server, or "sqlite" for a local
+                                 SQLite file per group. [default: mongo]
+  --sqlite-dir=<dir>             Directory of the <group_name>.sqlite3 files
+                                 of the sqlite backend. [default: .]
 """
 import importlib
 import os
@@ -39,6 +50,7 @@ from yahoo_groups_backup.logging import eprint
 
 args_schema = schema.Schema({
     '--mongo-port': schema.And(schema.Use(int), lambda n: 1 <= n <= 65535, error='Invalid mongo port'),
+    '--backend': schema.And(str, lambda b: b in ('mongo', 'sqlite'), error='Invalid backend, must be mongo or sqlite'),
     # '--delay': schema.And(schema.Use(float), lambda n: n > 0, error='Invalid delay, must be number > 0'),
     object: object,
 })
@@ -1,3 +1,21 @@
-from .backup_db import YahooBackupDB
-from .scraper import YahooBackupScraper
-from .message import html_from_message, unescape_yahoo_html
+import importlib
+import sys
+
+# the module `__getattr__` below needs 3.7, as do other parts of the package
+if sys.version_info < (3, 7):
+    raise ImportError("yahoo_groups_backup needs Python 3.7 or later")
+
+# the package attributes, and the modules they're imported from on first use, so that e.g. dumping
+# a site doesn't import the browser automation libraries which only the scraper needs
+_LAZY_ATTRIBUTES = {
+    'YahooBackupDB': 'backup_db',
+    'YahooBackupScraper': 'scraper',
+    'html_from_message': 'message',
+    'unescape_yahoo_html': 'message',
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        return getattr(importlib.import_module('.' + _LAZY_ATTRIBUTES[name], __name__), name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,304 @@
+import concurrent.futures
+import datetime
+import gzip
+import hashlib
+import itertools
+import json
+import os
+import os.path as P
+
+from . import docjson
+from .logging import eprint
+
+FORMAT_VERSION = 1
+
+MANIFEST_NAME = 'manifest.json'
+
+# size of the pieces file data is copied in
+COPY_SIZE = 256 * 1024
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class _HashingFile:
+    """Wraps a file opened for writing, counting and hashing everything written to it."""
+
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+
+def _file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(COPY_SIZE), b''):
+            h.update(data)
+    return h.hexdigest()
+
+
+class ArchiveWriter:
+    """Writes a group backup into an archive directory, made of gzipped chunk files:
+        * `messages-<n>.jsonl.gz` - `chunk_size` stored message documents per chunk, one per line,
+          serialized with `docjson`, so the message fields stay compressed as they are stored
+        * `files-<n>.jsonl.gz` - `chunk_size` file entries per chunk
+        * `blobs-<n>.pack.gz` - up to `pack_size` bytes of file data per chunk, as a JSON header line
+          `{"contentHash": ..., "length": ...}` followed by the data, for each distinct file data
+    and `manifest.json`, which lists the chunks along with their record count and sha256, written
+    last by `close`.
+
+    Only one chunk is held open at a time, and records are written as they come, so memory use
+    doesn't depend on the size of the backup."""
+
+    def __init__(self, path, group_name, chunk_size=5000, pack_size=256 * 1024 * 1024):
+        self.path = path
+        self.group_name = group_name
+        self.chunk_size = chunk_size
+        self.pack_size = pack_size
+
+        self.chunks = []
+
+        os.makedirs(path)
+
+    def _write_chunk(self, kind, extension, write_fn):
+        """Write a chunk file with `write_fn(gzip_file)`, which returns the number of records written,
+        and add it to the manifest."""
+        name = '%s-%05d.%s.gz' % (kind, sum(1 for chunk in self.chunks if chunk['kind'] == kind), extension)
+        with open(P.join(self.path, name), 'wb') as raw_f:
+            hashing_f = _HashingFile(raw_f)
+            with gzip.GzipFile(filename='', mode='wb', compresslevel=6, fileobj=hashing_f) as f:
+                count = write_fn(f)
+
+        self.chunks.append({
+            'name': name,
+            'kind': kind,
+            'count': count,
+            'size': hashing_f.size,
+            'sha256': hashing_f.hash.hexdigest(),
+        })
+        return count
+
+    def write_records(self, kind, records):
+        """Write the documents, `chunk_size` per chunk file. Returns how many were written."""
+        records = iter(records)
+
+        def write_fn(f):
+            count = 0
+            for record in itertools.islice(records, self.chunk_size):
+                f.write(docjson.dumps(record).encode('utf8'))
+                f.write(b'\n')
+                count += 1
+            return count
+
+        total = 0
+        while True:
+            count = self._write_chunk(kind, 'jsonl', write_fn)
+            total += count
+            if count < self.chunk_size:
+                break
+        if not count:
+            # don't keep the empty last chunk around
+            os.remove(P.join(self.path, self.chunks.pop()['name']))
+        return total
+
+    def write_blobs(self, blobs):
+        """Write the `(content_hash, length, data_chunks)` file data into pack chunk files. Returns
+        how many were written."""
+        blobs = iter(blobs)
+        next_blob = [next(blobs, None)]
+
+        def write_fn(f):
+            count = 0
+            written = 0
+            while next_blob[0] is not None and (written < self.pack_size or not count):
+                content_hash, length, data_chunks = next_blob[0]
+                f.write(json.dumps({'contentHash': content_hash, 'length': length}).encode('utf8'))
+                f.write(b'\n')
+
+                blob_written = 0
+                for data in data_chunks:
+                    f.write(data)
+                    blob_written += len(data)
+                if blob_written != length:
+                    raise ArchiveError("Data of %s is %s bytes, expected %s" % (content_hash, blob_written, length))
+
+                written += length
+                count += 1
+                next_blob[0] = next(blobs, None)
+            return count
+
+        total = 0
+        while next_blob[0] is not None:
+            total += self._write_chunk('blobs', 'pack', write_fn)
+        return total
+
+    def close(self):
+        """Write the manifest."""
+        manifest = {
+            'formatVersion': FORMAT_VERSION,
+            'groupName': self.group_name,
+            'created': datetime.datetime.utcnow().isoformat(),
+            'chunks': self.chunks,
+        }
+        with open(P.join(self.path, MANIFEST_NAME), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+
+class ArchiveReader:
+    """Reads an archive directory written by `ArchiveWriter`."""
+
+    def __init__(self, path):
+        self.path = path
+
+        manifest_path = P.join(path, MANIFEST_NAME)
+        if not P.exists(manifest_path):
+            raise ArchiveError("'%s' has no %s, it is not an archive or is incomplete" % (path, MANIFEST_NAME))
+        with open(manifest_path) as f:
+            self.manifest = json.load(f)
+
+        if self.manifest['formatVersion'] != FORMAT_VERSION:
+            raise ArchiveError("Unsupported archive format version %s" % (self.manifest['formatVersion'],))
+
+    @property
+    def group_name(self):
+        return self.manifest['groupName']
+
+    def chunks(self, kind):
+        return [chunk for chunk in self.manifest['chunks'] if chunk['kind'] == kind]
+
+    def verify_chunk(self, chunk):
+        """Raise an `ArchiveError` if the chunk file doesn't match its checksum."""
+        path = P.join(self.path, chunk['name'])
+        if not P.exists(path):
+            raise ArchiveError("Chunk '%s' is missing" % (chunk['name'],))
+        if _file_sha256(path) != chunk['sha256']:
+            raise ArchiveError("Chunk '%s' is corrupt, its checksum doesn't match" % (chunk['name'],))
+
+    def read_records(self, chunk):
+        """Yield the documents of a records chunk."""
+        with gzip.open(P.join(self.path, chunk['name']), 'rb') as f:
+            for line in f:
+                yield docjson.loads(line.decode('utf8'))
+
+    def read_blobs(self, chunk):
+        """Yield `(content_hash, length, read)` for the file data in a pack chunk, where `read(n)`
+        reads the data. Any data not read is skipped."""
+        with gzip.open(P.join(self.path, chunk['name']), 'rb') as f:
+            while True:
+                header = f.readline()
+                if not header:
+                    return
+
+                header = json.loads(header.decode('utf8'))
+                remaining = [header['length']]
+
+                def read(n):
+                    data = f.read(min(n, remaining[0]))
+                    remaining[0] -= len(data)
+                    return data
+
+                yield header['contentHash'], header['length'], read
+
+                while remaining[0] and read(COPY_SIZE):
+                    pass
+
+
+def _yield_blobs(db, blob_entries):
+    for content_hash, entry in blob_entries.items():
+        data = db.get_file_data(entry)
+        yield content_hash, data.length, data
+
+
+def export_backup(db, writer):
+    """Write all the messages, file entries and file data of the backup database with the
+    `ArchiveWriter`."""
+    eprint("Exporting messages...")
+    num_messages = writer.write_records('messages', db.yield_stored_messages())
+    eprint("Exported %s messages" % (num_messages,))
+
+    # content hash -> the entry to get the data with, for each distinct file data
+    blob_entries = {}
+
+    def yield_entries():
+        for entry, data in db.yield_all_files():
+            if data is not None and not entry.get('contentHash'):
+                # stored before file data was stored by content hash, so hash it here
+                h = hashlib.sha256()
+                for piece in data:
+                    h.update(piece)
+                blob_entries.setdefault(h.hexdigest(), entry)
+                entry = {**entry, 'contentHash': h.hexdigest()}
+            elif data is not None:
+                blob_entries.setdefault(entry['contentHash'], entry)
+            yield entry
+
+    eprint("Exporting file entries...")
+    num_files = writer.write_records('files', yield_entries())
+    eprint("Exported %s file entries" % (num_files,))
+
+    eprint("Exporting file data...")
+    num_blobs = writer.write_blobs(_yield_blobs(db, blob_entries))
+    eprint("Exported %s distinct files" % (num_blobs,))
+
+    writer.close()
+
+
+def _import_records(reader, chunk, store_fn, batch_size):
+    records = reader.read_records(chunk)
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            break
+        store_fn(batch)
+    return chunk['count']
+
+
+def _import_blobs(db, reader, chunk):
+    num_stored = 0
+    for content_hash, length, read in reader.read_blobs(chunk):
+        if db.has_blob(content_hash):
+            continue
+
+        writer = db.open_blob_data()
+        for data in iter(lambda: read(COPY_SIZE), b''):
+            writer.write(data)
+        writer.close()
+        if writer.content_hash != content_hash:
+            raise ArchiveError("Data of %s in '%s' doesn't match its hash" % (content_hash, chunk['name']))
+        num_stored += 1
+    return num_stored
+
+
+def import_backup(db, reader, workers=4, batch_size=1000):
+    """Load everything in the archive of the `ArchiveReader` into the backup database, after
+    checking all the chunk checksums. `workers` chunks are checked and loaded at a time."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        eprint("Verifying the archive...")
+        list(executor.map(reader.verify_chunk, reader.manifest['chunks']))
+
+        eprint("Importing messages and file entries...")
+        futures = [executor.submit(_import_records, reader, chunk, db.import_messages, batch_size)
+                   for chunk in reader.chunks('messages')]
+        futures += [executor.submit(_import_records, reader, chunk, db.import_file_entries, batch_size)
+                    for chunk in reader.chunks('files')]
+        num_records = sum(future.result() for future in futures)
+        eprint("Imported %s messages and file entries" % (num_records,))
+
+        eprint("Importing file data...")
+        num_blobs = sum(executor.map(lambda chunk: _import_blobs(db, reader, chunk), reader.chunks('blobs')))
+        eprint("Imported %s distinct files" % (num_blobs,))
+
+    eprint("Rebuilding message stats, threads and search index...")
+    db.rebuild_message_stats()
+    db.rebuild_threads()
+    db.rebuild_search_index()
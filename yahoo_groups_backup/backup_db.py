@@ -1,13 +1,29 @@
+import hashlib
+
 import gridfs
 import pymongo
+import pymongo.errors
 
 from . import message
+from .bitmap import IdBitmap
+from .compression import MessageDoc, compress_message, needs_compression
+from .stats import MessageStats, yield_missing_ranges
+from .search import FIELD_WEIGHTS, SEARCH_FIELDS, make_snippet, query_terms, search_doc
+from .threads import build_threads, merge_thread_updates, topic_links
+from .write_buffer import WriteBuffer
+
+# whether a stored message has a body, i.e. isn't missing, as a query and as an aggregation
+# expression. A missing, null or empty 'messageBody' is no body, same as `bool(messageBody)`
+HAS_BODY_QUERY = {'messageBody': {'$nin': [None, '']}}
+HAS_BODY_EXPR = {'$not': [{'$in': [{'$ifNull': ['$messageBody', None]}, [None, '']]}]}
 
 
 class YahooBackupDB:
     """Interface to store Yahoo! Group messages to a MongoDB. Group data is stored in a database
-    whose name is the same as the group name. File data is stored in that database name plus `_gridfs`, where
-    the gridfs _id is teh same as the file document _id, which is also the file path.
+    whose name is the same as the group name. File data is stored in that database name plus `_gridfs`, once
+    per distinct content: each gridfs file has a `contentHash` (the sha256 of the data), which the file
+    documents refer to. Older backups may instead have the gridfs _id the same as the file document _id,
+    which is also the file path.
 
     The `messages` collection contains all the message data returned by the Yahoo! Groups API.
     Notable fields:
@@ -19,12 +35,43 @@ class YahooBackupDB:
         * 'postDate' - a timestamp of when the post was made
         * 'messageBody' - the message body, as formatted HTML
         * 'rawEmail' - the full raw email, with headers and everything
+        * 'contentHash' - `message.content_hash` of the message data, missing for messages stored
+          before it was introduced
         * 'nextInTime' - next message id, in time order
         * 'nextInTopic' - next message id, in topic order
         * 'prevInTime' - prev message id, in time order
         * 'prevInTopic' - prev message id, in topic order
+    'messageBody' and 'rawEmail' are stored compressed (see `compression.py`), and decompressed when
+    read from the documents returned here.
     If a message is missing, then the document will contain an `_id` field and nothing else.
 
+    The `stats` collection contains the `MessageStats` of the messages, in the document with `_id`
+    'messages', updated along with the messages. It is computed from all the messages when it's
+    first needed, for backups made before it was introduced.
+
+    The `threads` collection groups the messages into threads, following their topic links:
+        * `_id` - the id of the first message of the thread
+        * `members` - the ids of the messages of the thread, in order
+        * `linkedIds` - the members and the ids their topic links point to, including messages we
+          don't have
+        * `numReplies` - the number of messages after the first one
+        * `lastPostDate` - the 'postDate' of the latest message
+        * `version` - incremented on every update, to detect concurrent updates (missing for the
+          threads made by `rebuild_threads`)
+    It is updated along with the messages, and built from all the messages when it's first needed,
+    for backups made before it was introduced.
+
+    The `search_index` collection is the full-text index of the messages, with a text index over:
+        * `subject` - the subject
+        * `author` - the profile, author name and email address
+        * `body` - the plain text of the message body
+    along with the `_id` and `postDate` of the message. It is updated along with the messages.
+
+    The `render_cache` collection keeps the HTML rendered for messages by `RenderCache`:
+        * `_id` - the `message.render_key` of the message
+        * `html` - the rendered HTML, compressed with `compression.compress_text`
+        * `failed` - whether rendering the raw email failed, and Yahoo!'s rendering was used instead
+
     The `files` collection contains all the data about files:
         * `_id` - the full file path and name (unique)
         * `url` - the url the file was downloaded from
@@ -32,24 +79,103 @@ class YahooBackupDB:
         * `size` - file size as reported by yahoo - float, in kilobytes
         * `profile` - profile of user that posted the file
         * `date` - date listed on the Yahoo! Group for the file
+        * `contentHash` - sha256 of the file data, which is the gridfs file with the same `contentHash`
+
+    The `file_listings` collection caches the listing of each directory of the Files section:
+        * `_id` - the directory path
+        * `signature` - the directory's date and size, as listed in its parent directory
+        * `files` - the file entries in the directory, as yielded by `YahooBackupScraper.list_directory`
+        * `dirs` - the subdirectories, with their `filePath` and `signature`
     """
+    # (server address, database name) of the databases whose indices this process created
+    _indexed = set()
+
     def __init__(self, mongo_cli, group_name):
         self.group_name = group_name
 
         self.cli = mongo_cli
         self.db = getattr(self.cli, group_name)
-        self.fs = gridfs.GridFS(getattr(self.cli, "%s_gridfs" % group_name))
+        self.fs_db = getattr(self.cli, "%s_gridfs" % group_name)
+        self.fs = gridfs.GridFS(self.fs_db)
 
-        self._ensure_indices()
+        self._message_writes = None
+        self._search_writes = None
+        self._file_writes = None
+
+        self._threads_checked = False
 
     def _ensure_indices(self):
+        """Create the indices, unless this process did already. Only done by the methods which
+        write or need the indices, so e.g. dumping a single message doesn't have to."""
+        key = (self.cli.address, self.db.name)
+        if key in YahooBackupDB._indexed:
+            return
+
         self.db.messages.create_index([("postDate", pymongo.ASCENDING)])
         self.db.messages.create_index([("authorName", pymongo.ASCENDING)])
         self.db.messages.create_index([("from", pymongo.ASCENDING)])
         self.db.messages.create_index([("profile", pymongo.ASCENDING)])
+        self.db.search_index.create_index(
+            [(field, pymongo.TEXT) for field in SEARCH_FIELDS],
+            weights=FIELD_WEIGHTS, default_language='none', name='search_text')
+        self.db.threads.create_index([("members", pymongo.ASCENDING)])
+        self.db.threads.create_index([("linkedIds", pymongo.ASCENDING)])
+        self.db.files.create_index([("size", pymongo.ASCENDING), ("date", pymongo.ASCENDING)])
+        self.fs_db.fs.files.create_index([("contentHash", pymongo.ASCENDING)])
+        # only once they're all made, so they're tried again if making any of them failed
+        YahooBackupDB._indexed.add(key)
+
+    def buffer_writes(self, **kwargs):
+        """Buffer the message and file entry upserts, sending them in batches. The keyword arguments
+        are passed on to `WriteBuffer`. Buffered writes are only visible after a `flush`."""
+        self._ensure_indices()
+        self._message_writes = WriteBuffer(self.db.messages, before_flush=self._look_up_stored_messages,
+                                           on_flush=self._save_derived_data, **kwargs)
+        self._search_writes = WriteBuffer(self.db.search_index, **kwargs)
+        self._file_writes = WriteBuffer(self.db.files, **kwargs)
+
+    def flush(self):
+        """Send any buffered writes."""
+        for buf in (self._message_writes, self._search_writes, self._file_writes):
+            if buf:
+                buf.flush()
+
+    def close(self):
+        """Send any buffered writes, and stop buffering them."""
+        for buf in (self._message_writes, self._search_writes, self._file_writes):
+            if buf:
+                buf.close()
+        self._message_writes = self._search_writes = self._file_writes = None
+
+    def num_coalesced_writes(self):
+        """Return how many writes were sent as part of a batch, rather than on their own."""
+        return sum(buf.num_coalesced for buf in (self._message_writes, self._search_writes, self._file_writes) if buf)
+
+    def yield_stored_messages(self, batch_size=1000):
+        """Yield all the message documents as they are stored, i.e. with their fields compressed,
+        including the missing messages, in message_id order."""
+        for doc in self.db.messages.find().sort('_id', 1).batch_size(batch_size):
+            yield doc
+
+    def import_messages(self, docs):
+        """Store the message documents, as yielded by `yield_stored_messages`, replacing any stored
+        ones, in one batch. Call `rebuild_message_stats` and `rebuild_threads` once done importing."""
+        self._ensure_indices()
+        if docs:
+            self.db.messages.bulk_write(
+                [pymongo.ReplaceOne({'_id': doc['_id']}, doc, upsert=True) for doc in docs], ordered=False)
+
+    def import_file_entries(self, entries):
+        """Store the file entries, as yielded by `yield_all_files`, replacing any stored ones, in one
+        batch."""
+        self._ensure_indices()
+        if entries:
+            self.db.files.bulk_write(
+                [pymongo.ReplaceOne({'_id': entry['_id']}, entry, upsert=True) for entry in entries], ordered=False)
 
     def has_updated_message(self, message_number):
         """Return whether we already have the given message number loaded and fully updated."""
+        self.flush()
         query = self.db.messages.find({'_id': message_number})
         if not query.count():
             return False
@@ -61,65 +187,503 @@ class YahooBackupDB:
 
         return True
 
+    def updated_message_ids(self, start=None, end=None):
+        """Return an `IdBitmap` of the numbers of all the messages for which `has_updated_message`
+        would return True, with one projected scan of the messages. Optionally only considers
+        the message numbers in [`start`, `end`)."""
+        self.flush()
+        query = {'nextInTime': {'$ne': 0}}
+        if start is not None or end is not None:
+            query['_id'] = {'$gte': start or 0, '$lt': end or 9999999999}
+
+        ids = IdBitmap()
+        for doc in self.db.messages.find(query, {'_id': 1}):
+            ids.add(doc['_id'])
+        return ids
+
     def upsert_message(self, message_number, message_obj):
         """Insert the message document, for the given message number. If the message is already stored, will
         update it. For a missing message, pass `None` for `message_obj`."""
+        self._ensure_indices()
         if not message_obj:
-            self.db.messages.insert_one({'_id': message_number})
+            # don't replace a message we do have, or fail if it's there already
+            doc = {'_id': message_number}
+            if self._message_writes:
+                self._message_writes.add(pymongo.UpdateOne(doc, {'$setOnInsert': doc}, upsert=True), doc)
+            else:
+                updates = self._look_up_stored_messages([doc])
+                self.db.messages.update_one(doc, {'$setOnInsert': doc}, upsert=True)
+                self._save_derived_data(updates)
         else:
             assert message_number == message_obj['msgId']
 
-            doc = {**message_obj, '_id': message_number}
+            doc = compress_message({**message_obj, '_id': message_number})
             del doc['msgId']
-            self.db.messages.update_one({'_id': message_number}, {'$set': doc}, upsert=True)
+            doc['contentHash'] = message.content_hash(message_obj)
+            search = search_doc(message_number, message_obj)
+            if self._message_writes:
+                self._message_writes.add(pymongo.UpdateOne({'_id': message_number}, {'$set': doc}, upsert=True), doc)
+                self._search_writes.add(pymongo.ReplaceOne({'_id': message_number}, search, upsert=True), search)
+            else:
+                updates = self._look_up_stored_messages([doc])
+                self.db.messages.update_one({'_id': message_number}, {'$set': doc}, upsert=True)
+                self.db.search_index.replace_one({'_id': message_number}, search, upsert=True)
+                self._save_derived_data(updates)
+
+    def _look_up_stored_messages(self, docs):
+        """Return `(stats update, thread update)` for each of the message documents about to be
+        written, with what is stored for them looked up with one query. The stats update is the
+        arguments to `MessageStats.add`, and the thread update is the topic links and post date of
+        the message, or None if it has no body."""
+        # (was present, had body) of each message, as of the write before it in the batch
+        stored = {row['_id']: (True, row['hasBody']) for row in self.db.messages.aggregate([
+            {'$match': {'_id': {'$in': list({doc['_id'] for doc in docs})}}},
+            {'$project': {'hasBody': HAS_BODY_EXPR}},
+        ])}
+        updates = []
+        for doc in docs:
+            message_id = doc['_id']
+            has_body = bool(doc.get('messageBody'))
+            was_present, had_body = stored.get(message_id, (False, False))
+            thread_update = None
+            if has_body:
+                thread_update = (topic_links(message_id, doc.get('prevInTopic'), doc.get('nextInTopic')),
+                                 doc.get('postDate'))
+            updates.append(((message_id, has_body, doc.get('postDate'), was_present, had_body), thread_update))
+            stored[message_id] = (True, had_body or has_body)
+        return updates
+
+    def _save_derived_data(self, updates):
+        """Update the data derived from the messages - the stats and the threads - for the written
+        messages, given the updates `_look_up_stored_messages` returned for them."""
+        self._save_message_stats([stats_update for stats_update, _ in updates])
+        self._save_threads([thread_update for _, thread_update in updates if thread_update])
+
+    def _save_threads(self, updates):
+        """Add the written messages, given their `(topic links, post date)`, to their threads,
+        merging the threads they link together, with one query and one batch of writes. Other
+        processes may be updating the same threads, so threads are only replaced or deleted if they
+        haven't changed since we read them, and otherwise the updates are applied again to the
+        threads as they are then. Since threads are only ever merged, applying the updates again is
+        harmless."""
+        if not updates or self._build_missing_threads():
+            return
+
+        links = sorted({link for update_links, _ in updates for link in update_links})
+        while True:
+            threads = list(self.db.threads.find({'linkedIds': {'$in': links}}))
+
+            ops = []
+            num_replaced = num_deleted = 0
+            for thread, merged_threads in merge_thread_updates(threads, updates):
+                previous = None
+                for merged in merged_threads:
+                    if merged['_id'] == thread['_id']:
+                        previous = merged
+                        continue
+                    ops.append(pymongo.DeleteOne({'_id': merged['_id'], 'version': merged.get('version')}))
+                    num_deleted += 1
+
+                if previous is None:
+                    ops.append(pymongo.InsertOne({**thread, 'version': 1}))
+                else:
+                    ops.append(pymongo.ReplaceOne({'_id': thread['_id'], 'version': previous.get('version')},
+                                                  {**thread, 'version': (previous.get('version') or 0) + 1}))
+                    num_replaced += 1
+
+            try:
+                result = self.db.threads.bulk_write(ops, ordered=False)
+            except pymongo.errors.BulkWriteError as e:
+                # only another process making a thread with the same first message is expected
+                if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                    raise
+                continue
+
+            if result.matched_count == num_replaced and result.deleted_count == num_deleted:
+                return
+
+    def rebuild_threads(self):
+        """Rebuild all the threads from the topic links of all the messages, in one scan."""
+        self._ensure_indices()
+        self.flush()
+        self._rebuild_threads()
+
+    def _rebuild_threads(self):
+        rows = self.db.messages.find(
+            HAS_BODY_QUERY,
+            {'prevInTopic': 1, 'nextInTopic': 1, 'postDate': 1},
+        ).sort('_id', 1)
+        threads = build_threads(
+            (row['_id'], row.get('prevInTopic'), row.get('nextInTopic'), row.get('postDate')) for row in rows)
+
+        self.db.threads.delete_many({})
+        batch = []
+        for thread in threads:
+            batch.append(thread)
+            if len(batch) >= 1000:
+                self.db.threads.insert_many(batch, ordered=False)
+                batch = []
+        if batch:
+            self.db.threads.insert_many(batch, ordered=False)
+
+    def _build_missing_threads(self):
+        """Build the threads from all the messages if there are messages but no threads, e.g. in a
+        backup made before threads were introduced. Only checked once. Returns whether they were
+        built."""
+        if self._threads_checked:
+            return False
+        self._threads_checked = True
+
+        if self.db.threads.find_one({}, {'_id': 1}) or not self.db.messages.find_one(HAS_BODY_QUERY, {'_id': 1}):
+            return False
+        self._ensure_indices()
+        self._rebuild_threads()
+        return True
+
+    def get_thread(self, message_number):
+        """Return the thread document of the thread the given message is in, or None."""
+        self.flush()
+        self._build_missing_threads()
+        return self.db.threads.find_one({'members': message_number})
+
+    def yield_all_threads(self):
+        """Yield all the thread documents, in order of their first message."""
+        self.flush()
+        self._build_missing_threads()
+        for thread in self.db.threads.find().sort('_id', 1):
+            yield thread
+
+    def _save_message_stats(self, updates):
+        """Apply the stats updates of the written messages to the stored stats. Other processes may
+        be updating them too, so only replace the stats if they haven't changed since we read them,
+        and otherwise try again. If there are no stored stats yet, e.g. in a backup made before they
+        were introduced, they are computed from all the messages instead, written ones included."""
+        if not updates:
+            return
+
+        while True:
+            stored = self.db.stats.find_one({'_id': 'messages'})
+            if stored is None:
+                self._rebuild_message_stats()
+                return
+
+            stats = MessageStats(stored)
+            for update in updates:
+                stats.add(*update)
+            stats.version += 1
 
-    def yield_all_messages(self, start=None, end=None):
-        """Yield all existing messages (skipping missing ones), in reverse message_id order."""
-        query = {'_id': {'$gte': start or 0, '$lt': end or 9999999999}}
-        for msg in self.db.messages.find(query).sort('_id', -1):
-            if not msg.get('messageBody'):
+            doc = {**stats.to_doc(), '_id': 'messages'}
+            if self.db.stats.replace_one({'_id': 'messages', 'version': stored.get('version', 0)}, doc).matched_count:
+                return
+
+    def rebuild_message_stats(self):
+        """Recompute the message stats from all the stored messages, with one sorted scan which
+        only returns the ids, post dates and whether there is a body. Returns the stats."""
+        self.flush()
+        return self._rebuild_message_stats()
+
+    def _rebuild_message_stats(self):
+        rows = self.db.messages.aggregate([
+            {'$sort': {'_id': 1}},
+            {'$project': {'postDate': 1, 'hasBody': HAS_BODY_EXPR}},
+        ], allowDiskUse=True)
+        stats = MessageStats.from_messages((row['_id'], row['hasBody'], row.get('postDate')) for row in rows)
+        self.db.stats.replace_one({'_id': 'messages'}, {**stats.to_doc(), '_id': 'messages'}, upsert=True)
+        return stats
+
+    def message_stats(self):
+        """Return the `MessageStats` of the stored messages, computing them if they were never
+        stored."""
+        self.flush()
+        stored = self.db.stats.find_one({'_id': 'messages'})
+        return MessageStats(stored) if stored else self._rebuild_message_stats()
+
+    def get_message(self, message_number):
+        """Return the message document of the given message number, or None if we don't have it."""
+        doc = self.db.messages.find_one({'_id': message_number})
+        return MessageDoc(doc) if doc else None
+
+    def yield_all_messages(self, start=None, end=None, fields=None, batch_size=None):
+        """Yield all existing messages (skipping missing ones), in reverse message_id order. If
+        `fields` is given, the documents only have those fields (and `_id`), the rest is never
+        sent over by the server. `batch_size` sets how many documents are fetched per round trip."""
+        query = {
+            '_id': {'$gte': start or 0, '$lt': end or 9999999999},
+            **HAS_BODY_QUERY,
+        }
+        projection = {field: 1 for field in fields} if fields else None
+        cursor = self.db.messages.find(query, projection).sort('_id', -1)
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+
+        for msg in cursor:
+            yield MessageDoc(msg)
+
+    def compress_stored_messages(self, batch_size=500):
+        """Compress the fields of the stored messages which aren't compressed yet, and add the
+        'contentHash' of those which don't have one, e.g. of backups made before either was
+        introduced. Streams through the messages, writing back each batch at once. Yields the
+        number of messages updated so far after each batch."""
+        fields = ('rawEmail', 'messageBody')
+        num_compressed = 0
+        ops = []
+        for doc in self.db.messages.find({}).sort('_id', 1).batch_size(batch_size):
+            update = {}
+            if needs_compression(doc):
+                compressed = compress_message(doc)
+                update.update((field, compressed[field]) for field in fields if field in compressed)
+            if 'rawEmail' in doc and 'contentHash' not in doc:
+                update['contentHash'] = message.stored_content_hash(doc)
+            if not update:
                 continue
 
-            yield msg
+            ops.append(pymongo.UpdateOne({'_id': doc['_id']}, {'$set': update}))
+            if len(ops) >= batch_size:
+                self.db.messages.bulk_write(ops, ordered=False)
+                num_compressed += len(ops)
+                ops = []
+                yield num_compressed
+
+        if ops:
+            self.db.messages.bulk_write(ops, ordered=False)
+            num_compressed += len(ops)
+            yield num_compressed
 
     def num_messages(self):
         """Return the number of non-empty messages in the database."""
-        return self.db.messages.find({'messageBody': {'$exists': True}}).count()
+        return self.message_stats().num_messages
 
     def get_latest_message(self):
-        """Return the latest message."""
-        return next(self.yield_all_messages())
+        """Return the latest message, or None if there are no messages."""
+        latest_id = self.message_stats().latest_id
+        return self.get_message(latest_id) if latest_id else None
+
+    def missing_message_ranges(self):
+        """Return `(start, end)` (both inclusive) for each range of message ids up to the latest
+        message which we don't have, from the stats."""
+        stats = self.message_stats()
+        return stats.missing_ranges_up_to(stats.latest_id)
+
+    def yield_missing_message_ranges(self):
+        """Same as `missing_message_ranges`, but computed from a scan of the message ids rather than
+        taken from the stats."""
+        latest_id = self.message_stats().latest_id
+        ids = (doc['_id'] for doc in self.db.messages.find({'_id': {'$lte': latest_id}}, {'_id': 1}).sort('_id', 1))
+        return yield_missing_ranges(ids, latest_id)
 
     def missing_message_ids(self):
-        """Return the set of the ids of all missing messages.."""
-        latest = self.get_latest_message()
-        ids = set(range(1, latest['_id']+1))
-        present_ids = set(doc['_id'] for doc in self.db.messages.find({}, {'_id': 1}))
-        return ids - present_ids
+        """Return the set of the ids of all missing messages."""
+        return set(n for start, end in self.missing_message_ranges() for n in range(start, end + 1))
+
+    def rebuild_search_index(self, batch_size=500):
+        """Rebuild the full-text index from all the messages. Returns the number of messages indexed."""
+        self._ensure_indices()
+        self.flush()
+        self.db.search_index.delete_many({})
+
+        num_indexed = 0
+        batch = []
+        fields = ('subject', 'profile', 'authorName', 'from', 'messageBody', 'postDate')
+        for message in self.yield_all_messages(fields=fields, batch_size=batch_size):
+            batch.append(search_doc(message['_id'], message))
+            if len(batch) >= batch_size:
+                self.db.search_index.insert_many(batch, ordered=False)
+                num_indexed += len(batch)
+                batch = []
+        if batch:
+            self.db.search_index.insert_many(batch, ordered=False)
+            num_indexed += len(batch)
+        return num_indexed
+
+    def search_index_size(self):
+        """Return the number of messages in the full-text index."""
+        self.flush()
+        return self.db.search_index.count()
+
+    def search_messages(self, query, page=1, page_size=20):
+        """Search the messages for the words and "quoted phrases" of the query, returning
+        `(num_results, results)` for the given page of the results, best matches first. Each result
+        has the `_id`, `subject`, `author` and `postDate` of the message, its `score`, and a
+        `snippet` of the body."""
+        self._ensure_indices()
+        self.flush()
+        query_doc = {'$text': {'$search': query}}
+        num_results = self.db.search_index.find(query_doc).count()
+        cursor = self.db.search_index.find(query_doc, {'score': {'$meta': 'textScore'}}) \
+            .sort([('score', {'$meta': 'textScore'})]) \
+            .skip((page - 1) * page_size).limit(page_size)
+
+        terms = query_terms(query)
+        results = []
+        for doc in cursor:
+            doc['snippet'] = make_snippet(doc.pop('body'), terms)
+            results.append(doc)
+        return num_results, results
+
+    def get_rendered_messages(self, keys):
+        """Return a dict of `render_key: (compressed_html, failed)` for those of the given keys which
+        are in the render cache."""
+        return {doc['_id']: (doc['html'], doc['failed'])
+                for doc in self.db.render_cache.find({'_id': {'$in': list(keys)}})}
+
+    def put_rendered_messages(self, entries):
+        """Store the `render_key: (compressed_html, failed)` entries into the render cache."""
+        self.db.render_cache.bulk_write([
+            pymongo.ReplaceOne({'_id': key}, {'_id': key, 'html': html, 'failed': failed}, upsert=True)
+            for key, (html, failed) in entries.items()
+        ], ordered=False)
 
     # -- File operations
 
     def has_file_entry(self, filePath):
+        self.flush()
         return self.db.files.find({'_id': filePath}).count() > 0
 
     def has_file_data(self, filePath):
+        entry = self.db.files.find_one({'_id': filePath}, {'contentHash': 1})
+        if entry and entry.get('contentHash'):
+            return self.has_blob(entry['contentHash'])
         return self.fs.exists({'_id': filePath})
 
+    def has_blob(self, content_hash):
+        """Return whether we have the file data with the given content hash."""
+        return self.fs.exists({'contentHash': content_hash})
+
+    def find_blob_for_listing(self, file_entry):
+        """Return the content hash of the data of a file we already have with the same name, type,
+        size and date as the given file entry, or None. This is taken to be the same file, e.g. one
+        posted in several folders, so it doesn't need to be downloaded again. The listed size is
+        rounded, so it isn't enough on its own."""
+        name = file_entry['filePath'].rsplit('/', 1)[-1]
+        for entry in self.db.files.find({'size': file_entry['size'], 'date': file_entry['date'],
+                                         'mime': file_entry['mime'], 'contentHash': {'$exists': True}},
+                                        {'contentHash': 1}):
+            if entry['_id'].rsplit('/', 1)[-1] == name and self.has_blob(entry['contentHash']):
+                return entry['contentHash']
+        return None
+
+    def set_file_content_hash(self, file_path, content_hash):
+        """Point the file entry at the data with the given content hash."""
+        self.db.files.update_one({'_id': file_path}, {'$set': {'contentHash': content_hash}})
+
     def upsert_file_entry(self, file_entry):
+        self._ensure_indices()
         doc = {**file_entry, '_id': file_entry['filePath']}
         del doc['filePath']
-        self.db.files.update_one({'_id': doc['_id']}, {'$set': doc}, upsert=True)
+        if self._file_writes:
+            self._file_writes.add(pymongo.UpdateOne({'_id': doc['_id']}, {'$set': doc}, upsert=True), doc)
+        else:
+            self.db.files.update_one({'_id': doc['_id']}, {'$set': doc}, upsert=True)
 
     def update_file_data(self, file_path, data):
-        if self.fs.exists({'_id': file_path}):
-            self.fs.delete(file_path)
-
-        self.fs.put(data, _id=file_path, filename=file_path)
-
-    def yield_all_files(self):
-        """Yield all (file_entry, grid_out_file) for all files in the database."""
-        for entry in self.db.files.find():
-            data = None
-            if self.fs.exists({'_id': entry['_id']}):
-                data = self.fs.get(entry['_id'])
-            yield entry, data
+        f = self.open_file_data(file_path)
+        f.write(data)
+        f.close()
+
+    def get_file_listing(self, dir_path):
+        """Return the cached listing of the given directory, or None."""
+        return self.db.file_listings.find_one({'_id': dir_path})
+
+    def upsert_file_listing(self, dir_path, signature, files, dirs):
+        """Cache the listing of the given directory."""
+        self._ensure_indices()
+        self.db.file_listings.replace_one(
+            {'_id': dir_path},
+            {'_id': dir_path, 'signature': signature, 'files': files, 'dirs': dirs},
+            upsert=True)
+
+    def open_file_data(self, file_path):
+        """Return a `FileDataWriter` to write the data of the given file with, replacing any existing
+        data once it is closed."""
+        self._ensure_indices()
+        return FileDataWriter(self, file_path)
+
+    def open_blob_data(self):
+        """Return a `FileDataWriter` to store some file data with, without any file entry."""
+        self._ensure_indices()
+        return FileDataWriter(self, None)
+
+    def get_file_data(self, entry):
+        """Return the grid_out_file with the data of the given file entry, or None if we don't
+        have it."""
+        if entry.get('contentHash'):
+            return self.fs.find_one({'contentHash': entry['contentHash']})
+        if self.fs.exists({'_id': entry['_id']}):
+            return self.fs.get(entry['_id'])
+        return None
+
+    def yield_all_files(self, batch_size=500):
+        """Yield all (file_entry, grid_out_file) for all files in the database, with None for the
+        files we have no data for. The gridfs files of each batch of entries are looked up with one
+        query."""
+        entries = []
+        for entry in self.db.files.find().batch_size(batch_size):
+            entries.append(entry)
+            if len(entries) >= batch_size:
+                yield from self._with_file_data(entries)
+                entries = []
+        yield from self._with_file_data(entries)
+
+    def _with_file_data(self, entries):
+        """Yield (file_entry, grid_out_file) for the file entries."""
+        if not entries:
+            return
+
+        hashes = [entry['contentHash'] for entry in entries if entry.get('contentHash')]
+        # data stored before file data was stored by content hash has the file path as its _id
+        paths = [entry['_id'] for entry in entries if not entry.get('contentHash')]
+        by_hash = {}
+        by_path = {}
+        for file_doc in self.fs_db.fs.files.find({'$or': [
+                {'contentHash': {'$in': hashes}}, {'_id': {'$in': paths}}]}):
+            if file_doc.get('contentHash'):
+                by_hash.setdefault(file_doc['contentHash'], file_doc)
+            else:
+                by_path[file_doc['_id']] = file_doc
+
+        for entry in entries:
+            if entry.get('contentHash'):
+                file_doc = by_hash.get(entry['contentHash'])
+            else:
+                file_doc = by_path.get(entry['_id'])
+            yield entry, gridfs.GridOut(self.fs_db.fs, file_document=file_doc) if file_doc else None
+
+
+class FileDataWriter:
+    """File-like object to write the data of a file into the GridFS of a `YahooBackupDB`.
+
+    The data is hashed as it is written. When closed, it is only kept if there is no data with
+    the same hash yet, and the file entry is pointed at the hash, which is then in `content_hash`.
+    With no `file_path`, only the data is stored. Call `abort()` to give up on the data instead."""
+
+    def __init__(self, backup_db, file_path):
+        self.backup_db = backup_db
+        self.file_path = file_path
+
+        self.content_hash = None
+
+        self._hash = hashlib.sha256()
+        self._grid_in = backup_db.fs.new_file(filename=file_path)
+
+    def write(self, data):
+        self._hash.update(data)
+        self._grid_in.write(data)
+
+    def abort(self):
+        self._grid_in.abort()
+
+    def close(self):
+        content_hash = self.content_hash = self._hash.hexdigest()
+        if self.backup_db.has_blob(content_hash):
+            self._grid_in.abort()
+        else:
+            self._grid_in.contentHash = content_hash
+            self._grid_in.close()
+
+        if self.file_path is None:
+            return
+        self.backup_db.set_file_content_hash(self.file_path, content_hash)
+
+        # drop the data stored the old way, by file path, if any
+        if self.backup_db.fs.exists({'_id': self.file_path}):
+            self.backup_db.fs.delete(self.file_path)
@@ -0,0 +1,40 @@
+# number of set bits in each possible byte
+_POPCOUNT = bytes(bin(i).count('1') for i in range(256))
+
+
+class IdBitmap:
+    """A compact set of non-negative integer ids, stored as one bit per id. Used to hold the
+    sets of message ids of large groups, which would take hundreds of MB as a `set` of ints."""
+
+    def __init__(self, ids=()):
+        self._bits = bytearray()
+        for id_ in ids:
+            self.add(id_)
+
+    def add(self, id_):
+        byte_i = id_ >> 3
+        if byte_i >= len(self._bits):
+            self._bits.extend(bytes(byte_i - len(self._bits) + 1))
+        self._bits[byte_i] |= 1 << (id_ & 7)
+
+    def __contains__(self, id_):
+        byte_i = id_ >> 3
+        return byte_i < len(self._bits) and bool(self._bits[byte_i] & (1 << (id_ & 7)))
+
+    def count(self, start=0, end=None):
+        """Return the number of ids in the range [start, end)."""
+        end = len(self._bits) * 8 if end is None else min(end, len(self._bits) * 8)
+        if start >= end:
+            return 0
+
+        # count whole bytes in bulk, and the partial bytes at either end one by one
+        first_byte, last_byte = (start + 7) >> 3, end >> 3
+        if first_byte >= last_byte:
+            return sum(1 for id_ in range(start, end) if id_ in self)
+
+        return (sum(1 for id_ in range(start, first_byte * 8) if id_ in self) +
+                sum(_POPCOUNT[b] for b in self._bits[first_byte:last_byte]) +
+                sum(1 for id_ in range(last_byte * 8, end) if id_ in self))
+
+    def __len__(self):
+        return self.count()
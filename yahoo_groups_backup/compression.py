@@ -0,0 +1,74 @@
+import collections.abc
+import zlib
+
+# the message fields which are stored compressed
+COMPRESSED_FIELDS = ('rawEmail', 'messageBody')
+
+# first byte of a compressed value, identifying how it was compressed
+ZLIB_V1 = 1
+
+
+def compress_text(text):
+    """Compress a string into bytes, prefixed with the compression version."""
+    return bytes([ZLIB_V1]) + zlib.compress(text.encode('utf8'), 6)
+
+
+def decompress_text(data):
+    """Decompress bytes made by `compress_text` back into the string."""
+    if data[0] == ZLIB_V1:
+        return zlib.decompress(data[1:]).decode('utf8')
+    raise ValueError("Unknown compression version %s" % data[0])
+
+
+def compress_message(doc):
+    """Return a copy of the message document with the `COMPRESSED_FIELDS` compressed. Empty
+    fields are left as they are, so they can be checked without decompressing."""
+    result = dict(doc)
+    for field in COMPRESSED_FIELDS:
+        if isinstance(result.get(field), str) and result[field]:
+            result[field] = compress_text(result[field])
+    return result
+
+
+def needs_compression(doc):
+    """Return whether the stored message document has fields which aren't compressed yet."""
+    return any(isinstance(doc.get(field), str) and doc[field] for field in COMPRESSED_FIELDS)
+
+
+class MessageDoc(collections.abc.MutableMapping):
+    """A stored message document, whose compressed fields are only decompressed when they are
+    read, however they're read: `doc['rawEmail']`, `doc.get`, `dict(doc)`, `{**doc}` and
+    `doc.copy()` all give the decompressed fields. Documents stored before compression was
+    introduced work as well."""
+
+    def __init__(self, doc):
+        self._doc = dict(doc)
+
+    def __getitem__(self, key):
+        value = self._doc[key]
+        if key in COMPRESSED_FIELDS and isinstance(value, bytes):
+            # only decompress once
+            value = self._doc[key] = decompress_text(value)
+        return value
+
+    def __setitem__(self, key, value):
+        self._doc[key] = value
+
+    def __delitem__(self, key):
+        del self._doc[key]
+
+    def __contains__(self, key):
+        return key in self._doc
+
+    def __iter__(self):
+        return iter(self._doc)
+
+    def __len__(self):
+        return len(self._doc)
+
+    def __repr__(self):
+        return 'MessageDoc(%r)' % (self._doc,)
+
+    def copy(self):
+        """Return a dict of the document, with its fields decompressed."""
+        return dict(self)
@@ -0,0 +1,35 @@
+import base64
+import datetime
+import json
+
+# JSON serialization of the database documents, which may contain values JSON doesn't have: dates
+# become `{"$date": <iso date>}` and bytes `{"$binary": <base64>}`, as in MongoDB's extended JSON.
+
+
+def _json_default(obj):
+    if isinstance(obj, datetime.datetime):
+        return {'$date': obj.isoformat()}
+    if isinstance(obj, bytes):
+        return {'$binary': base64.b64encode(obj).decode('ascii')}
+    raise TypeError("Can't serialize %r" % (obj,))
+
+
+def _json_object_hook(obj):
+    if len(obj) == 1 and '$binary' in obj:
+        return base64.b64decode(obj['$binary'])
+    if len(obj) == 1 and '$date' in obj:
+        try:
+            return datetime.datetime.strptime(obj['$date'], '%Y-%m-%dT%H:%M:%S.%f')
+        except ValueError:
+            return datetime.datetime.strptime(obj['$date'], '%Y-%m-%dT%H:%M:%S')
+    return obj
+
+
+def dumps(doc):
+    """Serialize the document to JSON."""
+    return json.dumps(doc, default=_json_default, separators=(',', ':'))
+
+
+def loads(s):
+    """Deserialize a document serialized by `dumps`."""
+    return json.loads(s, object_hook=_json_object_hook)
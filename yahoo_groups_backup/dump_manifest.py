@@ -0,0 +1,64 @@
+import hashlib
+import json
+import os
+import os.path as P
+
+MANIFEST_VERSION = 1
+
+
+def input_hash(*inputs):
+    """Return a hash of the JSON-serializable inputs an artifact is made from."""
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, separators=(',', ':')).encode('utf8')).hexdigest()
+
+
+class DumpManifest:
+    """Record of the artifacts of a dumped site - its data files and group files - along with the
+    hash of the inputs each was made from, kept in a JSON file. When dumping the site again, an
+    artifact which is still there and whose inputs hash the same doesn't need to be made again.
+
+    Every artifact of a dump is `record`ed, whether it was made again or not, and `save` writes them
+    out, so artifacts which are no longer made drop out of the manifest."""
+
+    def __init__(self, path):
+        self.path = path
+
+        self.previous = {}
+        if P.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == MANIFEST_VERSION:
+                self.previous = manifest['artifacts']
+
+        self.artifacts = {}
+        self.num_changed = 0
+
+    def is_current(self, name, file_path, hash_, record=True):
+        """Return whether the artifact at `file_path` exists and was made from inputs with the given
+        hash. Records the artifact either way, unless `record` is False, e.g. to record it once it's
+        made."""
+        current = self.previous.get(name) == hash_ and P.exists(file_path)
+        if record:
+            self.record(name, hash_, changed=not current)
+        return current
+
+    def record(self, name, hash_, changed=True):
+        self.artifacts[name] = hash_
+        if changed:
+            self.num_changed += 1
+
+    def keep_artifacts(self, prefix):
+        """Record the artifacts of the previous dump whose names start with `prefix` as unchanged,
+        for artifacts which are left as they were along with one checked with `is_current`."""
+        for name, hash_ in self.previous.items():
+            if name.startswith(prefix) and name not in self.artifacts:
+                self.record(name, hash_, changed=False)
+
+    def stale_artifacts(self):
+        """Return the names of the artifacts of the previous dump which this dump didn't make."""
+        return sorted(set(self.previous) - set(self.artifacts))
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'artifacts': self.artifacts}, f, sort_keys=True)
+        os.replace(tmp_path, self.path)
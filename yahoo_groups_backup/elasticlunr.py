@@ -0,0 +1,556 @@
+# Builds the search index of the static site: an elasticlunr 0.8.9 index
+# (static_site_template/js/elasticlunr.min.js), as `elasticlunr.Index.toJSON` would serialize it,
+# split into LZString-compressed chunk files, as `LocalJSONP.storeCompressed` would store it. The
+# index can also be split into shards by term, for the site to load as searches need them.
+#
+# The one known difference from what elasticlunr itself makes is for the terms `constructor` and
+# `__proto__`: elasticlunr counts terms in a plain object, so it gives `constructor` a `tf` of null
+# and leaves `__proto__` out, while here they're indexed like any other term.
+import array
+import collections
+import concurrent.futures
+import functools
+import heapq
+import itertools
+import json
+import math
+import os
+import os.path as P
+import pickle
+import re
+import tempfile
+
+from .lzstring import compress_to_base64
+
+ELASTICLUNR_VERSION = '0.8.9'
+
+# the fields of the site's search index, and the document field to use as ref
+FIELDS = ('subject', 'shortDisplayAuthor', 'messageBody')
+REF = 'id'
+PIPELINE = ('trimmer', 'stopWordFilter', 'stemmer')
+
+# how many characters of the index JSON to compress into each chunk file
+CHUNK_SIZE = 2 * 1024 * 1024
+
+# what JavaScript's \s and String.trim treat as whitespace
+_JS_WHITESPACE = '\t\n\x0b\x0c\r \xa0\u1680\u2000-\u200a\u2028\u2029\u202f\u205f\u3000\ufeff'
+_SEPARATOR_RE = re.compile('[%s-]+' % _JS_WHITESPACE)
+_TRIM_WHITESPACE_RE = re.compile('^[%s]+|[%s]+$' % (_JS_WHITESPACE, _JS_WHITESPACE))
+_ASTRAL_RE = re.compile('[\U00010000-\U0010ffff]')
+# JavaScript's \W, without the unicode flag
+_TRIMMER_RE = re.compile('^[^A-Za-z0-9_]+|[^A-Za-z0-9_]+$')
+_SURROGATE_RE = re.compile('[\ud800-\udfff]')
+
+
+def _to_utf16_units(text):
+    """Replace the characters outside the BMP with surrogate pairs, so the string has one character
+    per UTF-16 code unit, like a JavaScript string."""
+    data = text.encode('utf-16-le', 'surrogatepass')
+    return ''.join(map(chr, array.array('H', data)))
+
+
+def tokenize(text):
+    """Same as `elasticlunr.tokenizer` on a string, with the default separator."""
+    text = _TRIM_WHITESPACE_RE.sub('', text).lower()
+    if _ASTRAL_RE.search(text):
+        text = _to_utf16_units(text)
+    return _SEPARATOR_RE.split(text)
+
+
+# --- the Porter stemmer of elasticlunr (from lunr) ---
+
+_STEP2 = {
+    'ational': 'ate', 'tional': 'tion', 'enci': 'ence', 'anci': 'ance', 'izer': 'ize', 'bli': 'ble',
+    'alli': 'al', 'entli': 'ent', 'eli': 'e', 'ousli': 'ous', 'ization': 'ize', 'ation': 'ate',
+    'ator': 'ate', 'alism': 'al', 'iveness': 'ive', 'fulness': 'ful', 'ousness': 'ous', 'aliti': 'al',
+    'iviti': 'ive', 'biliti': 'ble', 'logi': 'log',
+}
+_STEP3 = {'icate': 'ic', 'ative': '', 'alize': 'al', 'iciti': 'ic', 'ical': 'ic', 'ful': '', 'ness': ''}
+
+_c = '[^aeiou]'
+_v = '[aeiouy]'
+_C = _c + '[^aeiouy]*'
+_V = _v + '[aeiou]*'
+
+_MGR0_RE = re.compile('^(' + _C + ')?' + _V + _C)
+_MEQ1_RE = re.compile('^(' + _C + ')?' + _V + _C + '(' + _V + ')?$')
+_MGR1_RE = re.compile('^(' + _C + ')?' + _V + _C + _V + _C)
+_S_V_RE = re.compile('^(' + _C + ')?' + _v)
+
+_1A_RE = re.compile('^(.+?)(ss|i)es$')
+_1A_2_RE = re.compile('^(.+?)([^s])s$')
+_1B_RE = re.compile('^(.+?)eed$')
+_1B_2_RE = re.compile('^(.+?)(ed|ing)$')
+_1B_AT_BL_IZ_RE = re.compile('(at|bl|iz)$')
+_1B_DOUBLE_RE = re.compile(r'([^aeiouylsz])\1$')
+_CVC_RE = re.compile('^' + _C + _v + '[^aeiouwxy]$')
+_1C_RE = re.compile('^(.+?[^aeiou])y$')
+_2_RE = re.compile('^(.+?)(' + '|'.join(_STEP2) + ')$')
+_3_RE = re.compile('^(.+?)(' + '|'.join(_STEP3) + ')$')
+_4_RE = re.compile('^(.+?)(al|ance|ence|er|ic|able|ible|ant|ement|ment|ent|ou|ism|ate|iti|ous|ive|ize)$')
+_4_2_RE = re.compile('^(.+?)(s|t)(ion)$')
+_5_RE = re.compile('^(.+?)e$')
+_5_LL_RE = re.compile('ll$')
+
+
+def stem(w):
+    """Same as `elasticlunr.stemmer`."""
+    if len(w) < 3:
+        return w
+
+    first = w[0]
+    if first == 'y':
+        w = 'Y' + w[1:]
+
+    # step 1a
+    m = _1A_RE.match(w) or _1A_2_RE.match(w)
+    if m:
+        w = m.group(1) + m.group(2)
+
+    # step 1b
+    m = _1B_RE.match(w)
+    if m:
+        if _MGR0_RE.match(m.group(1)):
+            w = w[:-1]
+    else:
+        m = _1B_2_RE.match(w)
+        if m and _S_V_RE.match(m.group(1)):
+            w = m.group(1)
+            if _1B_AT_BL_IZ_RE.search(w):
+                w += 'e'
+            elif _1B_DOUBLE_RE.search(w):
+                w = w[:-1]
+            elif _CVC_RE.match(w):
+                w += 'e'
+
+    # step 1c
+    m = _1C_RE.match(w)
+    if m:
+        w = m.group(1) + 'i'
+
+    # step 2
+    m = _2_RE.match(w)
+    if m and _MGR0_RE.match(m.group(1)):
+        w = m.group(1) + _STEP2[m.group(2)]
+
+    # step 3
+    m = _3_RE.match(w)
+    if m and _MGR0_RE.match(m.group(1)):
+        w = m.group(1) + _STEP3[m.group(2)]
+
+    # step 4
+    m = _4_RE.match(w)
+    if m:
+        if _MGR1_RE.match(m.group(1)):
+            w = m.group(1)
+    else:
+        m = _4_2_RE.match(w)
+        if m and _MGR1_RE.match(m.group(1) + m.group(2)):
+            w = m.group(1) + m.group(2)
+
+    # step 5
+    m = _5_RE.match(w)
+    if m:
+        stem_ = m.group(1)
+        if _MGR1_RE.match(stem_) or (_MEQ1_RE.match(stem_) and not _CVC_RE.match(stem_)):
+            w = stem_
+    if _5_LL_RE.search(w) and _MGR1_RE.match(w):
+        w = w[:-1]
+
+    if first == 'y':
+        w = 'y' + w[1:]
+    return w
+
+
+@functools.lru_cache(maxsize=200000)
+def _run_pipeline(token):
+    # trimmer, then stopWordFilter with the stop words cleared, which only drops empty tokens
+    token = _TRIMMER_RE.sub('', token)
+    if not token:
+        return None
+    return stem(token)
+
+
+def field_terms(text):
+    """Return the terms of a document field, as elasticlunr indexes it: tokenized and run through
+    the pipeline."""
+    if text is None:
+        return []
+    terms = (_run_pipeline(token) for token in tokenize(str(text)))
+    return [term for term in terms if term is not None]
+
+
+def tokenize_docs(docs):
+    """Return `(refs, field_lengths, postings)` for a batch of documents, where `field_lengths` has
+    the number of terms in each field of each document, and `postings` is, for each field, a dict of
+    term -> array of interleaved ref, term count pairs."""
+    refs = []
+    field_lengths = []
+    postings = [collections.defaultdict(lambda: array.array('I')) for _ in FIELDS]
+    for doc in docs:
+        ref = doc[REF]
+        refs.append(ref)
+        lengths = []
+        for field_postings, field in zip(postings, FIELDS):
+            terms = field_terms(doc.get(field))
+            lengths.append(len(terms))
+            for term, count in collections.Counter(terms).items():
+                field_postings[term].extend((ref, count))
+        field_lengths.append(lengths)
+    return refs, field_lengths, [dict(field_postings) for field_postings in postings]
+
+
+def _length_norm(field_length):
+    """The factor elasticlunr scales the term frequencies in a field by, when searching."""
+    return 1 / math.sqrt(field_length) if field_length else 1
+
+
+def _json_string(s):
+    # like JSON.stringify, which escapes lone surrogates
+    return _SURROGATE_RE.sub(lambda m: '\\u%04x' % ord(m.group()), json.dumps(s, ensure_ascii=False))
+
+
+def _js_number(x):
+    # like JavaScript's Number.toString, for the numbers in the index
+    return str(int(x)) if x.is_integer() else repr(x)
+
+
+@functools.lru_cache(maxsize=1024)
+def _tf_json(count):
+    return _js_number(math.sqrt(count))
+
+
+def _docs_json(postings):
+    pairs = sorted(zip(postings[0::2], postings[1::2]))
+    return ','.join('"%d":{"tf":%s}' % (ref, _tf_json(count)) for ref, count in pairs)
+
+
+def yield_trie_json(terms, docs_json=_docs_json):
+    """Yield the pieces of the JSON of the root node of an elasticlunr inverted index, given
+    `(term, postings)` for each of its terms, in sorted order. Each node of the trie is an object
+    with the 'docs' of the term it ends, its 'df', and a child node per next character.
+    `docs_json(postings)` makes the contents of the 'docs' of a term."""
+    yield '{"docs":{},"df":0'
+    path = ''
+    for term, postings in terms:
+        common = len(os.path.commonprefix([path, term]))
+        # close the nodes of the previous term which this one isn't under
+        yield '}' * (len(path) - common)
+        for c in term[common:-1]:
+            yield ',%s:{"docs":{},"df":0' % (_json_string(c),)
+        yield ',%s:{"docs":{%s},"df":%d' % (_json_string(term[-1]), docs_json(postings), len(postings) // 2)
+        path = term
+    yield '}' * (len(path) + 1)
+
+
+class _ChunkCompressor:
+    """Collects the index JSON as it's made, compressing each `chunk_size` characters of it with
+    `compress_to_base64`, using the executor if given."""
+
+    def __init__(self, chunk_size, executor=None, max_pending=1):
+        self.chunk_size = chunk_size
+        self.executor = executor
+        self.max_pending = max_pending
+
+        self.pieces = []
+        self.size = 0
+        self.pending = collections.deque()
+        self.chunks = []
+
+    def write(self, piece):
+        self.pieces.append(piece)
+        self.size += len(piece)
+        if self.size >= self.chunk_size:
+            data = ''.join(self.pieces)
+            for start in range(0, len(data) - self.chunk_size + 1, self.chunk_size):
+                self._compress(data[start:start + self.chunk_size])
+            rest = data[len(data) - len(data) % self.chunk_size:]
+            self.pieces = [rest]
+            self.size = len(rest)
+
+    def _compress(self, data):
+        if self.executor is None:
+            self.chunks.append(compress_to_base64(data))
+            return
+        while len(self.pending) >= self.max_pending:
+            self.chunks.append(self.pending.popleft().result())
+        self.pending.append(self.executor.submit(compress_to_base64, data))
+
+    def close(self):
+        """Return the compressed chunks."""
+        if self.size:
+            self._compress(''.join(self.pieces))
+        self.chunks.extend(future.result() for future in self.pending)
+        self.pending.clear()
+        return self.chunks
+
+
+def _compress_parts(data, chunk_size):
+    return [compress_to_base64(data[start:start + chunk_size]) for start in range(0, len(data), chunk_size)]
+
+
+def _write_parts(prefix, chunks):
+    """Write the compressed chunks to `<prefix>-part<n>.lz-b64.js` files, which
+    `LocalJSONP.loadCompressed` loads. Returns their paths."""
+    paths = []
+    for i, chunk in enumerate(chunks):
+        paths.append('%s-part%d.lz-b64.js' % (prefix, i))
+        with open(paths[-1], 'w') as f:
+            f.write('dataLoaded(%s)' % (json.dumps(
+                {'chunkI': i, 'totalChunks': len(chunks), 'chunkData': chunk}, separators=(',', ':')),))
+    return paths
+
+
+def _dump_run(path, run):
+    with open(path, 'wb') as f:
+        for field_i, field_postings in enumerate(run):
+            for term in sorted(field_postings):
+                pickle.dump((field_i, term, field_postings[term]), f, pickle.HIGHEST_PROTOCOL)
+
+
+def _load_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+class SearchIndexBuilder:
+    """Builds the static site's search index from the documents `add`ed to it, with the fields in
+    `FIELDS` and `REF`, writing it to `<dest_prefix>-part<n>.lz-b64.js` files on `finish`, or
+    split into shards by term on `finish_sharded`.
+
+    Documents are tokenized a batch at a time by a pool of `workers` processes. Their postings are
+    kept as arrays, and once there are `max_run_postings` of them, they're written out to a
+    temporary file, sorted by term, so memory use doesn't depend on the number of documents. The
+    index JSON is made from all the sorted runs merged together, and compressed a chunk at a time
+    as it's made, also by the pool. If an `executor` with `workers` processes is given, it is used
+    as the pool, rather than one of its own, and is left running."""
+
+    def __init__(self, dest_prefix, workers=1, batch_size=500, max_run_postings=2000000, chunk_size=CHUNK_SIZE,
+                 executor=None):
+        self.dest_prefix = dest_prefix
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_run_postings = max_run_postings
+        self.chunk_size = chunk_size
+
+        self.executor = executor
+        self._owns_executor = executor is None and workers > 1
+        if self._owns_executor:
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        self.temp_dir = None
+
+        self.batch = []
+        self.pending = collections.deque()
+
+        self.refs = array.array('I')
+        self.field_lengths = [array.array('I') for _ in FIELDS]
+        self.run = [{} for _ in FIELDS]
+        self.run_postings = 0
+        self.run_paths = []
+        self.num_postings = [0] * len(FIELDS)
+
+    def add(self, doc):
+        self.batch.append(doc)
+        if len(self.batch) >= self.batch_size:
+            self._tokenize_batch()
+
+    def _tokenize_batch(self):
+        batch, self.batch = self.batch, []
+        if self.executor is None:
+            self._add_tokenized(tokenize_docs(batch))
+            return
+
+        while len(self.pending) >= self.workers * 2:
+            self._add_tokenized(self.pending.popleft().result())
+        self.pending.append(self.executor.submit(tokenize_docs, batch))
+
+    def _add_tokenized(self, tokenized):
+        refs, field_lengths, postings = tokenized
+        self.refs.extend(refs)
+        for lengths, doc_lengths in zip(self.field_lengths, zip(*field_lengths)):
+            lengths.extend(doc_lengths)
+
+        for field_i, field_postings in enumerate(postings):
+            run = self.run[field_i]
+            for term, term_postings in field_postings.items():
+                if term in run:
+                    run[term].extend(term_postings)
+                else:
+                    run[term] = term_postings
+                self.run_postings += len(term_postings) // 2
+                self.num_postings[field_i] += len(term_postings) // 2
+
+        if self.run_postings >= self.max_run_postings:
+            self._spill_run()
+
+    def _spill_run(self):
+        if self.temp_dir is None:
+            self.temp_dir = tempfile.TemporaryDirectory(prefix='search-index-')
+        path = P.join(self.temp_dir.name, 'run-%d' % (len(self.run_paths),))
+        _dump_run(path, self.run)
+        self.run_paths.append(path)
+        self.run = [{} for _ in FIELDS]
+        self.run_postings = 0
+
+    def _yield_terms(self, field_i):
+        """Yield `(term, postings)` for all the terms of the field, in sorted order."""
+        runs = [(record[1:] for record in _load_run(path) if record[0] == field_i) for path in self.run_paths]
+        field_run = self.run[field_i]
+        runs.append((term, field_run[term]) for term in sorted(field_run))
+
+        merged = heapq.merge(*runs, key=lambda record: record[0])
+        for term, records in itertools.groupby(merged, key=lambda record: record[0]):
+            postings = array.array('I')
+            for _, term_postings in records:
+                postings.extend(term_postings)
+            yield term, postings
+
+    def _yield_json(self):
+        """Yield the pieces of the index JSON, as `elasticlunr.Index.toJSON` would make it."""
+        order = sorted(range(len(self.refs)), key=self.refs.__getitem__)
+
+        yield '{"version":%s,"fields":%s,"ref":%s,"documentStore":{"docs":{' % (
+            json.dumps(ELASTICLUNR_VERSION), json.dumps(list(FIELDS), separators=(',', ':')), json.dumps(REF))
+        yield ','.join('"%d":null' % (self.refs[i],) for i in order)
+        yield '},"docInfo":{'
+        yield ','.join('"%d":{%s}' % (self.refs[i], ','.join(
+            '"%s":%d' % (field, lengths[i]) for field, lengths in zip(FIELDS, self.field_lengths))) for i in order)
+        yield '},"length":%d,"save":false},"index":{' % (len(self.refs),)
+
+        for field_i, field in enumerate(FIELDS):
+            yield '%s"%s":{"root":' % (',' if field_i else '', field)
+            for piece in yield_trie_json(self._yield_terms(field_i)):
+                yield piece
+            yield ',"length":%d}' % (self.num_postings[field_i],)
+
+        yield '},"pipeline":%s}' % (json.dumps(list(PIPELINE), separators=(',', ':')),)
+
+    def finish(self):
+        """Write the index files. Returns the number of files written."""
+        try:
+            self._flush()
+
+            compressor = _ChunkCompressor(self.chunk_size, self.executor, max_pending=self.workers * 2)
+            for piece in self._yield_json():
+                compressor.write(piece)
+            return len(_write_parts(self.dest_prefix, compressor.close()))
+        finally:
+            self.close()
+
+    def _flush(self):
+        if self.batch:
+            self._tokenize_batch()
+        while self.pending:
+            self._add_tokenized(self.pending.popleft().result())
+
+    def _yield_shards(self, shard_postings):
+        """Yield the terms of all the fields, split into shards of consecutive terms with about
+        `shard_postings` postings each, as `(first_term, [(term, postings) for each field])`."""
+        def yield_records(field_i):
+            for term, postings in self._yield_terms(field_i):
+                yield term, field_i, postings
+
+        merged = heapq.merge(*[yield_records(field_i) for field_i in range(len(FIELDS))],
+                             key=lambda record: record[0])
+
+        first_term = None
+        shard = [[] for _ in FIELDS]
+        num_postings = 0
+        for term, records in itertools.groupby(merged, key=lambda record: record[0]):
+            # a term's postings are kept in a single shard, however many there are
+            if num_postings >= shard_postings:
+                yield first_term, shard
+                first_term = None
+                shard = [[] for _ in FIELDS]
+                num_postings = 0
+
+            if first_term is None:
+                first_term = term
+            for _, field_i, postings in records:
+                shard[field_i].append((term, postings))
+                num_postings += len(postings) // 2
+
+        if first_term is not None:
+            yield first_term, shard
+
+    def _shard_json(self, shard, field_lengths):
+        """Return the JSON of the inverted index of each field, for the terms of a shard. A
+        document's term frequencies are divided by the square root of the length of its field
+        beforehand, as elasticlunr does when searching, so the shards don't need the document
+        store."""
+        def docs_json(field_i):
+            def make_json(postings):
+                pairs = sorted(zip(postings[0::2], postings[1::2]))
+                return ','.join('"%d":{"tf":%s}' % (ref, _js_number(
+                    math.sqrt(count) * _length_norm(field_lengths[ref][field_i]))) for ref, count in pairs)
+            return make_json
+
+        pieces = ['{"index":{']
+        for field_i, field in enumerate(FIELDS):
+            pieces.append('%s"%s":{"root":' % (',' if field_i else '', field))
+            pieces.extend(yield_trie_json(shard[field_i], docs_json(field_i)))
+            pieces.append(',"length":%d}' % (sum(len(postings) // 2 for _, postings in shard[field_i]),))
+        pieces.append('}}')
+        return ''.join(pieces)
+
+    def finish_sharded(self, shard_postings=20000):
+        """Write the index split into shards by term, so a search only needs to load the shards
+        with the terms it looks for, rather than the whole index:
+            * `<dest_prefix>-shard<n>-part<m>.lz-b64.js` - each shard, as compressed pieces, with
+              the inverted indices of all the fields for a range of consecutive terms. A term and
+              all the terms starting with it are in consecutive shards
+            * `<dest_prefix>-shards.js` - the shard directory, with the first term of each shard
+              and what's needed to make an empty index to load the shards into
+        Returns the paths of the files written."""
+        try:
+            self._flush()
+
+            field_lengths = {ref: lengths for ref, lengths in zip(self.refs, zip(*self.field_lengths))}
+            paths = []
+            shard_starts = []
+            pending = collections.deque()
+
+            def write_shard(shard_i, chunks):
+                paths.extend(_write_parts('%s-shard%d' % (self.dest_prefix, shard_i), chunks))
+
+            for first_term, shard in self._yield_shards(shard_postings):
+                data = self._shard_json(shard, field_lengths)
+                shard_starts.append(first_term)
+                if self.executor is None:
+                    write_shard(len(shard_starts) - 1, _compress_parts(data, self.chunk_size))
+                    continue
+
+                while len(pending) >= self.workers * 2:
+                    shard_i, future = pending.popleft()
+                    write_shard(shard_i, future.result())
+                pending.append((len(shard_starts) - 1, self.executor.submit(_compress_parts, data, self.chunk_size)))
+            for shard_i, future in pending:
+                write_shard(shard_i, future.result())
+
+            paths.append('%s-shards.js' % (self.dest_prefix,))
+            with open(paths[-1], 'w') as f:
+                f.write('dataLoaded(%s);' % (json.dumps({
+                    'version': ELASTICLUNR_VERSION,
+                    'fields': FIELDS,
+                    'ref': REF,
+                    'pipeline': PIPELINE,
+                    'numDocs': len(self.refs),
+                    'shardStarts': shard_starts,
+                }, separators=(',', ':')),))
+            return paths
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the worker processes, unless the pool was given, and remove the temporary files."""
+        if self._owns_executor:
+            self.executor.shutdown()
+            self._owns_executor = False
+        self.executor = None
+        if self.temp_dir is not None:
+            self.temp_dir.cleanup()
+            self.temp_dir = None
@@ -0,0 +1,111 @@
+import concurrent.futures
+import re
+import time
+
+import requests
+
+from .logging import eprint
+from .scraper import TRANSIENT_STATUSES
+from .throttle import backoff_delay
+
+
+class FileDownloader:
+    """Download group files into the backup database, several at once over one pooled session.
+
+    Each response is streamed into the database's GridFS `chunk_size` bytes at a time, so memory use
+    doesn't depend on the file sizes. If a download breaks off, it is resumed where it stopped
+    with a Range request, up to `max_retries` times. Server errors and throttling are retried the
+    same way."""
+
+    def __init__(self, db, session, workers=4, chunk_size=255 * 1024, max_retries=5):
+        self.db = db
+        self.session = session
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+
+    @staticmethod
+    def _resumes_at(resp, written):
+        """Whether the response to a Range request continues the data after `written` bytes."""
+        match = re.match(r'bytes (\d+)-', resp.headers.get('Content-Range', ''))
+        return resp.status_code == 206 and match is not None and int(match.group(1)) == written
+
+    def _stream_into(self, url, file_path):
+        """Stream the file at `url` into a new data writer for `file_path` and return it, resuming
+        from where it left off on errors. If the server doesn't resume at the right place, the data
+        is written again from the start."""
+        writer = self.db.open_file_data(file_path)
+        written = 0
+        try:
+            for attempt in range(self.max_retries + 1):
+                headers = {}
+                if written:
+                    headers['Range'] = 'bytes=%d-' % written
+
+                resp = None
+                try:
+                    resp = self.session.get(url, headers=headers, stream=True, timeout=60)
+                    resp.raise_for_status()
+                    if written and not self._resumes_at(resp, written):
+                        eprint("Download of '%s' wasn't resumed at %s bytes, starting over..." % (url, written))
+                        writer.abort()
+                        writer = self.db.open_file_data(file_path)
+                        written = 0
+                        if resp.status_code != 200:
+                            continue
+
+                    for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                        writer.write(chunk)
+                        written += len(chunk)
+                    return writer
+                except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                        requests.HTTPError) as e:
+                    if isinstance(e, requests.HTTPError) and e.response.status_code not in TRANSIENT_STATUSES:
+                        raise
+                    if attempt == self.max_retries:
+                        raise
+                    delay = backoff_delay(attempt)
+                    eprint("Download of '%s' broke off at %s bytes (%s), resuming in %.1fs..." % (
+                        url, written, e, delay))
+                    time.sleep(delay)
+                finally:
+                    if resp is not None:
+                        resp.close()
+
+            raise RuntimeError("Giving up on the download of '%s' after %s retries" % (url, self.max_retries))
+        except BaseException:
+            writer.abort()
+            raise
+
+    def download(self, file_info):
+        """Download the data of the given file, as yielded by `YahooBackupScraper.yield_walk_files`,
+        into the database."""
+        self._stream_into(file_info['url'], file_info['filePath']).close()
+        return file_info
+
+    def run(self, file_infos):
+        """Download the data of all the given files, storing their entries as well. Returns the
+        number of files downloaded."""
+        done_count = 0
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = set()
+
+            def wait_for(return_when):
+                nonlocal pending, done_count
+                done, pending = concurrent.futures.wait(pending, return_when=return_when)
+                for future in done:
+                    eprint("Downloaded file '%s'" % (future.result()['filePath'],))
+                    done_count += 1
+
+            for file_info in file_infos:
+                eprint("Inserting file '%s'..." % file_info['filePath'])
+                self.db.upsert_file_entry(file_info)
+                pending.add(pool.submit(self.download, file_info))
+
+                if len(pending) >= self.workers:
+                    wait_for(concurrent.futures.FIRST_COMPLETED)
+
+            wait_for(concurrent.futures.ALL_COMPLETED)
+
+        return done_count
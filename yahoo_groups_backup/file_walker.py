@@ -0,0 +1,85 @@
+import concurrent.futures
+import threading
+
+from .logging import eprint
+
+
+class FileTreeWalker:
+    """Walk the Files section of a group, listing sibling directories at the same time with
+    `workers` browsers, each with its own scraper made by `make_scraper()`.
+
+    Each directory listing is cached in the database. A subdirectory whose listed date and size
+    (its 'signature') didn't change since it was cached is not visited again: its files, and those
+    of its own subdirectories, are taken from the cache instead.
+
+    The browsers of the scrapers are quit once the walk is over."""
+
+    def __init__(self, db, make_scraper, workers=1, use_cache=True):
+        self.db = db
+        self.make_scraper = make_scraper
+        self.workers = workers
+        self.use_cache = use_cache
+
+        self._local = threading.local()
+        self._scrapers = []
+        self._scrapers_lock = threading.Lock()
+
+    def _list_directory(self, path):
+        # each worker thread drives its own browser
+        if not hasattr(self._local, 'scraper'):
+            self._local.scraper = self.make_scraper()
+            with self._scrapers_lock:
+                self._scrapers.append(self._local.scraper)
+        return self._local.scraper.list_directory(path)
+
+    def _close_scrapers(self):
+        with self._scrapers_lock:
+            scrapers, self._scrapers = self._scrapers, []
+        for scraper in scrapers:
+            try:
+                scraper.close()
+            except Exception as e:
+                eprint("Failed to quit a browser: %s" % (e,))
+
+    def _unchanged_listing(self, dir_info):
+        """Return the cached listing of the directory, if its signature didn't change."""
+        if not self.use_cache:
+            return None
+
+        listing = self.db.get_file_listing(dir_info['filePath'])
+        if listing and listing['signature'] == dir_info['signature']:
+            return listing
+        return None
+
+    def walk(self, path="."):
+        """Yield a dict describing each file under `path`, as `YahooBackupScraper.yield_walk_files`
+        does, though not in the same order."""
+        try:
+            yield from self._walk(path)
+        finally:
+            self._close_scrapers()
+
+    def _walk(self, path):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = {pool.submit(self._list_directory, path): (path, None)}
+
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    dir_path, signature = pending.pop(future)
+                    files, dirs = future.result()
+                    self.db.upsert_file_listing(dir_path, signature, files, dirs)
+                    yield from files
+
+                    # subdirectories still to visit, going through the cached ones right away
+                    to_visit = list(dirs)
+                    while to_visit:
+                        dir_info = to_visit.pop()
+                        listing = self._unchanged_listing(dir_info)
+                        if listing:
+                            eprint("Directory '%s' is unchanged, using the cached listing" % (dir_info['filePath'],))
+                            yield from listing['files']
+                            to_visit.extend(listing['dirs'])
+                        else:
+                            pending[pool.submit(self._list_directory, dir_info['filePath'])] = (
+                                dir_info['filePath'], dir_info['signature'])
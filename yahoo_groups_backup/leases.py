@@ -0,0 +1,102 @@
+import contextlib
+import datetime
+import threading
+
+import pymongo
+
+from .logging import eprint
+
+
+class WorkLeases:
+    """Message id ranges to scrape, stored as lease documents in the group's `scrape_leases`
+    collection, so several scraper processes (on any number of hosts) can share the work.
+
+    Each document covers the message numbers in [`start`, `end`), and has:
+        * '_id' - the range start
+        * 'start', 'end' - the range
+        * 'done' - whether the range was scraped
+        * 'scrapedUpTo' - the last message number scraped, when done; the newest range may only
+          have been partially scraped, if the group had fewer messages at the time
+        * 'owner' - the process currently holding the lease, or None
+        * 'expires' - when the lease expires, if it isn't renewed
+    A lease whose owner stopped renewing it (e.g. the process died) is claimable again once it
+    expires."""
+
+    def __init__(self, backup_db, owner, duration=300):
+        self.leases = backup_db.db.scrape_leases
+        self.owner = owner
+        self.duration = datetime.timedelta(seconds=duration)
+
+        self.leases.create_index([("done", pymongo.ASCENDING), ("expires", pymongo.ASCENDING)])
+
+    def ensure_ranges(self, last_message, range_size):
+        """Make sure there are lease documents covering all message numbers up to `last_message`.
+        Existing ranges are left as they are, except that a range which was only partially
+        scraped is reopened if there are new messages in it. All processes have to use the same
+        `range_size`."""
+        self.leases.update_many(
+            {'done': True, 'partial': True, 'scrapedUpTo': {'$lt': last_message}},
+            {'$set': {'done': False}})
+
+        ops = [
+            pymongo.UpdateOne(
+                {'_id': start},
+                {'$setOnInsert': {'start': start, 'end': start + range_size,
+                                  'done': False, 'owner': None, 'expires': None}},
+                upsert=True)
+            for start in range(1, last_message + 1, range_size)
+        ]
+        if ops:
+            self.leases.bulk_write(ops, ordered=False)
+
+    def claim(self):
+        """Claim a range which isn't done and isn't leased (or whose lease expired), newest range
+        first. Returns the lease document, or None if there is nothing left to claim."""
+        now = datetime.datetime.utcnow()
+        return self.leases.find_one_and_update(
+            {'done': False, '$or': [{'owner': None}, {'expires': {'$lt': now}}]},
+            {'$set': {'owner': self.owner, 'expires': now + self.duration}},
+            sort=[('start', pymongo.DESCENDING)],
+            return_document=pymongo.ReturnDocument.AFTER)
+
+    def renew(self, lease):
+        """Extend the lease. Returns False if the lease was lost, i.e. another process reclaimed
+        it after it expired."""
+        result = self.leases.update_one(
+            {'_id': lease['_id'], 'owner': self.owner},
+            {'$set': {'expires': datetime.datetime.utcnow() + self.duration}})
+        return result.matched_count == 1
+
+    def release(self, lease, scraped_up_to=None):
+        """Give up the lease. If `scraped_up_to` is given, the range is marked as done, up to that
+        message number."""
+        update = {'owner': None, 'expires': None}
+        if scraped_up_to is not None:
+            update.update({
+                'done': True,
+                'scrapedUpTo': scraped_up_to,
+                'partial': scraped_up_to < lease['end'] - 1,
+            })
+        self.leases.update_one({'_id': lease['_id'], 'owner': self.owner}, {'$set': update})
+
+    @contextlib.contextmanager
+    def keep_renewed(self, lease):
+        """Context manager which renews the lease from a background thread while the body runs.
+        Yields a `threading.Event` which is set if the lease is lost."""
+        stop = threading.Event()
+        lost = threading.Event()
+
+        def renew_periodically():
+            while not stop.wait(self.duration.total_seconds() / 3):
+                if not self.renew(lease):
+                    eprint("Lost the lease on messages %s to %s!" % (lease['start'], lease['end']))
+                    lost.set()
+                    return
+
+        renewer = threading.Thread(target=renew_periodically, daemon=True)
+        renewer.start()
+        try:
+            yield lost
+        finally:
+            stop.set()
+            renewer.join()
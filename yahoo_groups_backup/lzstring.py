@@ -0,0 +1,81 @@
+# A port of the compression side of lz-string 1.4 (static_site_template/js/lz-string.min.js),
+# which the static site uses to decompress the search index.
+
+import base64
+import itertools
+
+
+def _compress(uncompressed):
+    """Return the compressed data of the string as a string of '0' and '1' bits. Like lz-string, works
+    on UTF-16 code units, so the string must not have characters outside the BMP (they can be given
+    as surrogate pairs)."""
+    # lz-string writes each value least significant bit first, so the bits of each value are
+    # formatted and reversed
+    bits = []
+    append = bits.append
+
+    dictionary = {}
+    dictionary_to_create = set()
+    w = ''
+    enlarge_in = 2
+    dict_size = 3
+    num_bits = 2
+
+    # None marks the end of the input, where what's left in w is written
+    for c in itertools.chain(uncompressed, (None,)):
+        if c is not None:
+            if c not in dictionary:
+                dictionary[c] = dict_size
+                dict_size += 1
+                dictionary_to_create.add(c)
+
+            wc = w + c
+            if wc in dictionary:
+                w = wc
+                continue
+        elif not w:
+            break
+
+        # write the code of w
+        if w in dictionary_to_create:
+            if ord(w) < 256:
+                append('0' * num_bits)
+                append(format(ord(w), '08b')[::-1])
+            else:
+                append('1' + '0' * (num_bits - 1))
+                append(format(ord(w), '016b')[::-1])
+            enlarge_in -= 1
+            if enlarge_in == 0:
+                enlarge_in = 1 << num_bits
+                num_bits += 1
+            dictionary_to_create.remove(w)
+        else:
+            append(format(dictionary[w], '0%db' % num_bits)[::-1])
+        enlarge_in -= 1
+        if enlarge_in == 0:
+            enlarge_in = 1 << num_bits
+            num_bits += 1
+
+        if c is None:
+            break
+        dictionary[wc] = dict_size
+        dict_size += 1
+        w = c
+
+    # mark the end of the stream
+    append(format(2, '0%db' % num_bits)[::-1])
+    return ''.join(bits)
+
+
+def compress_to_base64(uncompressed):
+    """Same as `LZString.compressToBase64`."""
+    bits = _compress(uncompressed)
+    # lz-string always pads with at least one bit, up to a whole character
+    bits += '0' * (6 - len(bits) % 6)
+    num_chars = len(bits) // 6
+
+    # each 6 bits are a character of the standard base64 alphabet, so let base64 encode them, as
+    # whole bytes
+    bits += '0' * (-len(bits) % 24)
+    result = base64.b64encode(int(bits, 2).to_bytes(len(bits) // 8, 'big'))[:num_chars].decode('ascii')
+    return result + '=' * (-len(result) % 4)
@@ -1,9 +1,18 @@
 import email
+import hashlib
 import html
+import json
 import re
 import sys
 import traceback
 
+from .compression import MessageDoc
+
+
+# bump this whenever a change here changes the HTML rendered for messages, so the rendered HTML
+# cached by `render_cache.RenderCache` is rendered again
+RENDERER_VERSION = 1
+
 
 def eprint(*args, **kwargs):
     print(*args, **kwargs, file=sys.stderr)
@@ -123,31 +132,71 @@ def html_from_yahoo_raw_email(raw_email_str):
     return html_from_email_message(email.message_from_string(raw_email_str))
 
 
-def html_from_message(message, use_yahoo_on_fail=False):
-    """Given the message record, return the best HTML we can get from it."""
+def html_from_message(message, use_yahoo_on_fail=False, with_fallback=False):
+    """Given the message record, return the best HTML we can get from it. If `with_fallback` is set,
+    return `(html, fell_back)` instead, where `fell_back` tells whether Yahoo!'s rendering was used
+    because the raw email is truncated or lacks the attachment with the content."""
     assert 'messageBody' in message
 
+    def result(html_string, fell_back):
+        return (html_string, fell_back) if with_fallback else html_string
+
     if is_raw_email_truncated(message['rawEmail']):
         # return Yahoo's rendering, since it is less truncated
-        return message['messageBody']
+        return result(message['messageBody'], True)
 
     # otherwise, try to render it ourselves
     try:
-        result = html_from_yahoo_raw_email(message['rawEmail'])
+        html_string = html_from_yahoo_raw_email(message['rawEmail'])
 
         # Yahoo! strips out attachments, so if the sender sent their email as
         # an attachment, it won't be available in the raw email. In this case,
         # use Yahoo!'s rendering.
-        if 'Attachment content not displayed' in result:
-            return message['messageBody']
+        if 'Attachment content not displayed' in html_string:
+            return result(message['messageBody'], True)
 
-        return result
+        return result(html_string, False)
     except Exception:
         if use_yahoo_on_fail:
             # eprint("Failed to process raw email from Yahoo! message:")
             # traceback.print_exc(file=sys.stderr)
             # eprint("Falling back on Yahoo!'s rendering")
-            return message['messageBody']
+            return result(message['messageBody'], True)
 
         # otherwise re-raise it
         raise
+
+
+def render_message(message):
+    """Return `(html, failed)` for the message record, where `failed` tells whether the raw email
+    couldn't be rendered - rendering it failed, or it is truncated or lacks its attachment - in
+    which case the HTML is Yahoo!'s rendering instead."""
+    try:
+        return html_from_message(message, with_fallback=True)
+    except Exception:
+        return message['messageBody'], True
+
+
+def render_key(message):
+    """Return the key identifying what `render_message` returns for the message record: a hash
+    of its raw email, Yahoo!'s rendering of it and the `RENDERER_VERSION`."""
+    h = hashlib.sha256(b'%d\n' % RENDERER_VERSION)
+    for field in ('rawEmail', 'messageBody'):
+        # hashed separately, so the boundary between the fields counts too
+        h.update(hashlib.sha256((message[field] or '').encode('utf8')).digest())
+    return h.hexdigest()
+
+
+def content_hash(message_obj):
+    """Return a hash of everything in a message object from the API, stored with the message as its
+    'contentHash', so what's made from the message can tell when it's stored again with changes."""
+    return hashlib.sha256(json.dumps(message_obj, sort_keys=True).encode('utf8')).hexdigest()
+
+
+def stored_content_hash(doc):
+    """Return the `content_hash` of a stored message document which doesn't have one, e.g. of a
+    backup made before it was introduced, from the message object it was made from as near as it
+    can be told: its fields decompressed, with its '_id' as the 'msgId'."""
+    message_obj = {key: value for key, value in MessageDoc(doc).items() if key != '_id'}
+    message_obj['msgId'] = doc['_id']
+    return content_hash(message_obj)
@@ -0,0 +1,63 @@
+import itertools
+
+from .compression import compress_text, decompress_text
+from .message import render_key, render_message
+
+
+class RenderCache:
+    """Renders messages with `message.render_message`, keeping the result in the backup database,
+    keyed by `message.render_key`. Messages don't change once posted, so a message is only
+    rendered again when its raw email, Yahoo!'s rendering or the `message.RENDERER_VERSION`
+    changes.
+
+    Lookups and stores are done a batch of messages at a time. `num_hits` and `num_misses` count
+    the messages which were and weren't in the cache."""
+
+    def __init__(self, db, enabled=True):
+        self.db = db
+        self.enabled = enabled
+
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def render(self, message):
+        """Return `(html, failed)` for the message, as `message.render_message` does."""
+        return self.render_all([message])[0]
+
+    def render_all(self, messages):
+        """Return `(html, failed)` for each of the messages, in order."""
+        if not self.enabled:
+            self.num_misses += len(messages)
+            return [render_message(message) for message in messages]
+
+        keys = [render_key(message) for message in messages]
+        cached = self.db.get_rendered_messages(set(keys))
+
+        results = []
+        new_entries = {}
+        for key, message in zip(keys, messages):
+            if key in cached:
+                self.num_hits += 1
+                html, failed = cached[key]
+                results.append((decompress_text(html), failed))
+                continue
+
+            self.num_misses += 1
+            html, failed = render_message(message)
+            new_entries[key] = (compress_text(html), failed)
+            results.append((html, failed))
+
+        if new_entries:
+            self.db.put_rendered_messages(new_entries)
+        return results
+
+    def yield_rendered(self, messages, batch_size=500):
+        """Yield `(message, html, failed)` for each of the messages, rendering a batch at a time."""
+        messages = iter(messages)
+        while True:
+            batch = list(itertools.islice(messages, batch_size))
+            if not batch:
+                return
+
+            for message, (html, failed) in zip(batch, self.render_all(batch)):
+                yield message, html, failed
@@ -0,0 +1,94 @@
+import concurrent.futures
+
+from .logging import eprint
+
+
+class ResumePlan:
+    """The work left to do to scrape all messages from `first_message` up to `last_message`, given
+    what is already in the database. Iterating over it yields the message numbers still to scrape,
+    in descending order. The already updated messages are loaded once, up-front, instead of
+    querying the database for each message number."""
+
+    def __init__(self, db, last_message, first_message=1):
+        self.last_message = last_message
+        self.first_message = first_message
+        self.updated_ids = db.updated_message_ids(first_message, last_message + 1)
+
+        self.num_remaining = (last_message - first_message + 1) - self.updated_ids.count(
+            first_message, last_message + 1)
+
+    def is_done(self, message_number):
+        return message_number in self.updated_ids
+
+    def __len__(self):
+        return self.num_remaining
+
+    def __iter__(self):
+        for message_number in range(self.last_message, self.first_message - 1, -1):
+            if message_number not in self.updated_ids:
+                yield message_number
+
+
+class MessageScrapeEngine:
+    """Scrape messages with several workers at once, all sharing the same scraper.
+
+    Up to `workers` messages are in flight at any time, or as many as the `controller` (a
+    `throttle.AdaptiveController`) currently allows, if given. The scraped messages are stored
+    from the calling thread, as they complete, so the database is only ever written to from one
+    thread."""
+
+    def __init__(self, scraper, db, workers=1, controller=None):
+        self.scraper = scraper
+        self.db = db
+        self.workers = workers
+        self.controller = controller
+
+    def max_in_flight(self):
+        if self.controller:
+            return min(self.workers, self.controller.concurrency)
+        return self.workers
+
+    def store_message(self, message_number, msg):
+        """Store a scraped message (or its absence) into the database."""
+        self.db.upsert_message(message_number, msg)
+        if not msg:
+            eprint("Message #%s is missing" % (message_number,))
+        else:
+            eprint("Inserted message #%s by %s/%s/%s" % (
+                message_number,
+                msg['authorName'], msg['profile'], msg['from']))
+
+    def run(self, message_numbers, fetch=None):
+        """Scrape and store all the messages of the given iterable of message numbers. Returns the
+        number of messages scraped.
+
+        `fetch` is called with each message number to get the message, and defaults to the
+        scraper's `get_message`."""
+        fetch = fetch or self.scraper.get_message
+        done_count = 0
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = {}
+            message_numbers = iter(message_numbers)
+            exhausted = False
+
+            while True:
+                # top up the in-flight requests
+                while not exhausted and len(pending) < self.max_in_flight():
+                    try:
+                        message_number = next(message_numbers)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending[pool.submit(fetch, message_number)] = message_number
+
+                if not pending:
+                    break
+
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    message_number = pending.pop(future)
+                    self.store_message(message_number, future.result())
+                    done_count += 1
+
+        return done_count
@@ -1,35 +1,112 @@
+import concurrent.futures
 import html
 import json
 import platform
 import random
 import re
 import sys
+import threading
 import time
 import urllib.parse
 
 import dateutil.parser
-from selenium.webdriver.common.keys import Keys
-import splinter
+import requests
+
+from . import message
+from .throttle import backoff_delay
 
 
 def eprint(*args, **kwargs):
     return print(*args, **kwargs, file=sys.stderr)
 
 
+API_ROOT = "https://groups.yahoo.com/api/v1/groups"
+
+# stands in for the HTTP status of a request which got no response, e.g. a dropped connection
+NO_RESPONSE = 0
+
+# API errors worth retrying: network and server errors and throttling
+TRANSIENT_STATUSES = (NO_RESPONSE, 429, 500, 502, 503, 504, 999)
+
+
 class YahooBackupScraper:
     """Scrape Yahoo! Group messages with Selenium. Login information is required for
-    private groups."""
+    private groups.
+
+    If `browserless` is set, the JSON API is queried over a pooled, keep-alive HTTP session
+    instead. The browser is then only started when needed to log in: its cookies are copied
+    into the session and it is shut down again. `api_root` can point the API calls at
+    another server, e.g. a local stand-in for testing.
 
-    def __init__(self, group_name, driver, login_email=None, password=None, delay=1):
+    If a `rate_limiter` (a `throttle.TokenBucket`) is given, every API request takes a token
+    from it instead of sleeping for `delay` before each message. This allows several threads
+    to share one scraper and one request budget.
+
+    Server errors and throttling are retried up to `max_retries` times, with jittered exponential
+    backoff. If a `controller` (a `throttle.AdaptiveController`) is given, it is told about the
+    latency of each request and about each error, to adapt the request rate."""
+
+    def __init__(self, group_name, driver, login_email=None, password=None, delay=1,
+                 browserless=False, api_root=API_ROOT, pool_size=10, rate_limiter=None,
+                 controller=None, max_retries=5):
         self.group_name = group_name
         self.login_email = login_email
         self.password = password
         self.delay = delay
-
-        self.br = splinter.Browser(driver)
+        self.driver = driver
+        self.api_root = api_root.rstrip('/')
+        self.rate_limiter = rate_limiter
+        self.controller = controller
+        self.max_retries = max_retries
+
+        self._br = None
+        self._logged_in = False
+        self._login_lock = threading.Lock()
+        self.session = None
+        self._raw_pool = None
+        if browserless:
+            self.session = self._make_session(pool_size)
+            # fetches the /raw halves of messages alongside the formatted halves
+            self._raw_pool = concurrent.futures.ThreadPoolExecutor(max_workers=pool_size)
 
     def __del__(self):
-        self.br.quit()
+        self._quit_browser()
+
+    @property
+    def br(self):
+        """The splinter browser, started on first use."""
+        if self._br is None:
+            # only imported here, as browserless scraping doesn't need it
+            import splinter
+            self._br = splinter.Browser(self.driver)
+        return self._br
+
+    def _quit_browser(self):
+        br = getattr(self, '_br', None)
+        if br is not None:
+            br.quit()
+            self._br = None
+
+    def close(self):
+        """Quit the browser, if it was started. It is started again if the scraper is used again."""
+        self._quit_browser()
+
+    @staticmethod
+    def _make_session(pool_size):
+        """Return a requests session which keeps up to `pool_size` connections alive per host."""
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def _files_url(self, path):
+        """Return the url of the human-consumable page of the given directory in the Files section."""
+        return "https://groups.yahoo.com/neo/groups/%s/files/%s/" % (self.group_name, path)
+
+    def _api_url(self, path):
+        """Return the JSON API url for the given path within the group."""
+        return "%s/%s/%s" % (self.api_root, self.group_name, path)
 
     def _is_login_page(self):
         html = self.br.html
@@ -65,7 +142,10 @@ class YahooBackupScraper:
         time.sleep(1)
 
         if self._is_login_page():
+            if self._logged_in and self.controller:
+                self.controller.record_error("bounced to the login page")
             self._process_login_page()
+            self._logged_in = True
             # get the page again
             self.br.visit(url)
 
@@ -74,18 +154,114 @@ class YahooBackupScraper:
 
         return
 
+    def _login_with_browser(self, url):
+        """Log in by visiting `url` with the browser, then copy the browser's cookies and user agent
+        into the HTTP session. The browser is shut down afterwards, as it is no longer needed."""
+        eprint("Logging in with the browser to get session cookies...")
+        self._visit_with_login(url)
+        self._copy_browser_cookies(self.session)
+        self._quit_browser()
+
+    def _copy_browser_cookies(self, session):
+        """Copy the browser's cookies and user agent into the given requests session."""
+        for cookie in self.br.driver.get_cookies():
+            session.cookies.set(
+                cookie['name'], cookie['value'],
+                domain=cookie.get('domain'), path=cookie.get('path', '/'))
+        session.headers['User-Agent'] = self.br.driver.execute_script("return navigator.userAgent;")
+
+    def make_download_session(self, pool_size=10):
+        """Return a requests session to download the group's files with. In browserless mode this is
+        the scraper's own session, otherwise a new one with the browser's cookies."""
+        if self.session is not None:
+            return self.session
+
+        # make sure we're logged in, so the cookies are there
+        self._visit_with_login(self._files_url("."))
+
+        session = self._make_session(pool_size)
+        self._copy_browser_cookies(session)
+        return session
+
+    def _get_json(self, url):
+        """Fetch the URL with the HTTP session and return the loaded JSON, or None if the response
+        was not JSON or was an authorization error, i.e. we need to log in. Network errors are
+        returned as an API error with the `NO_RESPONSE` status."""
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+
+        start = time.monotonic()
+        try:
+            resp = self.session.get(url, timeout=60)
+        except requests.RequestException as e:
+            eprint("Request for %s failed: %s" % (url, e))
+            return {'ygError': {'httpStatus': NO_RESPONSE}}
+        if resp.status_code in (429, 999):
+            # throttled - the response is a plain page, make it look like any other API error
+            return {'ygError': {'httpStatus': resp.status_code}}
+
+        try:
+            data = resp.json()
+        except ValueError:
+            return None
+
+        status = data.get('ygError', {}).get('httpStatus')
+        if status in (401, 403):
+            return None
+
+        if self.controller and status not in TRANSIENT_STATUSES:
+            self.controller.record_success(time.monotonic() - start)
+
+        return data
+
     def _load_json_url(self, url):
         """Given a URL which returns a JSON response, return the loaded object. A bit hacky to deal with
         Selenium wrapping the JSON in <html>...<body><pre>...</pre></body></html>."""
-        self._visit_with_login(url)
-        return json.loads(self.br.find_by_tag("pre")[0].text)
+        if self.session is None:
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            self._visit_with_login(url)
+            return json.loads(self.br.find_by_tag("pre")[0].text)
+
+        data = self._get_json(url)
+        if data is None:
+            # only one thread logs in, the others wait for it and then use the new cookies
+            with self._login_lock:
+                data = self._get_json(url)
+                if data is None:
+                    if self._logged_in and self.controller:
+                        self.controller.record_error("bounced to the login page")
+                    self._login_with_browser(url)
+                    self._logged_in = True
+                    data = self._get_json(url)
+            if data is None:
+                raise RuntimeError("Unable to login")
+
+        return data
+
+    def _load_api_json(self, url):
+        """Load the JSON API url, retrying server errors and throttling. Returns the loaded
+        object, which may still be an error, e.g. a 404."""
+        for attempt in range(self.max_retries + 1):
+            data = self._load_json_url(url)
+            status = data.get('ygError', {}).get('httpStatus')
+            if status not in TRANSIENT_STATUSES:
+                return data
+
+            reason = "got no response" if status == NO_RESPONSE else "got error %s" % (status,)
+            if self.controller:
+                self.controller.record_error(reason)
+            if attempt < self.max_retries:
+                delay = backoff_delay(attempt, base=self.delay)
+                eprint("Request %s, trying again in %.1fs..." % (reason, delay))
+                time.sleep(delay)
+
+        raise RuntimeError("Giving up after %s retries:\n\n%s" % (self.max_retries, json.dumps(data)))
 
     def get_last_message_number(self):
         """Return the latest message number in the group."""
-        url = "https://groups.yahoo.com/api/v1/groups/%s/messages?count=1&sortOrder=desc&direction=-1" % (
-            self.group_name,
-        )
-        return self._load_json_url(url)['ygData']['messages'][0]['messageId']
+        url = self._api_url("messages?count=1&sortOrder=desc&direction=-1")
+        return self._load_api_json(url)['ygData']['messages'][0]['messageId']
 
     @staticmethod
     def _massage_message(data):
@@ -171,20 +347,24 @@ class YahooBackupScraper:
         """Get the data for the given message number. Returns None if the message doesn't exist.
         Returns the object in the 'ygData' key returned by the Yahoo! Groups API,
         with both the HTML and the raw data in it."""
-        # delay to prevent rate limiting
-        time.sleep(max(0, random.gauss(self.delay, self.delay / 2)))
-        url = "https://groups.yahoo.com/api/v1/groups/%s/messages/%s" % (self.group_name, message_number)
+        if not self.rate_limiter:
+            # delay to prevent rate limiting
+            time.sleep(max(0, random.gauss(self.delay, self.delay / 2)))
+        url = self._api_url("messages/%s" % (message_number,))
+
+        raw_future = None
+        if self._raw_pool:
+            raw_future = self._raw_pool.submit(self._load_api_json, url + "/raw")
 
-        formatted = self._load_json_url(url)
+        formatted = self._load_api_json(url)
         if 'ygError' in formatted:
             if formatted['ygError']['httpStatus'] == 404:
                 return None
-            if formatted['ygError']['httpStatus'] == 500:
-                eprint("Got unexpected server error, trying again...")
-                return self.get_message(message_number)
             raise RuntimeError("Unexpected error:\n\n%s" % json.dumps(formatted))
 
-        raw = self._load_json_url(url + "/raw")
+        raw = raw_future.result() if raw_future else self._load_api_json(url + "/raw")
+        if 'ygError' in raw:
+            raise RuntimeError("Unexpected error:\n\n%s" % json.dumps(raw))
 
         data = formatted['ygData']
         data['rawEmail'] = raw['ygData']['rawEmail']
@@ -196,7 +376,103 @@ class YahooBackupScraper:
             eprint("Failed to process message:\n%s" % (pprint.pformat(data)))
             raise
 
+    def yield_message_listing(self, last_message, page_size=100, first_message=1):
+        """Page backwards through the message listing, starting at `last_message`, `page_size`
+        messages per request. Yields `(message_number, entry)` for every message number from
+        `last_message` down to `first_message`, where `entry` is the listing data for the message,
+        or None if the message number is missing from the listing, i.e. the message was deleted.
+
+        The 'nextInTime' and 'prevInTime' links are filled in from the neighbouring entries, if
+        the listing doesn't have them. The entries just outside the range are only used for this."""
+        expected = last_message
+        start = last_message + 1
+        held = None
+        newer = 0
+
+        def yield_gap(down_to):
+            nonlocal expected
+            while expected > down_to:
+                yield expected, None
+                expected -= 1
+
+        finished = False
+        while not finished:
+            url = self._api_url("messages?count=%d&start=%d&sortOrder=desc&direction=-1" % (page_size, start))
+            entries = self._load_api_json(url)['ygData']['messages']
+            if not entries:
+                break
+
+            for entry in entries:
+                number = entry['messageId']
+                if number > last_message:
+                    # newer than the range, only needed for the first 'nextInTime'
+                    newer = number
+                    continue
+                if number > expected:
+                    # overlaps the previous page
+                    continue
+
+                if held:
+                    held.setdefault('prevInTime', number)
+                    yield held['messageId'], held
+                    held = None
+
+                if number < first_message:
+                    finished = True
+                    break
+
+                yield from yield_gap(number)
+                # the entry itself is yielded once the next entry is known
+                expected = number - 1
+
+                entry.setdefault('nextInTime', held['messageId'] if held else newer)
+                held = entry
+                newer = number
+
+            start = entries[-1]['messageId'] - 1
+            if start < 1:
+                break
+
+        if held:
+            held.setdefault('prevInTime', 0)
+            yield held['messageId'], held
+        yield from yield_gap(first_message - 1)
+
+    def get_message_from_listing(self, entry):
+        """Get the data for the message of the given listing entry, as `get_message` does, but
+        only fetching the raw email. The 'messageBody' is rendered from the raw email. If that
+        can't be done properly, falls back to `get_message` to get Yahoo's rendering."""
+        if not self.rate_limiter:
+            # delay to prevent rate limiting
+            time.sleep(max(0, random.gauss(self.delay, self.delay / 2)))
+        message_number = entry['messageId']
+
+        raw = self._load_api_json(self._api_url("messages/%s/raw" % (message_number,)))
+        if 'ygError' in raw:
+            if raw['ygError']['httpStatus'] == 404:
+                return None
+            raise RuntimeError("Unexpected error:\n\n%s" % json.dumps(raw))
+
+        data = {key: val for key, val in entry.items() if key != 'messageId'}
+        data.update(raw['ygData'])
+        data['msgId'] = message_number
+
+        try:
+            data['messageBody'] = message.html_from_yahoo_raw_email(data['rawEmail'])
+        except Exception:
+            return self.get_message(message_number)
+        if 'Attachment content not displayed' in data['messageBody']:
+            return self.get_message(message_number)
+
+        try:
+            return self._massage_message(data)
+        except:
+            import pprint
+            eprint("Failed to process message:\n%s" % (pprint.pformat(data)))
+            raise
+
     def open_tab(self):
+        from selenium.webdriver.common.keys import Keys
         if platform.system() == 'Darwin':
             key_sequence = Keys.COMMAND + 't'
         else:
@@ -206,6 +482,7 @@ class YahooBackupScraper:
         time.sleep(1)
 
     def close_tab(self):
+        from selenium.webdriver.common.keys import Keys
         if platform.system() == 'Darwin':
             key_sequence = Keys.COMMAND + 'w'
         else:
@@ -214,41 +491,55 @@ class YahooBackupScraper:
         self.br.driver.find_element_by_tag_name('body').send_keys(key_sequence)
         time.sleep(1)
 
-    def yield_walk_files(self, path="."):
-        """Starting from `path`, yield a dict describing each file, and recurse into subdirectories."""
-        url = "https://groups.yahoo.com/neo/groups/%s/files/%s/" % (self.group_name, path)
-
-        self._visit_with_login(url)
+    def list_directory(self, path="."):
+        """Return `(files, dirs)` for the given directory of the Files section. `files` is a list
+        of dicts describing each file, and `dirs` a list of dicts describing each subdirectory, with
+        its 'filePath' and a 'signature' which changes whenever the listed date or size does."""
+        from selenium.common.exceptions import NoSuchElementException
+        self._visit_with_login(self._files_url(path))
 
-        # get all data-file attributes - these are the file entries
-        data_files = []
-        data_dirs = []
+        files = []
+        dirs = []
 
+        # all data-file attributes are the file entries
         for el in self.br.find_by_xpath("//*[@data-file]"):
             data = json.loads('{' + el['data-file'].encode('utf8').decode('unicode_escape') + '}')
             if data['fileType'] == 'd':
-                data_dirs.append(data)
+                try:
+                    date_str = el._element.find_element_by_class_name('yg-list-date').text
+                except NoSuchElementException:
+                    date_str = None
+
+                dirs.append({
+                    'filePath': data['filePath'],
+                    'signature': {'data': data, 'date': date_str},
+                })
             elif data['fileType'] == 'f':
-                data_files.append(data)
+                url = el.find_by_tag('a')[0]._element.get_attribute('href')
+                profile = el._element.find_element_by_class_name('yg-list-auth').text
+                date_str = el._element.find_element_by_class_name('yg-list-date').text
+                the_date = dateutil.parser.parse(date_str)
+
+                files.append({
+                    'filePath': urllib.parse.unquote(data['filePath']),
+                    'url': url,
+                    'mime': data['mime'],
+                    'size': float(data['size']),
+                    'profile': profile,
+                    'date': the_date,
+                })
             else:
                 raise NotImplementedError("Unknown fileType %s, data was %s" % (
                     data['fileType'], json.dumps(data),
                 ))
 
-        for data in data_files:
-            url = el.find_by_tag('a')[0]._element.get_attribute('href')
-            profile = el._element.find_element_by_class_name('yg-list-auth').text
-            date_str = el._element.find_element_by_class_name('yg-list-date').text
-            the_date = dateutil.parser.parse(date_str)
-
-            yield {
-                'filePath': urllib.parse.unquote(data['filePath']),
-                'url': url,
-                'mime': data['mime'],
-                'size': float(data['size']),
-                'profile': profile,
-                'date': the_date,
-            }
-
-        for data in data_dirs:
+        return files, dirs
+
+    def yield_walk_files(self, path="."):
+        """Starting from `path`, yield a dict describing each file, and recurse into subdirectories."""
+        files, dirs = self.list_directory(path)
+
+        yield from files
+
+        for data in dirs:
             yield from self.yield_walk_files(data['filePath'])
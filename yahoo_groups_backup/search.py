@@ -0,0 +1,41 @@
+import html
+import re
+
+from .message import unescape_yahoo_html
+
+# the fields of the search index, and how much the matches in each count in the ranking
+SEARCH_FIELDS = ('subject', 'author', 'body')
+FIELD_WEIGHTS = {'subject': 5, 'author': 3, 'body': 1}
+
+
+def text_from_html(html_string):
+    """Return the plain text of some HTML, e.g. a message body."""
+    text = re.sub(r'<br\s*/?>|</p>|</div>', '\n', html_string, flags=re.IGNORECASE)
+    text = re.sub(r'<[^>]+>', ' ', text)
+    return html.unescape(text)
+
+
+def search_doc(message_number, message):
+    """Return the search index document of the message: its subject, its author fields, and the
+    plain text of its body."""
+    return {
+        '_id': message_number,
+        'subject': unescape_yahoo_html(message.get('subject') or ''),
+        'author': ' '.join(message.get(field) for field in ('profile', 'authorName', 'from') if message.get(field)),
+        'body': text_from_html(message.get('messageBody') or ''),
+        'postDate': message.get('postDate'),
+    }
+
+
+def query_terms(query):
+    """Split a search query into its words and "quoted phrases"."""
+    return [phrase or word for phrase, word in re.findall(r'"([^"]*)"|(\S+)', query) if phrase or word]
+
+
+def make_snippet(text, terms, width=80):
+    """Return the part of the text around the first match of any of the terms."""
+    text = ' '.join(text.split())
+    positions = [m.start() for m in (re.search(re.escape(term), text, re.IGNORECASE) for term in terms) if m]
+    start = max(0, min(positions) - width // 4) if positions else 0
+    snippet = text[start:start + width]
+    return ('...' if start else '') + snippet + ('...' if start + width < len(text) else '')
@@ -0,0 +1,782 @@
+import atexit
+import hashlib
+import sqlite3
+import threading
+import time
+
+from .bitmap import IdBitmap
+from .compression import MessageDoc, compress_message, needs_compression
+from .docjson import dumps, loads
+from .message import content_hash, stored_content_hash
+from .stats import MessageStats, yield_missing_ranges
+from .search import FIELD_WEIGHTS, SEARCH_FIELDS, make_snippet, query_terms, search_doc
+from .threads import build_threads, merge_threads, topic_links
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    next_in_time INTEGER,
+    has_body INTEGER NOT NULL,
+    doc TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    doc TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS threads (
+    id INTEGER PRIMARY KEY,
+    doc TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS thread_links (
+    linked_id INTEGER PRIMARY KEY,
+    thread_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS render_cache (
+    key TEXT PRIMARY KEY,
+    html BLOB NOT NULL,
+    failed INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size REAL,
+    date TEXT,
+    content_hash TEXT,
+    doc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_size_date ON files (size, date);
+CREATE TABLE IF NOT EXISTS file_listings (
+    path TEXT PRIMARY KEY,
+    doc TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    id INTEGER PRIMARY KEY,
+    content_hash TEXT UNIQUE,
+    length INTEGER
+);
+CREATE TABLE IF NOT EXISTS blob_chunks (
+    blob_id INTEGER NOT NULL,
+    n INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (blob_id, n)
+);
+"""
+
+
+class SQLiteBackupDB:
+    """Embedded alternative to `YahooBackupDB`, storing everything in one SQLite file in WAL mode,
+    with the same interface. Useful to work on an archive without running a MongoDB server.
+
+    Messages, file entries and directory listings are stored as JSON documents, the same as the
+    documents of the corresponding MongoDB collections, with the fields needed for queries copied
+    into columns. File data is stored once per content hash, in chunks.
+
+    Writes are committed right away, unless `buffer_writes` was called, in which case they are
+    grouped into transactions."""
+
+    # messages to fetch per query when iterating over them
+    batch_size = 500
+
+    def __init__(self, path, group_name):
+        self.group_name = group_name
+        self.path = path
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        try:
+            self.conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(%s, post_date UNINDEXED)" % (
+                    ", ".join(SEARCH_FIELDS),))
+            self.has_search_index = True
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5
+            self.has_search_index = False
+        self.conn.commit()
+
+        # the connection is shared between threads, e.g. the file download workers
+        self._lock = threading.RLock()
+
+        self._buffering = False
+        self._max_ops = 1
+        self._max_bytes = 0
+        self._max_delay = 0
+        self._pending_ops = 0
+        self._pending_bytes = 0
+        self._oldest = None
+        self._num_ops = 0
+        self._num_commits = 0
+
+        self._threads_checked = False
+
+    # -- Transactions
+
+    def buffer_writes(self, max_ops=100, max_bytes=4 * 1024 * 1024, max_delay=5):
+        """Group the writes into transactions, committed once `max_ops` writes or `max_bytes` of
+        documents are pending, or the oldest pending write is `max_delay` seconds old."""
+        self._buffering = True
+        self._max_ops = max_ops
+        self._max_bytes = max_bytes
+        self._max_delay = max_delay
+        atexit.register(self.flush)
+
+    def _wrote(self, size=0):
+        """Note a write, committing if it's time to."""
+        if self._pending_ops == 0:
+            self._oldest = time.monotonic()
+        self._pending_ops += 1
+        self._pending_bytes += size
+
+        if (not self._buffering or self._pending_ops >= self._max_ops or
+                self._pending_bytes >= self._max_bytes or
+                time.monotonic() - self._oldest >= self._max_delay):
+            self.flush()
+
+    def flush(self):
+        """Commit any pending writes."""
+        with self._lock:
+            if not self._pending_ops:
+                return
+            self.conn.commit()
+            self._num_ops += self._pending_ops
+            self._num_commits += 1
+            self._pending_ops = 0
+            self._pending_bytes = 0
+            self._oldest = None
+
+    def close(self):
+        """Commit any pending writes, and stop buffering them."""
+        self.flush()
+        if self._buffering:
+            atexit.unregister(self.flush)
+            self._buffering = False
+
+    def _begin(self):
+        """Start a write transaction, unless one is open already, so that other processes can't
+        change what is read in it before it is written back."""
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN IMMEDIATE")
+
+    def num_coalesced_writes(self):
+        """Return how many writes were committed as part of a transaction, rather than on their own."""
+        return self._num_ops - self._num_commits
+
+    # -- Messages
+
+    def yield_stored_messages(self, batch_size=1000):
+        """Yield all the message documents as they are stored, i.e. with their fields compressed,
+        including the missing messages, in message_id order."""
+        start = 0
+        while True:
+            with self._lock:
+                rows = self.conn.execute(
+                    "SELECT id, doc FROM messages WHERE id >= ? ORDER BY id LIMIT ?", (start, batch_size)).fetchall()
+            if not rows:
+                return
+
+            for _, doc in rows:
+                yield loads(doc)
+            start = rows[-1][0] + 1
+
+    def import_messages(self, docs):
+        """Store the message documents, as yielded by `yield_stored_messages`, replacing any stored
+        ones, in one transaction. Call `rebuild_message_stats` and `rebuild_threads` once done
+        importing."""
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO messages (id, next_in_time, has_body, doc) VALUES (?, ?, ?, ?)",
+                [(doc['_id'], doc.get('nextInTime'), bool(doc.get('messageBody')), dumps(doc)) for doc in docs])
+            self.conn.commit()
+
+    def import_file_entries(self, entries):
+        """Store the file entries, as yielded by `yield_all_files`, replacing any stored ones, in one
+        transaction."""
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO files (path, size, date, content_hash, doc) VALUES (?, ?, ?, ?, ?)",
+                [(entry['_id'], entry.get('size'), dumps(entry.get('date')), entry.get('contentHash'), dumps(entry))
+                 for entry in entries])
+            self.conn.commit()
+
+    def has_updated_message(self, message_number):
+        """Return whether we already have the given message number loaded and fully updated."""
+        with self._lock:
+            row = self.conn.execute("SELECT next_in_time FROM messages WHERE id = ?", (message_number,)).fetchone()
+        # maybe need to update the 'next' link
+        return row is not None and row[0] != 0
+
+    def updated_message_ids(self, start=None, end=None):
+        """Return an `IdBitmap` of the numbers of all the messages for which `has_updated_message`
+        would return True. Optionally only considers the message numbers in [`start`, `end`)."""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT id FROM messages WHERE (next_in_time IS NULL OR next_in_time != 0) AND id >= ? AND id < ?",
+                (start or 0, end or 9999999999)).fetchall()
+        return IdBitmap(row[0] for row in rows)
+
+    def upsert_message(self, message_number, message_obj):
+        """Insert the message document, for the given message number. If the message is already stored, will
+        update it. For a missing message, pass `None` for `message_obj`."""
+        with self._lock:
+            # the stats are updated in the same transaction as the message
+            self._begin()
+            stats = self._stored_message_stats()
+            if not message_obj:
+                inserted = self.conn.execute(
+                    "INSERT OR IGNORE INTO messages (id, next_in_time, has_body, doc) VALUES (?, NULL, 0, ?)",
+                    (message_number, dumps({'_id': message_number}))).rowcount
+                if inserted:
+                    stats.add(message_number, False)
+                    self._save_message_stats(stats)
+                self._wrote()
+                return
+
+            assert message_number == message_obj['msgId']
+
+            stored = self._get_stored_message(message_number)
+            stats.add(message_number, bool(message_obj.get('messageBody')), message_obj.get('postDate'),
+                      was_present=stored is not None, had_body=bool(stored and stored.get('messageBody')))
+            self._save_message_stats(stats)
+
+            doc = stored or {}
+            doc.update(compress_message(message_obj))
+            doc['_id'] = message_number
+            del doc['msgId']
+            doc['contentHash'] = content_hash(message_obj)
+
+            data = dumps(doc)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO messages (id, next_in_time, has_body, doc) VALUES (?, ?, ?, ?)",
+                (message_number, doc.get('nextInTime'), bool(doc.get('messageBody')), data))
+            if message_obj.get('messageBody') and not self._build_missing_threads():
+                self._add_to_thread(
+                    topic_links(message_number, message_obj.get('prevInTopic'), message_obj.get('nextInTopic')),
+                    message_obj.get('postDate'))
+            self._index_messages([search_doc(message_number, message_obj)])
+            self._wrote(len(data))
+
+    def _index_messages(self, search_docs):
+        """Add the `search.search_doc`s to the full-text index, replacing any already there."""
+        if not self.has_search_index:
+            return
+        self.conn.executemany("DELETE FROM search_index WHERE rowid = ?", [(doc['_id'],) for doc in search_docs])
+        self.conn.executemany(
+            "INSERT INTO search_index (rowid, %s, post_date) VALUES (?, %s, ?)" % (
+                ", ".join(SEARCH_FIELDS), ", ".join("?" * len(SEARCH_FIELDS))),
+            [[doc['_id']] + [doc[field] for field in SEARCH_FIELDS] + [doc['postDate']] for doc in search_docs])
+
+    def rebuild_search_index(self, batch_size=500):
+        """Rebuild the full-text index from all the messages. Returns the number of messages indexed."""
+        self._check_search_index()
+        with self._lock:
+            self.conn.execute("DELETE FROM search_index")
+
+        num_indexed = 0
+        batch = []
+        fields = ('subject', 'profile', 'authorName', 'from', 'messageBody', 'postDate')
+        for message in self.yield_all_messages(fields=fields, batch_size=batch_size):
+            batch.append(search_doc(message['_id'], message))
+            if len(batch) >= batch_size:
+                with self._lock:
+                    self._index_messages(batch)
+                num_indexed += len(batch)
+                batch = []
+        with self._lock:
+            self._index_messages(batch)
+            self.conn.commit()
+        return num_indexed + len(batch)
+
+    def _check_search_index(self):
+        if not self.has_search_index:
+            raise RuntimeError("Full-text search needs SQLite built with FTS5")
+
+    def search_index_size(self):
+        """Return the number of messages in the full-text index."""
+        self._check_search_index()
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM search_index").fetchone()[0]
+
+    def search_messages(self, query, page=1, page_size=20):
+        """Search the messages for the words and "quoted phrases" of the query, returning
+        `(num_results, results)` for the given page of the results, best matches first. Each result
+        has the `_id`, `subject`, `author` and `postDate` of the message, its `score`, and a
+        `snippet` of the body."""
+        self._check_search_index()
+        terms = query_terms(query)
+        if not terms:
+            return 0, []
+        # quote everything, so the query can't be taken as FTS5 syntax
+        match = " OR ".join('"%s"' % term.replace('"', '""') for term in terms)
+        # bm25 scores are lower for better matches
+        rank = "bm25(search_index, %s)" % ", ".join("%s" % FIELD_WEIGHTS[field] for field in SEARCH_FIELDS)
+
+        with self._lock:
+            num_results = self.conn.execute(
+                "SELECT COUNT(*) FROM search_index WHERE search_index MATCH ?", (match,)).fetchone()[0]
+            rows = self.conn.execute(
+                "SELECT rowid, subject, author, body, post_date, -%s FROM search_index WHERE search_index MATCH ? "
+                "ORDER BY %s LIMIT ? OFFSET ?" % (rank, rank),
+                (match, page_size, (page - 1) * page_size)).fetchall()
+
+        return num_results, [{
+            '_id': message_number,
+            'subject': subject,
+            'author': author,
+            'postDate': post_date,
+            'score': score,
+            'snippet': make_snippet(body, terms),
+        } for message_number, subject, author, body, post_date, score in rows]
+
+    def _add_to_thread(self, links, post_date):
+        """Add the message with the given `topic_links` to its thread, merging the threads it links
+        together."""
+        thread_ids = [row[0] for row in self.conn.execute(
+            "SELECT DISTINCT thread_id FROM thread_links WHERE linked_id IN (%s)" % ", ".join("?" * len(links)),
+            links)]
+        threads = [loads(row[0]) for row in self.conn.execute(
+            "SELECT doc FROM threads WHERE id IN (%s)" % ", ".join("?" * len(thread_ids)), thread_ids)]
+
+        thread = merge_threads(threads, links, post_date)
+        self.conn.executemany("DELETE FROM threads WHERE id = ?", [(thread_id,) for thread_id in thread_ids])
+        self._insert_thread(thread)
+
+    def _insert_thread(self, thread):
+        self.conn.execute("INSERT OR REPLACE INTO threads (id, doc) VALUES (?, ?)", (thread['_id'], dumps(thread)))
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO thread_links (linked_id, thread_id) VALUES (?, ?)",
+            [(linked_id, thread['_id']) for linked_id in thread['linkedIds']])
+
+    def rebuild_threads(self):
+        """Rebuild all the threads from the topic links of all the messages, in one scan."""
+        with self._lock:
+            self._rebuild_threads()
+            self.conn.commit()
+
+    def _rebuild_threads(self):
+        rows = self.conn.execute(
+            "SELECT id, json_extract(doc, '$.prevInTopic'), json_extract(doc, '$.nextInTopic'), "
+            "json_extract(doc, '$.postDate') FROM messages WHERE has_body ORDER BY id")
+        threads = list(build_threads(rows))
+
+        self.conn.execute("DELETE FROM threads")
+        self.conn.execute("DELETE FROM thread_links")
+        for thread in threads:
+            self._insert_thread(thread)
+
+    def _build_missing_threads(self):
+        """Build the threads from all the messages if there are messages but no threads, e.g. in a
+        backup made before threads were introduced. Only checked once. Returns whether they were
+        built."""
+        with self._lock:
+            if self._threads_checked:
+                return False
+            self._threads_checked = True
+
+            if (self.conn.execute("SELECT 1 FROM threads LIMIT 1").fetchone() or
+                    not self.conn.execute("SELECT 1 FROM messages WHERE has_body LIMIT 1").fetchone()):
+                return False
+            self._begin()
+            self._rebuild_threads()
+            return True
+
+    def get_thread(self, message_number):
+        """Return the thread document of the thread the given message is in, or None."""
+        if self._build_missing_threads():
+            self._wrote()
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT threads.doc FROM thread_links JOIN threads ON threads.id = thread_links.thread_id "
+                "WHERE thread_links.linked_id = ?", (message_number,)).fetchone()
+        thread = loads(row[0]) if row else None
+        if thread and message_number in thread['members']:
+            return thread
+        return None
+
+    def yield_all_threads(self):
+        """Yield all the thread documents, in order of their first message."""
+        if self._build_missing_threads():
+            self._wrote()
+        start = 0
+        while True:
+            with self._lock:
+                rows = self.conn.execute(
+                    "SELECT id, doc FROM threads WHERE id >= ? ORDER BY id LIMIT ?",
+                    (start, self.batch_size)).fetchall()
+            if not rows:
+                return
+
+            for _, doc in rows:
+                yield loads(doc)
+            start = rows[-1][0] + 1
+
+    def _get_stored_message(self, message_number):
+        with self._lock:
+            row = self.conn.execute("SELECT doc FROM messages WHERE id = ?", (message_number,)).fetchone()
+        return loads(row[0]) if row else None
+
+    def get_message(self, message_number):
+        """Return the message document of the given message number, or None if we don't have it."""
+        doc = self._get_stored_message(message_number)
+        return MessageDoc(doc) if doc else None
+
+    def yield_all_messages(self, start=None, end=None, fields=None, batch_size=None):
+        """Yield all existing messages (skipping missing ones), in reverse message_id order. If
+        `fields` is given, the documents only have those fields (and `_id`), extracted from the
+        stored JSON by SQLite; fields which are null or missing are left out. `batch_size` sets
+        how many documents are fetched per query."""
+        if fields:
+            # json_patch drops the null values, i.e. the missing fields
+            select_doc = "json_patch('{}', json_object(%s))" % ", ".join(
+                ["?, json_extract(doc, ?)"] * len(fields))
+            field_params = [param for field in fields for param in (field, '$."%s"' % field)]
+        else:
+            select_doc = "doc"
+            field_params = []
+
+        end = end or 9999999999
+        while True:
+            with self._lock:
+                rows = self.conn.execute(
+                    "SELECT id, %s FROM messages WHERE has_body AND id >= ? AND id < ? ORDER BY id DESC LIMIT ?" % (
+                        select_doc,),
+                    field_params + [start or 0, end, batch_size or self.batch_size]).fetchall()
+            if not rows:
+                return
+
+            for message_number, data in rows:
+                doc = loads(data)
+                doc['_id'] = message_number
+                yield MessageDoc(doc)
+            end = rows[-1][0]
+
+    def compress_stored_messages(self, batch_size=500):
+        """Compress the fields of the stored messages which aren't compressed yet, and add the
+        'contentHash' of those which don't have one, one transaction per batch. Yields the number
+        of messages updated so far after each batch."""
+        num_compressed = 0
+        start = 0
+        while True:
+            with self._lock:
+                rows = self.conn.execute(
+                    "SELECT id, doc FROM messages WHERE id >= ? ORDER BY id LIMIT ?",
+                    (start, batch_size)).fetchall()
+                if not rows:
+                    return
+
+                updates = []
+                for message_number, data in rows:
+                    doc = loads(data)
+                    needs_hash = 'rawEmail' in doc and 'contentHash' not in doc
+                    if not needs_hash and not needs_compression(doc):
+                        continue
+                    if needs_hash:
+                        doc['contentHash'] = stored_content_hash(doc)
+                    updates.append((dumps(compress_message(doc)), message_number))
+                self.conn.executemany("UPDATE messages SET doc = ? WHERE id = ?", updates)
+                self.conn.commit()
+
+            start = rows[-1][0] + 1
+            if updates:
+                num_compressed += len(updates)
+                yield num_compressed
+
+    def _compute_message_stats(self):
+        rows = self.conn.execute(
+            "SELECT id, has_body, CASE WHEN has_body THEN json_extract(doc, '$.postDate') END "
+            "FROM messages ORDER BY id")
+        return MessageStats.from_messages(rows)
+
+    def _stored_message_stats(self):
+        """Return the stored `MessageStats`, or compute them if they were never stored."""
+        row = self.conn.execute("SELECT doc FROM stats WHERE name = 'messages'").fetchone()
+        return MessageStats(loads(row[0])) if row else self._compute_message_stats()
+
+    def _save_message_stats(self, stats):
+        self.conn.execute("INSERT OR REPLACE INTO stats (name, doc) VALUES ('messages', ?)",
+                          (dumps(stats.to_doc()),))
+
+    def rebuild_message_stats(self):
+        """Recompute the message stats from all the stored messages, with one scan of the ids."""
+        with self._lock:
+            self._begin()
+            self._save_message_stats(self._compute_message_stats())
+            self.conn.commit()
+
+    def message_stats(self):
+        """Return the `MessageStats` of the stored messages, computing and storing them if they were
+        never stored, e.g. in a backup made before they were introduced."""
+        with self._lock:
+            row = self.conn.execute("SELECT doc FROM stats WHERE name = 'messages'").fetchone()
+            if row:
+                return MessageStats(loads(row[0]))
+
+            self._begin()
+            stats = self._stored_message_stats()
+            self._save_message_stats(stats)
+            self._wrote()
+            return stats
+
+    def num_messages(self):
+        """Return the number of non-empty messages in the database."""
+        return self.message_stats().num_messages
+
+    def get_latest_message(self):
+        """Return the latest message, or None if there are no messages."""
+        latest_id = self.message_stats().latest_id
+        return self.get_message(latest_id) if latest_id else None
+
+    def missing_message_ranges(self):
+        """Return `(start, end)` (both inclusive) for each range of message ids up to the latest
+        message which we don't have, from the stats."""
+        stats = self.message_stats()
+        return stats.missing_ranges_up_to(stats.latest_id)
+
+    def yield_missing_message_ranges(self):
+        """Same as `missing_message_ranges`, but computed from a scan of the message ids rather than
+        taken from the stats."""
+        latest_id = self.message_stats().latest_id
+        return yield_missing_ranges(self._yield_message_ids(latest_id), latest_id)
+
+    def _yield_message_ids(self, last_id):
+        """Yield the ids of all stored messages up to `last_id`, in ascending order, a batch at a time."""
+        start = 0
+        while True:
+            with self._lock:
+                rows = self.conn.execute(
+                    "SELECT id FROM messages WHERE id >= ? AND id <= ? ORDER BY id LIMIT ?",
+                    (start, last_id, self.batch_size)).fetchall()
+            if not rows:
+                return
+
+            for row in rows:
+                yield row[0]
+            start = rows[-1][0] + 1
+
+    def missing_message_ids(self):
+        """Return the set of the ids of all missing messages."""
+        return set(n for start, end in self.missing_message_ranges() for n in range(start, end + 1))
+
+    def get_rendered_messages(self, keys):
+        """Return a dict of `render_key: (compressed_html, failed)` for those of the given keys which
+        are in the render cache."""
+        keys = list(keys)
+        result = {}
+        with self._lock:
+            # stay under SQLite's limit on the number of query parameters
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                for key, html, failed in self.conn.execute(
+                        "SELECT key, html, failed FROM render_cache WHERE key IN (%s)" % ", ".join("?" * len(batch)),
+                        batch):
+                    result[key] = (html, bool(failed))
+        return result
+
+    def put_rendered_messages(self, entries):
+        """Store the `render_key: (compressed_html, failed)` entries into the render cache."""
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO render_cache (key, html, failed) VALUES (?, ?, ?)",
+                [(key, html, failed) for key, (html, failed) in entries.items()])
+            self._wrote()
+
+    # -- File operations
+
+    def has_file_entry(self, filePath):
+        with self._lock:
+            return self.conn.execute("SELECT 1 FROM files WHERE path = ?", (filePath,)).fetchone() is not None
+
+    def has_file_data(self, filePath):
+        with self._lock:
+            row = self.conn.execute("SELECT content_hash FROM files WHERE path = ?", (filePath,)).fetchone()
+        return bool(row and row[0] and self.has_blob(row[0]))
+
+    def has_blob(self, content_hash):
+        """Return whether we have the file data with the given content hash."""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT 1 FROM blobs WHERE content_hash = ?", (content_hash,)).fetchone() is not None
+
+    def find_blob_for_listing(self, file_entry):
+        """Return the content hash of the data of a file we already have with the same name, type,
+        size and date as the given file entry, or None."""
+        name = file_entry['filePath'].rsplit('/', 1)[-1]
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT files.path, files.doc, files.content_hash FROM files "
+                "JOIN blobs ON blobs.content_hash = files.content_hash "
+                "WHERE files.size = ? AND files.date = ?",
+                (file_entry['size'], dumps(file_entry['date']))).fetchall()
+        for path, doc, content_hash in rows:
+            if path.rsplit('/', 1)[-1] == name and loads(doc).get('mime') == file_entry['mime']:
+                return content_hash
+        return None
+
+    def set_file_content_hash(self, file_path, content_hash):
+        """Point the file entry at the data with the given content hash."""
+        with self._lock:
+            row = self.conn.execute("SELECT doc FROM files WHERE path = ?", (file_path,)).fetchone()
+            if not row:
+                return
+            doc = loads(row[0])
+            doc['contentHash'] = content_hash
+            self.conn.execute("UPDATE files SET content_hash = ?, doc = ? WHERE path = ?",
+                              (content_hash, dumps(doc), file_path))
+            self._wrote()
+
+    def upsert_file_entry(self, file_entry):
+        with self._lock:
+            row = self.conn.execute("SELECT doc FROM files WHERE path = ?", (file_entry['filePath'],)).fetchone()
+            doc = loads(row[0]) if row else {}
+            doc.update(file_entry)
+            doc['_id'] = file_entry['filePath']
+            del doc['filePath']
+
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (path, size, date, content_hash, doc) VALUES (?, ?, ?, ?, ?)",
+                (doc['_id'], doc.get('size'), dumps(doc.get('date')), doc.get('contentHash'), dumps(doc)))
+            self._wrote()
+
+    def update_file_data(self, file_path, data):
+        f = self.open_file_data(file_path)
+        f.write(data)
+        f.close()
+
+    def get_file_listing(self, dir_path):
+        """Return the cached listing of the given directory, or None."""
+        with self._lock:
+            row = self.conn.execute("SELECT doc FROM file_listings WHERE path = ?", (dir_path,)).fetchone()
+        return loads(row[0]) if row else None
+
+    def upsert_file_listing(self, dir_path, signature, files, dirs):
+        """Cache the listing of the given directory."""
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO file_listings (path, doc) VALUES (?, ?)",
+                (dir_path, dumps({'_id': dir_path, 'signature': signature, 'files': files, 'dirs': dirs})))
+            self._wrote()
+
+    def open_file_data(self, file_path):
+        """Return a `SQLiteBlobWriter` to write the data of the given file with, replacing any
+        existing data once it is closed."""
+        return SQLiteBlobWriter(self, file_path)
+
+    def open_blob_data(self):
+        """Return a `SQLiteBlobWriter` to store some file data with, without any file entry."""
+        return SQLiteBlobWriter(self, None)
+
+    def get_file_data(self, entry):
+        """Return a `SQLiteBlobReader` with the data of the given file entry, or None if we don't
+        have it."""
+        if not entry.get('contentHash'):
+            return None
+
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT id, length FROM blobs WHERE content_hash = ?", (entry['contentHash'],)).fetchone()
+        if not row:
+            return None
+        return SQLiteBlobReader(self, row[0], row[1])
+
+    def yield_all_files(self, batch_size=500):
+        """Yield all (file_entry, blob_reader) for all files in the database, with None for the files
+        we have no data for. Each batch of entries is queried along with their data's blob ids."""
+        last_path = ''
+        while True:
+            with self._lock:
+                rows = self.conn.execute(
+                    "SELECT files.path, files.doc, blobs.id, blobs.length FROM files "
+                    "LEFT JOIN blobs ON blobs.content_hash = files.content_hash "
+                    "WHERE files.path > ? ORDER BY files.path LIMIT ?", (last_path, batch_size)).fetchall()
+            if not rows:
+                return
+
+            for _, doc, blob_id, length in rows:
+                yield loads(doc), SQLiteBlobReader(self, blob_id, length) if blob_id is not None else None
+            last_path = rows[-1][0]
+
+
+class SQLiteBlobWriter:
+    """Write the data of a file into a `SQLiteBackupDB`, in chunks of `chunk_size` bytes. Same as
+    `backup_db.FileDataWriter`: the data is hashed as it is written, only kept if there is no data
+    with the same hash yet, and the file entry, if any, is pointed at the hash once closed."""
+
+    chunk_size = 255 * 1024
+
+    def __init__(self, backup_db, file_path):
+        self.backup_db = backup_db
+        self.file_path = file_path
+
+        self.content_hash = None
+
+        self._hash = hashlib.sha256()
+        self._buffer = bytearray()
+        self._n = 0
+        self._length = 0
+
+        with backup_db._lock:
+            self._blob_id = backup_db.conn.execute("INSERT INTO blobs (content_hash) VALUES (NULL)").lastrowid
+            backup_db._wrote()
+
+    def _write_chunk(self, chunk):
+        with self.backup_db._lock:
+            self.backup_db.conn.execute(
+                "INSERT INTO blob_chunks (blob_id, n, data) VALUES (?, ?, ?)", (self._blob_id, self._n, chunk))
+            self.backup_db._wrote(len(chunk))
+        self._n += 1
+
+    def write(self, data):
+        self._hash.update(data)
+        self._length += len(data)
+        self._buffer += data
+        while len(self._buffer) >= self.chunk_size:
+            self._write_chunk(bytes(self._buffer[:self.chunk_size]))
+            del self._buffer[:self.chunk_size]
+
+    def abort(self):
+        with self.backup_db._lock:
+            self.backup_db.conn.execute("DELETE FROM blob_chunks WHERE blob_id = ?", (self._blob_id,))
+            self.backup_db.conn.execute("DELETE FROM blobs WHERE id = ?", (self._blob_id,))
+            self.backup_db._wrote()
+
+    def close(self):
+        if self._buffer:
+            self._write_chunk(bytes(self._buffer))
+            self._buffer = bytearray()
+
+        content_hash = self.content_hash = self._hash.hexdigest()
+        with self.backup_db._lock:
+            if self.backup_db.has_blob(content_hash):
+                self.abort()
+            else:
+                self.backup_db.conn.execute(
+                    "UPDATE blobs SET content_hash = ?, length = ? WHERE id = ?",
+                    (content_hash, self._length, self._blob_id))
+                self.backup_db._wrote()
+
+            if self.file_path is not None:
+                self.backup_db.set_file_content_hash(self.file_path, content_hash)
+
+
+class SQLiteBlobReader:
+    """Read-only file-like view of some file data in a `SQLiteBackupDB`. Iterating over it yields
+    the data in chunks, as iterating over a GridFS file does."""
+
+    def __init__(self, backup_db, blob_id, length):
+        self.backup_db = backup_db
+        self.blob_id = blob_id
+        self.length = length
+
+    def __iter__(self):
+        n = 0
+        while True:
+            with self.backup_db._lock:
+                row = self.backup_db.conn.execute(
+                    "SELECT data FROM blob_chunks WHERE blob_id = ? AND n = ?", (self.blob_id, n)).fetchone()
+            if row is None:
+                return
+            yield row[0]
+            n += 1
+
+    def read(self):
+        return b''.join(self)
@@ -0,0 +1,106 @@
+import bisect
+
+
+def yield_missing_ranges(sorted_ids, last_id):
+    """Given an iterable of ascending message ids, yield `(start, end)` for each range of ids from 1
+    to `last_id` (both inclusive) which aren't in it. Only looks at one id at a time, so it works on
+    a database cursor of any size."""
+    expected = 1
+    for id_ in sorted_ids:
+        if id_ > last_id:
+            break
+        if id_ > expected:
+            yield expected, id_ - 1
+        expected = max(expected, id_ + 1)
+
+    if expected <= last_id:
+        yield expected, last_id
+
+
+class MessageStats:
+    """Summary of the stored messages of a group, kept up to date as messages are stored, so it
+    doesn't have to be computed from all the messages whenever it's needed. Stored as a document:
+        * 'maxId' - the highest message id stored, including missing messages
+        * 'latestId' - the highest id of a message with a body, i.e. not missing
+        * 'latestPostDate' - the 'postDate' of that message
+        * 'numMessages' - the number of messages with a body
+        * 'missingRanges' - list of `[start, end]` (both inclusive) ranges of ids, up to 'maxId',
+          for which nothing is stored
+        * 'version' - incremented on every update, to detect concurrent updates
+    """
+
+    def __init__(self, doc=None):
+        doc = doc or {}
+        self.max_id = doc.get('maxId', 0)
+        self.latest_id = doc.get('latestId', 0)
+        self.latest_post_date = doc.get('latestPostDate')
+        self.num_messages = doc.get('numMessages', 0)
+        self.missing_ranges = [list(r) for r in doc.get('missingRanges', [])]
+        self.version = doc.get('version', 0)
+
+    def to_doc(self):
+        return {
+            'maxId': self.max_id,
+            'latestId': self.latest_id,
+            'latestPostDate': self.latest_post_date,
+            'numMessages': self.num_messages,
+            'missingRanges': self.missing_ranges,
+            'version': self.version,
+        }
+
+    @classmethod
+    def from_messages(cls, rows):
+        """Compute the stats from `(message_id, has_body, post_date)` for each stored message, in
+        ascending id order."""
+        stats = cls()
+
+        def yield_ids():
+            for message_id, has_body, post_date in rows:
+                if has_body:
+                    stats.num_messages += 1
+                    stats.latest_id = message_id
+                    stats.latest_post_date = post_date
+                stats.max_id = message_id
+                yield message_id
+
+        stats.missing_ranges = [list(r) for r in yield_missing_ranges(yield_ids(), float('inf'))
+                                if r[1] != float('inf')]
+        return stats
+
+    def _remove_missing(self, message_id):
+        """Remove the id from the missing ranges, splitting the range it's in if needed."""
+        i = bisect.bisect_right(self.missing_ranges, [message_id, float('inf')]) - 1
+        if i < 0:
+            return
+        start, end = self.missing_ranges[i]
+        if not start <= message_id <= end:
+            return
+
+        replacement = []
+        if start < message_id:
+            replacement.append([start, message_id - 1])
+        if message_id < end:
+            replacement.append([message_id + 1, end])
+        self.missing_ranges[i:i + 1] = replacement
+
+    def add(self, message_id, has_body, post_date=None, was_present=False, had_body=False):
+        """Update the stats for a message being stored. `was_present` and `had_body` tell what was
+        stored for the message before."""
+        if not was_present:
+            if message_id > self.max_id:
+                if message_id > self.max_id + 1:
+                    self.missing_ranges.append([self.max_id + 1, message_id - 1])
+                self.max_id = message_id
+            else:
+                self._remove_missing(message_id)
+
+        if has_body:
+            if not had_body:
+                self.num_messages += 1
+            if message_id >= self.latest_id:
+                self.latest_id = message_id
+                self.latest_post_date = post_date
+
+    def missing_ranges_up_to(self, last_id):
+        """Return the missing ranges, cut off at `last_id`."""
+        return [(start, min(end, last_id)) for start, end in self.missing_ranges if start <= last_id]
@@ -0,0 +1,15 @@
+import os.path as P
+
+
+def open_backup_db(arguments, group_name):
+    """Open the backup database of the given group, with the backend chosen by the `--backend`
+    setting: a MongoDB server (`YahooBackupDB`), or an embedded SQLite file per group, in the
+    `--sqlite-dir` directory (`SQLiteBackupDB`)."""
+    if arguments['--backend'] == 'sqlite':
+        from .sqlite_db import SQLiteBackupDB
+        return SQLiteBackupDB(P.join(arguments['--sqlite-dir'], '%s.sqlite3' % group_name), group_name)
+
+    import pymongo
+    from .backup_db import YahooBackupDB
+    cli = pymongo.MongoClient(arguments['--mongo-host'], arguments['--mongo-port'])
+    return YahooBackupDB(cli, group_name)
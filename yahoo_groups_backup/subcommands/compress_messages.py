@@ -0,0 +1,36 @@
+"""
+Usage:
+  yahoo-groups-backup.py compress_messages [-h|--help] [options] <group_name>
+
+Options:
+  --batch-size=<n>         Number of messages to compress per database write.
+                           [default: 500]
+
+Help:
+  This compresses the raw email and the message body of all the stored
+  messages which are not compressed yet, and adds the content hash of those
+  which don't have one, e.g. in backups made before messages were stored
+  compressed and hashed. Without their hashes, `dump_site --incremental`
+  makes the pages of those messages again every time. It is safe to
+  interrupt and run again.
+"""
+import schema
+
+from yahoo_groups_backup.logging import eprint
+from yahoo_groups_backup.storage import open_backup_db
+
+
+args_schema = schema.Schema({
+    '--batch-size': schema.And(schema.Use(int), lambda n: n >= 1, error='Invalid batch size, must be integer >= 1'),
+    object: object,
+})
+
+
+def command(arguments):
+    db = open_backup_db(arguments, arguments['<group_name>'])
+
+    num_compressed = 0
+    for num_compressed in db.compress_stored_messages(batch_size=arguments['--batch-size']):
+        eprint("Updated %s messages..." % (num_compressed,))
+
+    eprint("Done, updated %s messages!" % (num_compressed,))
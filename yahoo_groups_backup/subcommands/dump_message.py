@@ -5,11 +5,11 @@ Usage:
 Help:
   This dumps the message of the particular id from the given group.
 """
-import pymongo
 import schema
 
-from yahoo_groups_backup import YahooBackupDB, html_from_message
 from yahoo_groups_backup.logging import eprint
+from yahoo_groups_backup.render_cache import RenderCache
+from yahoo_groups_backup.storage import open_backup_db
 
 
 args_schema = schema.Schema({
@@ -19,10 +19,11 @@ args_schema = schema.Schema({
 
 
 def command(arguments):
-    cli = pymongo.MongoClient(arguments['--mongo-host'], arguments['--mongo-port'])
-    ydb = YahooBackupDB(cli, arguments['<group_name>'])
+    ydb = open_backup_db(arguments, arguments['<group_name>'])
 
-    msg = ydb.db.messages.find_one({'_id': arguments['<message_id>']})
+    msg = ydb.get_message(arguments['<message_id>'])
+
+    body, _ = RenderCache(ydb).render(msg)
 
     fn = '#%d from %s.html' % (msg['_id'], msg['profile'])
 
@@ -38,5 +39,5 @@ def command(arguments):
 <div class="subject">%s</div>
 <div class="body">%s</div>
 
-</body>""" % (msg.get('subject', '(unknown)'), html_from_message(msg, True)))
+</body>""" % (msg.get('subject', '(unknown)'), body))
 
@@ -13,6 +13,17 @@ Options:
                                    [default: 0]
   --redactions=<file>              File to use for redactions, if exists.
                                    [default: redactions.yaml]
+  --render-workers=<n>             Number of processes rendering messages at the
+                                   same time, 0 for one per CPU core. By default
+                                   they're rendered by the main process alone.
+                                   [default: 1]
+  --file-workers=<n>               Number of group files to write at the same
+                                   time. [default: 4]
+  --no-render-cache                Render all the messages again, rather than
+                                   reusing the HTML rendered by previous runs.
+  --incremental                    Update the site in <root_dir> if it exists,
+                                   only writing the data files and group files
+                                   whose inputs changed since it was dumped.
   --code-only                      Whether to dump only the code and not
                                    the messages. If enabled, this only
                                    *copies* the template site *over* the
@@ -20,38 +31,49 @@ Options:
                                    the files.
 """
 
+import collections
+import concurrent.futures
+import hashlib
+import itertools
 import json
 import os
 import os.path as P
+import re
 import shutil
-import subprocess
 import sys
 import time
 
-import pymongo
 import schema
 import yaml
 
 from yahoo_groups_backup.logging import eprint
-from yahoo_groups_backup import YahooBackupDB, html_from_message, unescape_yahoo_html, redaction
+from yahoo_groups_backup import redaction
+from yahoo_groups_backup.dump_manifest import DumpManifest, input_hash
+from yahoo_groups_backup.elasticlunr import SearchIndexBuilder
+from yahoo_groups_backup.message import RENDERER_VERSION, unescape_yahoo_html
+from yahoo_groups_backup.render_cache import RenderCache
+from yahoo_groups_backup.storage import open_backup_db
 
 
+# buffer size for reading and writing the group files
+FILE_BUFFER_SIZE = 1024 * 1024
+
+# the message fields read for all the messages: the ones the index is made from, and the hash which
+# tells when a message was stored again with changes
+INDEX_FIELDS = ('subject', 'authorName', 'profile', 'from', 'postDate', 'contentHash')
+# the message fields the messageData pages are rendered from, only read for the pages rendered
+BODY_FIELDS = ('rawEmail', 'messageBody')
+
 args_schema = schema.Schema({
     '--msgdb-page-size': schema.Use(int),
+    '--render-workers': schema.And(schema.Use(int), lambda n: n >= 0,
+                                   error='Invalid render workers, must be integer >= 0'),
+    '--file-workers': schema.And(schema.Use(int), lambda n: n >= 1, error='Invalid file workers, must be integer >= 1'),
     '--redact-before': schema.Use(int),
     object: object,
 })
 
 
-def check_node():
-    try:
-        subprocess.Popen(["node", "--version"], stdout=subprocess.PIPE).communicate()
-    except Exception:
-        return False
-
-    return True
-
-
 def mask_email(email):
     if not email:
         return ''
@@ -74,6 +96,18 @@ def template_filename(path):
     return '/'.join(parts)
 
 
+def is_same_file(path, size, content_hash):
+    """Return whether the file at the path has the given size and sha256 hash."""
+    if not content_hash or not P.exists(path) or P.getsize(path) != size:
+        return False
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(FILE_BUFFER_SIZE), b''):
+            h.update(data)
+    return h.hexdigest() == content_hash
+
+
 def sanitize_filename(fn):
     return ''.join(c if (c.isalnum() or c in ' ._-') else '_' for c in fn)
 
@@ -95,6 +129,38 @@ def copytree(src, dst, symlinks=False, ignore=None):
                 shutil.copy2(s, d)
 
 
+# the `DumpSite` of a render worker process
+_worker_site = None
+
+
+def _init_render_worker(arguments):
+    global _worker_site
+    _worker_site = DumpSite(arguments)
+
+
+def _render_page_in_worker(start, end):
+    """Render a message page in a render worker process. Returns the records, along with the ids
+    of the messages which failed to render and the render cache hits and misses."""
+    site = _worker_site
+    site.failed_render_messages = set()
+    site.render_cache.num_hits = site.render_cache.num_misses = 0
+    records = site.render_message_page(start, end)
+    return records, site.failed_render_messages, site.render_cache.num_hits, site.render_cache.num_misses
+
+
+def search_index_doc(message_id, index_record, message_body):
+    """Return the search index document of a message, from its index record, if it has one (it's
+    not redacted), and its messageData body."""
+    index_record = index_record or {}
+    return {
+        'id': message_id,
+        'subject': index_record.get('subject', ''),
+        'shortDisplayAuthor': ' '.join(index_record.get(field, '') for field in ('profile', 'authorName', 'from')),
+        # remove HTML from message body to not confuse the search
+        'messageBody': re.sub(r'<[^>]+>', ' ', message_body),
+    }
+
+
 class DumpSite:
     """Class to dump a static site.
 
@@ -122,21 +188,32 @@ angular
         self.group_name = arguments['<group_name>']
         self.page_size = arguments['--msgdb-page-size']
         self.redact_before = arguments['--redact-before']
+        self.file_workers = arguments['--file-workers']
+        self.render_workers = arguments['--render-workers'] or os.cpu_count()
+        self.arguments = arguments
 
-        self.redactions = []
+        self.redactions = redaction.Redactions([])
+        redactions_spec = ''
         if P.exists(arguments['--redactions']):
+            with open(arguments['--redactions']) as f:
+                redactions_spec = f.read()
             self.redactions = redaction.load_redactions(open(arguments['--redactions']))
         elif arguments['--redactions'] != 'redactions.yaml':
             raise ValueError("Given non-existent redactions file")
 
-        self.cli = pymongo.MongoClient(arguments['--mongo-host'], arguments['--mongo-port'])
-        self.db = YahooBackupDB(self.cli, self.group_name)
+        self.db = open_backup_db(arguments, self.group_name)
+        self.render_cache = RenderCache(self.db, enabled=not arguments['--no-render-cache'])
 
         self.source_root_dir = P.join(P.dirname(__file__), '..', '..', 'static_site_template')
         self.dest_root_dir = arguments['<root_dir>']
         self.data_dir = P.join(self.dest_root_dir, 'data')
         self.files_dir = P.join(self.data_dir, 'files')
 
+        self.incremental = arguments['--incremental']
+        self.manifest = DumpManifest(P.join(self.dest_root_dir, 'dump-manifest.json'))
+        # inputs of all the data files, besides the messages they're made from
+        self.common_inputs = [RENDERER_VERSION, redactions_spec, self.redact_before, self.templates['redacted_message']]
+
         self.failed_render_messages = set()
 
     def copy_template_site(self):
@@ -208,22 +285,31 @@ angular
                            separators=',;'),
             ))
 
+    def load_jsonp_records(self, filename):
+        """Load the records of a data file written by `dump_jsonp_records`."""
+        with open(P.join(self.data_dir, filename)) as f:
+            data = f.read()
+        keys = json.loads(re.search(r'^    var keys = (.*);$', data, re.MULTILINE).group(1))
+        records = json.loads(re.search(r'^    var records = (.*);$', data, re.MULTILINE).group(1))
+        return [dict(zip(keys, values)) for values in records]
+
     def render_config(self):
         """Render the site configuration file."""
         eprint("Rendering config file...")
+        stats = self.db.message_stats()
         self.dump_jsonp('data.config.js', {
             'groupName': self.group_name,
-            'lastMessageTime': self.db.get_latest_message().get('postDate'),
-            'lastMessageNumber': self.db.get_latest_message()['_id'],
+            'lastMessageTime': stats.latest_post_date,
+            'lastMessageNumber': stats.latest_id,
             'messageDbPageSize': self.page_size,
             'cacheBuster': int(time.time()),
         })
 
-        missing_ids = self.db.missing_message_ids()
-        if missing_ids:
+        num_missing = sum(end - start + 1 for start, end in stats.missing_ranges_up_to(stats.latest_id))
+        if num_missing:
             eprint("")
             eprint("WARNING! Backup is not complete, missing %s messages! Site will be incomplete." % (
-                len(missing_ids),
+                num_missing,
             ))
             eprint("")
 
@@ -231,67 +317,260 @@ angular
         """Apply the redactions to a given piece of text."""
         return self.redactions.apply(text)
 
-    def render_index(self):
-        """Render the index file."""
+    def is_data_current(self, filename, *inputs):
+        """Return whether the data file, made from the given inputs along with the common ones, is
+        in the site already, from an earlier dump. Always False unless dumping incrementally."""
+        hash_ = input_hash(self.common_inputs, *inputs)
+        name = 'data/' + filename
+        if not self.incremental:
+            self.manifest.record(name, hash_)
+            return False
+        return self.manifest.is_current(name, P.join(self.data_dir, filename), hash_)
+
+    def index_record(self, message):
+        """Return the index data record of a message."""
+        return {
+            "id": message['_id'],
+            "subject": self.apply_redactions(unescape_yahoo_html(message.get('subject', '(unknown)'))),
+            "authorName": self.apply_redactions(message.get('authorName', '')),
+            "profile": self.apply_redactions(message.get('profile', '')),
+            "from": self.apply_redactions(mask_email(message.get('from', ''))),
+            "timestamp": message.get('postDate', 0),
+        }
+
+    def render_index(self, records, message_ids):
+        """Render the index file, given the index records of the messages which aren't redacted and
+        the ids of all the messages."""
+        if self.is_data_current('data.index.js', message_ids, records):
+            eprint("Index data is up to date")
+            return
+
         eprint("Rendering index data...")
-        self.dump_jsonp_records('data.index.js', [
+        self.dump_jsonp_records('data.index.js', records)
+
+    def get_message_bodies(self, messages):
+        """Get the message bodies for the given messages, without redactions."""
+        to_render = [message for message in messages if message['_id'] >= self.redact_before]
+        rendered = dict(zip((message['_id'] for message in to_render), self.render_cache.render_all(to_render)))
+
+        bodies = []
+        for message in messages:
+            if message['_id'] not in rendered:
+                bodies.append(self.templates['redacted_message'])
+                continue
+
+            html, failed = rendered[message['_id']]
+            if failed:
+                self.failed_render_messages.add(message['_id'])
+            bodies.append(html)
+        return bodies
+
+    def render_message_page(self, start, end):
+        """Return the records of the messageData file of the page of messages with ids in [`start`,
+        `end`). Only reads the fields the page is rendered from, for the messages of the page."""
+        messages = list(self.db.yield_all_messages(start, end, fields=BODY_FIELDS, batch_size=self.page_size))
+        return [
             {
                 "id": message['_id'],
-                "subject": self.apply_redactions(unescape_yahoo_html(message.get('subject', '(unknown)'))),
-                "authorName": self.apply_redactions(message.get('authorName', '')),
-                "profile": self.apply_redactions(message.get('profile', '')),
-                "from": self.apply_redactions(mask_email(message.get('from', ''))),
-                "timestamp": message.get('postDate', 0),
+                "messageBody": self.apply_redactions(body),
             }
-            for message in self.db.yield_all_messages(start=self.redact_before)
-        ])
-
-    def get_message_body(self, message):
-        """Get a message body for a given message, without redactions."""
-        if message['_id'] < self.redact_before:
-            return self.templates['redacted_message']
+            for message, body in zip(messages, self.get_message_bodies(messages))
+        ]
+
+    def yield_message_pages(self):
+        """Yield `(start, end, messages)` for each messageData page, from one pass over all the
+        messages, last page first. Pages without any messages are yielded too. The messages only
+        have the `INDEX_FIELDS`."""
+        messages = self.db.yield_all_messages(fields=INDEX_FIELDS, batch_size=self.page_size)
+        next_start = None
+        for start, page_messages in itertools.groupby(messages, lambda message: message['_id'] // self.page_size):
+            start *= self.page_size
+            if next_start is not None:
+                for empty_start in range(next_start, start, -self.page_size):
+                    yield empty_start, empty_start + self.page_size, []
+            yield start, start + self.page_size, list(page_messages)
+            next_start = start - self.page_size
+
+        if next_start is not None:
+            for empty_start in range(next_start, -1, -self.page_size):
+                yield empty_start, empty_start + self.page_size, []
+
+    def make_render_pool(self):
+        """Return a pool of `render_workers` processes, each with its own `DumpSite` and database
+        connection for the render cache."""
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.render_workers, initializer=_init_render_worker, initargs=(self.arguments,))
+
+    def render_pages_in_pool(self, executor, pages):
+        """Render the `(start, end)` message pages with the pool made by `make_render_pool`.
+        Yields `(start, end, records)` for each page, in order. Only a few pages per worker are
+        rendered ahead of the one being yielded, to bound memory use."""
+        pending = collections.deque()
+        pages = iter(pages)
+        while True:
+            while len(pending) < self.render_workers * 2:
+                page = next(pages, None)
+                if page is None:
+                    break
+                start, end = page
+                pending.append((start, end, executor.submit(_render_page_in_worker, start, end)))
+            if not pending:
+                return
+
+            start, end, future = pending.popleft()
+            records, failed_ids, num_hits, num_misses = future.result()
+            self.failed_render_messages.update(failed_ids)
+            self.render_cache.num_hits += num_hits
+            self.render_cache.num_misses += num_misses
+            yield start, end, records
+
+    def dump_messages(self):
+        """Dump all the data files made from the messages - the index, the messageData pages and
+        the search index - with a single pass over the index fields of the messages. As
+        each page of messages is read, its index records are kept, and unless its data file is up
+        to date, its messages are read again with their bodies, and it is rendered, written, and fed
+        to the search index, while the next pages are read."""
+        # the index records of the messages which aren't redacted, by id
+        index_records = {}
+        # the ids of all the messages
+        message_ids = []
+        # pages left as they were, which are only read back if the search index is made again
+        current_pages = []
+        # the render workers tokenize and compress the search index as well
+        executor = self.make_render_pool() if self.render_workers > 1 else None
+        search_index = SearchIndexBuilder(P.join(self.data_dir, 'data.searchIndex'), workers=self.render_workers,
+                                          executor=executor)
+
+        def yield_pages_to_render():
+            for start, end, messages in self.yield_message_pages():
+                page_versions = [(message['_id'], message.get('contentHash')) for message in messages]
+                message_ids.extend(message_id for message_id, _ in page_versions)
+                index_records.update((message['_id'], self.index_record(message)) for message in messages
+                                     if message['_id'] >= self.redact_before)
+                filename = 'data.messageData-%s-%s.js' % (start, end)
+                if self.is_data_current(filename, page_versions):
+                    current_pages.append(filename)
+                    continue
+                yield start, end
+
+        if executor:
+            rendered_pages = self.render_pages_in_pool(executor, yield_pages_to_render())
+        else:
+            rendered_pages = ((start, end, self.render_message_page(start, end))
+                              for start, end in yield_pages_to_render())
 
         try:
-            return html_from_message(message)
-        except Exception:
-            self.failed_render_messages.add(message['_id'])
-            return html_from_message(message, use_yahoo_on_fail=True)
-
-    def render_messages(self):
-        """Render all the message bodies into the messageData data files."""
-        latest_id = self.db.get_latest_message()['_id']
-        for start in range(0, latest_id+1, self.page_size):
-            end = start + self.page_size
-            eprint("Rendering messages %s to %s..." % (start, end))
-            self.dump_jsonp_records('data.messageData-%s-%s.js' % (start, end), [
-                {
-                    "id": message['_id'],
-                    "messageBody": self.apply_redactions(self.get_message_body(message)),
-                }
-                for message in self.db.yield_all_messages(start=start, end=end)
-            ])
-
-    def render_search_indices(self):
-        subprocess.Popen([
-            'node', P.join(P.dirname(P.realpath(__file__)), 'generate_search_index.js'),
-            P.join(self.data_dir)
-        ]).communicate()
+            for start, end, records in rendered_pages:
+                eprint("Rendered messages %s to %s..." % (start, end))
+                self.dump_jsonp_records('data.messageData-%s-%s.js' % (start, end), records)
+
+                for record in records:
+                    search_index.add(search_index_doc(record['id'], index_records.get(record['id']),
+                                                      record['messageBody']))
+            eprint("Rendered %s messages, %s taken from the render cache" % (
+                self.render_cache.num_hits + self.render_cache.num_misses, self.render_cache.num_hits))
+
+            message_ids.sort()
+            self.render_index(list(index_records.values()), message_ids)
+
+            # the search index is made from the index and the messageData files
+            inputs = sorted((name, hash_) for name, hash_ in self.manifest.artifacts.items()
+                            if name.startswith('data/data.'))
+            if self.is_data_current('data.searchIndex-shards.js', inputs):
+                # the shards are left as they were along with their directory
+                self.manifest.keep_artifacts('data/data.searchIndex-shard')
+                eprint("Search index is up to date")
+                return
+
+            eprint("Generating the search index...")
+            for filename in current_pages:
+                for record in self.load_jsonp_records(filename):
+                    search_index.add(search_index_doc(record['id'], index_records.get(record['id']),
+                                                      record['messageBody']))
+            paths = search_index.finish_sharded()
+            # the shards are made from the same inputs as their directory
+            hash_ = self.manifest.artifacts['data/data.searchIndex-shards.js']
+            for path in paths:
+                name = 'data/' + P.basename(path)
+                if name not in self.manifest.artifacts:
+                    self.manifest.record(name, hash_)
+            eprint("Wrote the search index in %s files" % (len(paths),))
+        finally:
+            search_index.close()
+            if executor:
+                executor.shutdown()
+
+    def file_dump_path(self, ent):
+        """Return the path in the files directory to dump the group file to."""
+        # split to pieces, ignore first empty piece, sanitize each piece, put back together
+        sanitized = '/'.join(map(sanitize_filename, ent['_id'].split('/')[1:]))
+        return P.join(self.files_dir, sanitized)
+
+    def dump_file(self, ent, file_f):
+        """Dump the data of a group file into the files directory, unless the same data is there
+        already. Returns whether the file was written."""
+        full_path = self.file_dump_path(ent)
+        if is_same_file(full_path, file_f.length, ent.get('contentHash')):
+            return False
+
+        os.makedirs(P.dirname(full_path), exist_ok=True)
+        with open(full_path, "wb", buffering=FILE_BUFFER_SIZE) as f:
+            for chunk in file_f:
+                f.write(chunk)
+        return True
 
     def dump_files(self):
-        """Dump all the group files into the files directory."""
+        """Dump all the group files into the files directory, `file_workers` files at a time. Each
+        file is recorded in the manifest once it's dumped."""
         eprint("Dumping group files...")
-        for ent, file_f in self.db.yield_all_files():
-            if file_f is None:
-                eprint("Skipping '%s', have no data for this file..." % (ent['_id'],))
-                continue
-
-            # split to pieces, ignore first empty piece, sanitize each piece, put back together
-            sanitized = '/'.join(map(sanitize_filename, ent['_id'].split('/')[1:]))
-            full_path = P.join(self.files_dir, sanitized)
-            os.makedirs(P.dirname(full_path), exist_ok=True)
-            with open(full_path, "wb") as f:
-                for chunk in file_f:
-                    f.write(chunk)
+        # whether each file was written, rather than already there
+        written = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.file_workers) as executor:
+            # the manifest name and content hash of the file each future dumps
+            futures = {}
+
+            def wait_for(return_when):
+                done, _ = concurrent.futures.wait(futures, return_when=return_when)
+                for future in done:
+                    name, content_hash = futures.pop(future)
+                    written.append(future.result())
+                    if content_hash:
+                        self.manifest.record(name, content_hash, changed=written[-1])
+
+            for ent, file_f in self.db.yield_all_files():
+                if file_f is None:
+                    eprint("Skipping '%s', have no data for this file..." % (ent['_id'],))
+                    continue
+
+                # if the manifest says the file was dumped with the same data, only check its size,
+                # rather than hashing it all again
+                full_path = self.file_dump_path(ent)
+                name = P.relpath(full_path, self.dest_root_dir)
+                if ent.get('contentHash') and \
+                        self.manifest.is_current(name, full_path, ent['contentHash'], record=False) and \
+                        P.getsize(full_path) == file_f.length:
+                    self.manifest.record(name, ent['contentHash'], changed=False)
+                    written.append(False)
+                    continue
+
+                futures[executor.submit(self.dump_file, ent, file_f)] = (name, ent.get('contentHash'))
+
+                # don't queue up more files than we need to keep the workers busy
+                if len(futures) >= self.file_workers * 4:
+                    wait_for(concurrent.futures.FIRST_COMPLETED)
+
+            wait_for(concurrent.futures.ALL_COMPLETED)
+
+        eprint("Wrote %s files, %s were already there" % (written.count(True), written.count(False)))
+
+    def remove_stale_artifacts(self):
+        """Remove the data files and group files of the previous dump which this one didn't make,
+        e.g. files which were deleted from the group."""
+        for name in self.manifest.stale_artifacts():
+            path = P.join(self.dest_root_dir, name)
+            if P.exists(path):
+                eprint("Removing stale '%s'..." % (name,))
+                os.remove(path)
 
     def run(self):
         """Run and dump the entire site."""
@@ -302,23 +581,21 @@ angular
             self.render_config()
             return
 
-        if not check_node():
-            sys.exit("node not found - node is required to generate the search indices")
-
-        if os.path.exists(self.dest_root_dir):
-            sys.exit("Root site directory already exists. Specify a new directory or delete the existing one.")
+        if os.path.exists(self.dest_root_dir) and not self.incremental:
+            sys.exit("Root site directory already exists. Specify a new directory or delete the existing one, "
+                     "or use --incremental to update it.")
 
         self.copy_template_site()
 
-        os.makedirs(self.data_dir)
-        os.makedirs(self.files_dir)
+        os.makedirs(self.data_dir, exist_ok=True)
+        os.makedirs(self.files_dir, exist_ok=True)
 
         self.render_templates()
         self.render_config()
-        self.render_index()
-        self.render_messages()
-        self.render_search_indices()
+        self.dump_messages()
         self.dump_files()
+        self.remove_stale_artifacts()
+        self.manifest.save()
 
         eprint("Site is ready in '%s'!" % self.dest_root_dir)
         if self.failed_render_messages:
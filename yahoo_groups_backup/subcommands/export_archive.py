@@ -0,0 +1,44 @@
+"""
+Usage:
+  yahoo-groups-backup.py export_archive [-h|--help] [options] <group_name> <archive_dir>
+
+Options:
+  --chunk-size=<n>         Number of messages or file entries per chunk file.
+                           [default: 5000]
+  --pack-size=<mb>         Size in megabytes of the file data per chunk file.
+                           [default: 256]
+
+Help:
+  This exports the messages, file entries and file data of a group backup
+  into a new directory of compressed, checksummed chunk files, which can be
+  loaded with import_archive, e.g. on another machine or into another
+  backend.
+"""
+import os.path as P
+import sys
+
+import schema
+
+from yahoo_groups_backup.archive import ArchiveWriter, export_backup
+from yahoo_groups_backup.logging import eprint
+from yahoo_groups_backup.storage import open_backup_db
+
+
+args_schema = schema.Schema({
+    '--chunk-size': schema.And(schema.Use(int), lambda n: n >= 1, error='Invalid chunk size, must be integer >= 1'),
+    '--pack-size': schema.And(schema.Use(int), lambda n: n >= 1, error='Invalid pack size, must be integer >= 1'),
+    object: object,
+})
+
+
+def command(arguments):
+    if P.exists(arguments['<archive_dir>']):
+        sys.exit("Archive directory already exists. Specify a new directory or delete the existing one.")
+
+    db = open_backup_db(arguments, arguments['<group_name>'])
+    writer = ArchiveWriter(arguments['<archive_dir>'], arguments['<group_name>'],
+                           chunk_size=arguments['--chunk-size'],
+                           pack_size=arguments['--pack-size'] * 1024 * 1024)
+    export_backup(db, writer)
+
+    eprint("Archive is ready in '%s'!" % (arguments['<archive_dir>'],))
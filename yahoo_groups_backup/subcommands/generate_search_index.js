@@ -1,11 +1,14 @@
 /**
  * A node script to generate an elasticlunr index and zip it, in pieces, for
- * a Yahoo! groups static site backup.
+ * a Yahoo! groups static site backup, from the documents given on stdin.
+ *
+ * The site's search index is now built by yahoo_groups_backup/elasticlunr.py,
+ * which must make the same index. This script is kept as the reference to
+ * check it against, see benchmarks/search_index.py.
  */
 
 var path = require('path');
-var fs = require('fs');
-var extend = require('util')._extend;
+var readline = require('readline');
 
 var elasticlunr = require('../../static_site_template/js/elasticlunr.min.js');
 
@@ -25,10 +28,6 @@ main();
 // ---------------------------
 
 function main() {
-  var searchIndex = null;
-  var messageIndex = null;
-  var config = null;
-
   var args = process.argv.slice(2);
 
   var pathToData = args[0];
@@ -38,29 +37,27 @@ function main() {
     process.exit(1);
   }
 
-  searchIndex = createIndex();
-
-  loadMessageIndex(pathToData).then(function (data) {
-    messageIndex = data;
+  var searchIndex = createIndex();
 
-    messageIndex.idToRow = {};
-    for (var i=0; i < messageIndex.length; i++) {
-      messageIndex.idToRow[messageIndex[i].id] = messageIndex[i];
-    }
-  }).then(function () {
-    return loadConfig(pathToData);
-  }).then(function (config_) {
-    config = config_;
-  }).then(function () {
-    return processBatches(config, pathToData, messageIndex, searchIndex, 0);
-  }).then(function () {
-    return LocalJSONP.storeCompressed(
+  // the documents to index come on stdin, one JSON object per line, as the
+  // messages are dumped
+  var numDocs = 0;
+  var lines = readline.createInterface({input: process.stdin});
+  lines.on('line', function (line) {
+    searchIndex.addDoc(JSON.parse(line));
+    numDocs++;
+  });
+  lines.on('close', function () {
+    console.log("Indexed", numDocs, "messages");
+    LocalJSONP.storeCompressed(
       searchIndex.toJSON(), CHUNK_SIZE,
-      path.join(pathToData, 'data.searchIndex'));
-  }).then(function () {
-    console.log("Done!");
-  }).catch(function (err) {
-    console.error("There was an error:", err);
+      path.join(pathToData, 'data.searchIndex')
+    ).then(function () {
+      console.log("Done!");
+    }).catch(function (err) {
+      console.error("There was an error:", err);
+      process.exit(1);
+    });
   });
 }
 
@@ -73,41 +70,3 @@ function createIndex() {
     this.saveDocument(false);
   });
 }
-
-function loadConfig(pathToData) {
-  return LocalJSONP.LocalJSONP(path.join(pathToData, 'data.config.js'));
-}
-
-function loadMessageIndex(pathToData) {
-  return LocalJSONP.LocalJSONP(path.join(pathToData, 'data.index.js'));
-}
-
-function processBatches(config, pathToData, messageIndex, searchIndex, startI) {
-  if (startI > config.lastMessageNumber) {
-    console.log("Done!");
-    return;
-  }
-
-  var endI = startI + config.messageDbPageSize;
-
-  var messageDataFn = path.join(pathToData, 'data.messageData-' + startI + '-' + endI + '.js');
-
-  return LocalJSONP.LocalJSONP(messageDataFn).then(function (data) {
-    console.log("Processing", data.length, "messages...");
-    for (var i=0; i < data.length; i++) {
-      var toAdd = {};
-      extend(toAdd, data[i]);
-      extend(toAdd, messageIndex.idToRow[data[i].id]);
-
-      // augment with shortDisplayAuthor, which is dynamically added to the messages
-      toAdd.shortDisplayAuthor = [toAdd.profile, toAdd.authorName, toAdd.from].join(" ");
-
-      // remove HTML from message body to not confuse the search
-      toAdd.messageBody = toAdd.messageBody.replace(/<[^>]+>/g, " ");
-      searchIndex.addDoc(toAdd);
-    }
-  }).then(function () {
-    // process next batch
-    return processBatches(config, pathToData, messageIndex, searchIndex, endI);
-  });
-}
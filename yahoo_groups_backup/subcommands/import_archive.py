@@ -0,0 +1,40 @@
+"""
+Usage:
+  yahoo-groups-backup.py import_archive [-h|--help] [options] <archive_dir> [<group_name>]
+
+Options:
+  --workers=<n>            Number of chunk files to load at the same time.
+                           [default: 4]
+
+Help:
+  This loads an archive made by export_archive into the backup of the
+  group, after checking that none of its chunk files are corrupt. The
+  group is the one the archive was exported from, unless <group_name> is
+  given. Messages and files already in the backup are replaced by the ones
+  in the archive.
+"""
+import sys
+
+import schema
+
+from yahoo_groups_backup.archive import ArchiveError, ArchiveReader, import_backup
+from yahoo_groups_backup.logging import eprint
+from yahoo_groups_backup.storage import open_backup_db
+
+
+args_schema = schema.Schema({
+    '--workers': schema.And(schema.Use(int), lambda n: n >= 1, error='Invalid workers, must be integer >= 1'),
+    object: object,
+})
+
+
+def command(arguments):
+    try:
+        reader = ArchiveReader(arguments['<archive_dir>'])
+        group_name = arguments['<group_name>'] or reader.group_name
+        db = open_backup_db(arguments, group_name)
+        import_backup(db, reader, workers=arguments['--workers'])
+    except ArchiveError as e:
+        sys.exit(str(e))
+
+    eprint("Imported the archive into '%s'!" % (group_name,))
@@ -10,28 +10,71 @@ Options:
   --login=<login>          Yahoo! login, required for private groups.
   --password=<password>    Yahoo! password, required for private groups.
   --driver=<driver>        Specify a webdriver for Selenium [default: firefox]
+  -w --workers=<workers>   Number of files to download at the same time.
+                           [default: 4]
+  --max-retries=<n>        Number of times to resume a download which broke
+                           off. [default: 5]
+  --walk-workers=<n>       Number of browsers listing directories at the same
+                           time. [default: 1]
+  --no-listing-cache       Visit every directory, even those whose date and
+                           size didn't change since the last run.
 """
-import pymongo
-import requests
+import schema
 
-from yahoo_groups_backup import YahooBackupDB, YahooBackupScraper
+from yahoo_groups_backup.scraper import YahooBackupScraper
+from yahoo_groups_backup.file_downloader import FileDownloader
+from yahoo_groups_backup.file_walker import FileTreeWalker
 from yahoo_groups_backup.logging import eprint
+from yahoo_groups_backup.storage import open_backup_db
+
+
+args_schema = schema.Schema({
+    '--workers': schema.And(schema.Use(int), lambda n: n >= 1, error='Invalid workers, must be integer >= 1'),
+    '--walk-workers': schema.And(schema.Use(int), lambda n: n >= 1,
+                                 error='Invalid walk workers, must be integer >= 1'),
+    '--max-retries': schema.And(schema.Use(int), lambda n: n >= 0,
+                                error='Invalid max retries, must be integer >= 0'),
+    object: object,
+})
 
 
 def command(arguments):
-    cli = pymongo.MongoClient(arguments['--mongo-host'], arguments['--mongo-port'])
-    db = YahooBackupDB(cli, arguments['<group_name>'])
+    db = open_backup_db(arguments, arguments['<group_name>'])
     scraper = YahooBackupScraper(
         arguments['<group_name>'], arguments['--driver'], login_email=arguments['--login'],
         password=arguments['--password'])
 
-    for file_info in scraper.yield_walk_files():
-        if not db.has_file_entry(file_info['filePath']) or not db.has_file_data(file_info['filePath']):
-            eprint("Inserting file '%s'..." % file_info['filePath'])
-            file_data = requests.get(file_info['url']).content
-            db.upsert_file_entry(file_info)
-            db.update_file_data(file_info['filePath'], file_data)
-        else:
-            eprint("Already had file '%s'" % file_info['filePath'])
+    # the first walking browser is the scraper's own, the others are new ones
+    spare_scrapers = [scraper]
+
+    def make_scraper():
+        if spare_scrapers:
+            return spare_scrapers.pop()
+        return YahooBackupScraper(
+            arguments['<group_name>'], arguments['--driver'], login_email=arguments['--login'],
+            password=arguments['--password'])
+
+    walker = FileTreeWalker(db, make_scraper, workers=arguments['--walk-workers'],
+                            use_cache=not arguments['--no-listing-cache'])
+
+    def yield_files_to_download():
+        for file_info in walker.walk():
+            if db.has_file_entry(file_info['filePath']) and db.has_file_data(file_info['filePath']):
+                eprint("Already had file '%s'" % file_info['filePath'])
+                continue
+
+            content_hash = db.find_blob_for_listing(file_info)
+            if content_hash:
+                eprint("Already had the data of file '%s' from another file" % file_info['filePath'])
+                db.upsert_file_entry(file_info)
+                db.set_file_content_hash(file_info['filePath'], content_hash)
+                continue
+
+            yield file_info
+
+    downloader = FileDownloader(
+        db, scraper.make_download_session(pool_size=arguments['--workers']),
+        workers=arguments['--workers'], max_retries=arguments['--max-retries'])
+    downloader.run(yield_files_to_download())
 
     eprint("Done processing all files!")
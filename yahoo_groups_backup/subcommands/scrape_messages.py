@@ -10,53 +10,163 @@ Options:
   --login=<login>          Yahoo! login, required for private groups.
   --password=<password>    Yahoo! password, required for private groups.
   --driver=<driver>        Specify a webdriver for Selenium [default: firefox]
+  --browserless            Fetch the JSON API over a plain HTTP session, only
+                           using the browser to log in.
+  -w --workers=<workers>   Number of messages to scrape at the same time.
+                           More than one requires --browserless. [default: 1]
+  --rate=<rate>            Maximum number of API requests per second, shared
+                           by all workers. Replaces the per-message --delay.
+  --adaptive               Adapt the request rate and the number of workers
+                           (up to --workers) to the server's latency and
+                           errors. Starts from --rate, or one request per
+                           --delay.
+  --max-retries=<n>        Number of times to retry a request on a server
+                           error or throttling, backing off exponentially.
+                           [default: 5]
+  --harvest                Get the message metadata from the paged message
+                           listing, and only fetch the raw email of each
+                           message. Deleted messages are detected from the
+                           gaps in the listing.
+  --listing-page-size=<n>  Number of messages to get per listing request
+                           when harvesting. [default: 100]
+  --write-batch-size=<n>   Number of messages to store per database write.
+                           Buffered messages are written at least every 5
+                           seconds, and on exit. [default: 100]
+  --lease                  Share the work with other scraper processes, on
+                           any host, by claiming ranges of messages from a
+                           work queue stored in the database.
+  --lease-range-size=<n>   Number of messages in each range of the work
+                           queue. Must be the same for all the processes.
+                           [default: 1000]
+  --lease-duration=<secs>  Seconds after which a range whose scraper stopped
+                           renewing its lease is reclaimed. [default: 300]
 """
-import pymongo
+import itertools
+import os
+import signal
+import socket
+import sys
+
 import schema
 
-from yahoo_groups_backup import YahooBackupDB, YahooBackupScraper
+from yahoo_groups_backup.scraper import YahooBackupScraper
+from yahoo_groups_backup.leases import WorkLeases
 from yahoo_groups_backup.logging import eprint
+from yahoo_groups_backup.scrape_engine import MessageScrapeEngine, ResumePlan
+from yahoo_groups_backup.storage import open_backup_db
+from yahoo_groups_backup.throttle import AdaptiveController, TokenBucket
 
 
 args_schema = schema.Schema({
     '--delay': schema.And(schema.Use(float), lambda n: n > 0, error='Invalid delay, must be number > 0'),
+    '--workers': schema.And(schema.Use(int), lambda n: n >= 1, error='Invalid workers, must be integer >= 1'),
+    '--listing-page-size': schema.And(schema.Use(int), lambda n: n >= 1,
+                                      error='Invalid listing page size, must be integer >= 1'),
+    '--write-batch-size': schema.And(schema.Use(int), lambda n: n >= 1,
+                                     error='Invalid write batch size, must be integer >= 1'),
+    '--lease-range-size': schema.And(schema.Use(int), lambda n: n >= 1,
+                                     error='Invalid lease range size, must be integer >= 1'),
+    '--lease-duration': schema.And(schema.Use(float), lambda n: n > 0,
+                                   error='Invalid lease duration, must be number > 0'),
+    '--max-retries': schema.And(schema.Use(int), lambda n: n >= 0,
+                                error='Invalid max retries, must be integer >= 0'),
+    '--rate': schema.Or(None, schema.And(schema.Use(float), lambda n: n > 0,
+                                         error='Invalid rate, must be number > 0')),
     object: object,
 })
 
 
 def command(arguments):
-    cli = pymongo.MongoClient(arguments['--mongo-host'], arguments['--mongo-port'])
-    db = YahooBackupDB(cli, arguments['<group_name>'])
+    if arguments['--workers'] > 1 and not arguments['--browserless']:
+        sys.exit("Scraping with more than one worker requires --browserless")
+    if arguments['--lease'] and arguments['--backend'] != 'mongo':
+        sys.exit("Sharing the work with --lease requires the mongo backend")
+
+    rate_limiter = None
+    if arguments['--rate']:
+        rate_limiter = TokenBucket(arguments['--rate'])
+
+    controller = None
+    if arguments['--adaptive']:
+        rate_limiter = rate_limiter or TokenBucket(1 / arguments['--delay'])
+        controller = AdaptiveController(rate_limiter, arguments['--workers'])
+
+    db = open_backup_db(arguments, arguments['<group_name>'])
+    if arguments['--write-batch-size'] > 1:
+        db.buffer_writes(max_ops=arguments['--write-batch-size'])
+    # turn termination into a regular exit, so the buffered writes are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit("Terminated"))
+
     scraper = YahooBackupScraper(
         arguments['<group_name>'], arguments['--driver'], arguments['--login'],
-        arguments['--password'])
+        arguments['--password'], delay=arguments['--delay'],
+        browserless=arguments['--browserless'], pool_size=max(10, arguments['--workers']),
+        rate_limiter=rate_limiter, controller=controller, max_retries=arguments['--max-retries'])
+
+    listing_entries = {}
+
+    def yield_harvested_message_numbers(plan):
+        listing = scraper.yield_message_listing(
+            plan.last_message, page_size=arguments['--listing-page-size'], first_message=plan.first_message)
+        for cur_message, entry in listing:
+            if plan.is_done(cur_message):
+                continue
+
+            listing_entries[cur_message] = entry
+            yield cur_message
 
-    skipped = [0]
+    def fetch_harvested_message(message_number):
+        entry = listing_entries.pop(message_number)
+        if entry is None:
+            # a gap in the listing, the message was deleted
+            return None
+        return scraper.get_message_from_listing(entry)
 
-    def print_skipped(min):
-        if skipped[0] >= min:
-            eprint("Skipped %s messages we already processed" % skipped[0])
-            skipped[0] = 0
+    engine = MessageScrapeEngine(scraper, db, workers=arguments['--workers'], controller=controller)
+
+    def scrape(plan, lost_lease=None):
+        message_numbers = plan
+        if arguments['--harvest']:
+            message_numbers = yield_harvested_message_numbers(plan)
+        if lost_lease:
+            # stop handing out work once another process took over the range
+            message_numbers = itertools.takewhile(lambda _: not lost_lease.is_set(), message_numbers)
+
+        engine.run(message_numbers, fetch=fetch_harvested_message if arguments['--harvest'] else None)
+
+    def scrape_leased_ranges(last_message):
+        leases = WorkLeases(db, "%s:%s" % (socket.gethostname(), os.getpid()),
+                            duration=arguments['--lease-duration'])
+        leases.ensure_ranges(last_message, arguments['--lease-range-size'])
+
+        while True:
+            lease = leases.claim()
+            if not lease:
+                break
+
+            plan = ResumePlan(db, min(lease['end'] - 1, last_message), first_message=lease['start'])
+            eprint("Claimed messages %s to %s, %s left to scrape" % (
+                plan.first_message, plan.last_message, len(plan)))
+            with leases.keep_renewed(lease) as lost_lease:
+                scrape(plan, lost_lease)
+                db.flush()
+            if not lost_lease.is_set():
+                leases.release(lease, scraped_up_to=plan.last_message)
 
     last_message = scraper.get_last_message_number()
-    cur_message = last_message
-    while cur_message >= 1:
-        if db.has_updated_message(cur_message):
-            skipped[0] += 1
-            print_skipped(1000)
-            cur_message -= 1
-            continue
-
-        msg = scraper.get_message(cur_message)
-        db.upsert_message(cur_message, msg)
-        if not msg:
-            eprint("Message #%s is missing" % (cur_message,))
-        else:
-            eprint("Inserted message #%s by %s/%s/%s" % (
-                cur_message,
-                msg['authorName'], msg['profile'], msg['from']))
 
-        cur_message -= 1
+    try:
+        if arguments['--lease']:
+            scrape_leased_ranges(last_message)
+        else:
+            plan = ResumePlan(db, last_message)
+            eprint("%s of %s messages left to scrape (%s already scraped)" % (
+                len(plan), last_message, last_message - len(plan)))
+            scrape(plan)
+    finally:
+        db.flush()
+        if db.num_coalesced_writes():
+            eprint("Saved %s database round trips by batching writes" % (db.num_coalesced_writes(),))
+        db.close()
 
-    print_skipped(0)
     eprint("All messages from the beginning up to #%s have been scraped!" % (last_message,))
@@ -0,0 +1,55 @@
+"""
+Usage:
+  yahoo-groups-backup.py search [-h|--help] [options] <group_name> <query>...
+
+Options:
+  --page=<n>               Page of the results to show. [default: 1]
+  --page-size=<n>          Number of results per page. [default: 20]
+  --rebuild-index          Rebuild the search index from all the messages
+                           before searching, e.g. for a backup made before
+                           messages were indexed.
+
+Help:
+  This searches the subjects, authors and bodies of the messages for the
+  words of the query, best matches first. Put a phrase in double quotes to
+  search for it as a whole.
+"""
+import datetime
+
+import schema
+
+from yahoo_groups_backup.logging import eprint
+from yahoo_groups_backup.storage import open_backup_db
+
+
+args_schema = schema.Schema({
+    '--page': schema.And(schema.Use(int), lambda n: n >= 1, error='Invalid page, must be integer >= 1'),
+    '--page-size': schema.And(schema.Use(int), lambda n: n >= 1, error='Invalid page size, must be integer >= 1'),
+    object: object,
+})
+
+
+def format_date(timestamp):
+    if not timestamp:
+        return '(unknown)'
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d')
+
+
+def command(arguments):
+    db = open_backup_db(arguments, arguments['<group_name>'])
+
+    if arguments['--rebuild-index'] or (not db.search_index_size() and db.num_messages()):
+        eprint("Building the search index...")
+        eprint("Indexed %s messages" % (db.rebuild_search_index(),))
+
+    query = ' '.join(arguments['<query>'])
+    page, page_size = arguments['--page'], arguments['--page-size']
+    num_results, results = db.search_messages(query, page=page, page_size=page_size)
+
+    first = (page - 1) * page_size
+    eprint("%s results, showing %s to %s:" % (num_results, min(first + 1, num_results), first + len(results)))
+    for result in results:
+        print("")
+        print("#%s  %s  %s" % (result['_id'], format_date(result['postDate']), result['author']))
+        print("    %s" % (result['subject'],))
+        print("    %s" % (result['snippet'],))
@@ -13,15 +13,14 @@ Help:
 Options:
     -i --case-insensitive    Case-insensitive redactions
 """
-import pymongo
 import re
 
-from yahoo_groups_backup import YahooBackupDB, html_from_message
+from yahoo_groups_backup.render_cache import RenderCache
+from yahoo_groups_backup.storage import open_backup_db
 
 
 def command(arguments):
-    cli = pymongo.MongoClient(arguments['--mongo-host'], arguments['--mongo-port'])
-    ydb = YahooBackupDB(cli, arguments['<group_name>'])
+    ydb = open_backup_db(arguments, arguments['<group_name>'])
 
     src = arguments['<source>']
     repl = arguments['<redaction>']
@@ -54,11 +53,13 @@ def command(arguments):
             print("Before: %s" % text[orig_start:orig_end])
             print("After:  %s" % redacted[show_start:show_end])
 
-    for i, msg in enumerate(ydb.yield_all_messages()):
+    fields = ('rawEmail', 'messageBody', 'subject', 'authorName', 'from', 'profile')
+    rendered = RenderCache(ydb).yield_rendered(ydb.yield_all_messages(fields=fields))
+    for i, (msg, body, _) in enumerate(rendered):
         if i % 1000 == 0:
             print("Up to #%d..." % msg['_id'])
 
-        process_redaction(msg['_id'], html_from_message(msg, True))
+        process_redaction(msg['_id'], body)
         process_redaction(msg['_id'], msg.get('subject', ''))
         process_redaction(msg['_id'], msg.get('authorName', ''))
         process_redaction(msg['_id'], msg.get('from', ''))
@@ -0,0 +1,127 @@
+def thread_doc(members, linked_ids, last_post_date):
+    """Return the document of the thread with the given member message ids. `linked_ids` are the
+    members and all the ids they link to, including messages we don't have (yet)."""
+    members = sorted(members)
+    return {
+        '_id': members[0],
+        'members': members,
+        'linkedIds': sorted(linked_ids),
+        'numReplies': len(members) - 1,
+        'lastPostDate': last_post_date,
+    }
+
+
+def topic_links(message_id, prev_in_topic, next_in_topic):
+    """Return the ids of the messages which the message is linked to by its 'prevInTopic' and
+    'nextInTopic' fields, along with its own id."""
+    return [message_id] + [link for link in (prev_in_topic, next_in_topic) if link]
+
+
+def _max_date(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+
+def build_threads(rows):
+    """Given `(message_id, prev_in_topic, next_in_topic, post_date)` for all the messages, return
+    the documents of all the threads. Messages linked by their topic links, directly or not (e.g.
+    through a message we don't have), end up in the same thread. A thread's `_id` is its first
+    message id."""
+    parent = {}
+    post_dates = {}
+
+    def find(message_id):
+        parent.setdefault(message_id, message_id)
+        root = message_id
+        while parent[root] != root:
+            root = parent[root]
+        while parent[message_id] != root:
+            parent[message_id], message_id = root, parent[message_id]
+        return root
+
+    for message_id, prev_in_topic, next_in_topic, post_date in rows:
+        post_dates[message_id] = post_date
+        for link in topic_links(message_id, prev_in_topic, next_in_topic)[1:]:
+            a, b = find(message_id), find(link)
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+        find(message_id)
+
+    linked_ids = {}
+    for message_id in list(parent):
+        linked_ids.setdefault(find(message_id), []).append(message_id)
+
+    for thread_linked_ids in linked_ids.values():
+        # only the messages we have are thread members, not the ones they link to
+        members = [message_id for message_id in thread_linked_ids if message_id in post_dates]
+        last_post_date = None
+        for message_id in members:
+            last_post_date = _max_date(last_post_date, post_dates[message_id])
+        yield thread_doc(members, thread_linked_ids, last_post_date)
+
+
+def merge_threads(threads, links, post_date):
+    """Return the document of the thread made by adding the message with the given `topic_links` to
+    the given threads, i.e. the threads whose `linkedIds` contain any of the links."""
+    members = {links[0]}
+    linked_ids = set(links)
+    last_post_date = post_date
+    for thread in threads:
+        members.update(thread['members'])
+        linked_ids.update(thread['linkedIds'])
+        last_post_date = _max_date(last_post_date, thread['lastPostDate'])
+    return thread_doc(members, linked_ids, last_post_date)
+
+
+def merge_thread_updates(threads, updates):
+    """Like `merge_threads`, for several messages at once, given `(topic_links, post_date)` for
+    each one and the threads whose `linkedIds` contain any of their links. The messages and threads
+    they link together end up in the same thread. Returns `(thread, merged_threads)` for each
+    resulting thread, with the given threads it replaces."""
+    parent = {}
+
+    def find(message_id):
+        parent.setdefault(message_id, message_id)
+        root = message_id
+        while parent[root] != root:
+            root = parent[root]
+        while parent[message_id] != root:
+            parent[message_id], message_id = root, parent[message_id]
+        return root
+
+    def union(ids):
+        root = find(ids[0])
+        for message_id in ids[1:]:
+            other = find(message_id)
+            if other != root:
+                parent[other] = root
+
+    for thread in threads:
+        union(thread['linkedIds'])
+    for links, post_date in updates:
+        union(links)
+
+    groups = {}
+    for thread in threads:
+        groups.setdefault(find(thread['linkedIds'][0]), ([], []))[0].append(thread)
+    for links, post_date in updates:
+        groups.setdefault(find(links[0]), ([], []))[1].append((links, post_date))
+
+    results = []
+    for group_threads, group_updates in groups.values():
+        members = set()
+        linked_ids = set()
+        last_post_date = None
+        for thread in group_threads:
+            members.update(thread['members'])
+            linked_ids.update(thread['linkedIds'])
+            last_post_date = _max_date(last_post_date, thread['lastPostDate'])
+        for links, post_date in group_updates:
+            members.add(links[0])
+            linked_ids.update(links)
+            last_post_date = _max_date(last_post_date, post_date)
+        results.append((thread_doc(members, linked_ids, last_post_date), group_threads))
+    return results
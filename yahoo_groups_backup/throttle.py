@@ -0,0 +1,120 @@
+import random
+import threading
+import time
+
+from .logging import eprint
+
+
+class TokenBucket:
+    """A thread-safe token bucket, used to share a requests-per-second budget between
+    all the scraping workers.
+
+    Tokens are refilled continuously at `rate` per second, up to `burst` tokens. Each request
+    takes one token, blocking until one is available."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+
+        self._tokens = self.burst
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def set_rate(self, rate):
+        """Change the refill rate, keeping the tokens accumulated so far."""
+        with self._lock:
+            self._refill()
+            self.rate = rate
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` tokens are available, then take them."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+
+def backoff_delay(attempt, base=1, cap=60):
+    """Return how long to wait before retry number `attempt` (starting at 0), with exponential
+    backoff and full jitter, so that retrying workers don't all come back at the same time."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class AdaptiveController:
+    """Adapts the request rate of a `TokenBucket`, and the number of requests to keep in flight,
+    to how the server copes, using additive-increase/multiplicative-decrease.
+
+    Every `increase_every` successful requests in a row, the concurrency goes up by one (up to
+    `max_concurrency`) and the rate by `rate_step`. An error (a server error, a throttling page,
+    being bounced to the login page), or a request taking `latency_factor` times longer than the
+    usual latency (a moving average of all the latencies), halves both. Decreases are at most once
+    per `cooldown` seconds, so a burst of errors from the requests in flight only counts once."""
+
+    def __init__(self, rate_limiter, max_concurrency, min_rate=0.1, max_rate=None, rate_step=None,
+                 increase_every=20, latency_factor=3, cooldown=5):
+        self.rate_limiter = rate_limiter
+        self.max_concurrency = max_concurrency
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate_limiter.rate * 10
+        self.rate_step = rate_step or max(0.1, rate_limiter.rate / 10)
+        self.increase_every = increase_every
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+
+        self.concurrency = 1
+        self.num_errors = 0
+
+        self._successes = 0
+        self._usual_latency = None
+        self._last_decrease = 0
+        self._lock = threading.Lock()
+
+    def record_success(self, latency):
+        """Record a request which succeeded after `latency` seconds."""
+        with self._lock:
+            usual_latency = self._usual_latency
+            # slow responses count towards the usual latency too, so if the server just gets
+            # slower, the usual latency catches up rather than every response counting as slow
+            if usual_latency is None:
+                self._usual_latency = latency
+            else:
+                self._usual_latency = 0.9 * usual_latency + 0.1 * latency
+
+            if usual_latency and latency > self.latency_factor * usual_latency:
+                self._decrease("slow response, %.1fs" % latency)
+                return
+
+            self._successes += 1
+            if self._successes >= self.increase_every:
+                self._successes = 0
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                self.rate_limiter.set_rate(min(self.max_rate, self.rate_limiter.rate + self.rate_step))
+
+    def record_error(self, reason):
+        """Record a request which failed in a way that suggests we should slow down."""
+        with self._lock:
+            self.num_errors += 1
+            self._decrease(reason)
+
+    def _decrease(self, reason):
+        self._successes = 0
+
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+
+        self.concurrency = max(1, self.concurrency // 2)
+        self.rate_limiter.set_rate(max(self.min_rate, self.rate_limiter.rate / 2))
+        eprint("Backing off (%s): now %s in flight, at most %.2f requests per second" % (
+            reason, self.concurrency, self.rate_limiter.rate))
@@ -0,0 +1,114 @@
+import atexit
+import threading
+import time
+
+import bson
+import pymongo.errors
+
+from .logging import eprint
+
+
+class WriteBuffer:
+    """Write-behind buffer for a collection. Write operations (`pymongo.UpdateOne`, `InsertOne`, ...)
+    are queued and sent in `bulk_write` batches once `max_ops` are queued, they take up
+    `max_bytes`, or `max_delay` seconds have passed since the oldest one was queued.
+
+    Anything still queued is flushed by `close`, or else at interpreter exit. `num_coalesced` counts
+    how many writes were saved a round trip by being sent along with others.
+
+    `before_flush`, if given, is called with the documents of each batch before it is sent, and
+    returns a list with an item for each of them. `on_flush`, if given, is called after the batch
+    is sent, even if some of its writes failed, with the items (or documents, if there is no
+    `before_flush`) of the writes which succeeded.
+
+    Writes flushed because of `max_delay` are flushed by a background thread, which logs any
+    failure and keeps going until the buffer is closed."""
+
+    def __init__(self, collection, max_ops=100, max_bytes=4 * 1024 * 1024, max_delay=5, before_flush=None,
+                 on_flush=None):
+        self.collection = collection
+        self.before_flush = before_flush
+        self.on_flush = on_flush
+        self.max_ops = max_ops
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+
+        self.num_ops = 0
+        self.num_batches = 0
+
+        self._ops = []
+        self._docs = []
+        self._bytes = 0
+        self._oldest = None
+        self._lock = threading.RLock()
+        self._closed = threading.Event()
+
+        atexit.register(self.flush)
+
+        self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+
+    @property
+    def num_coalesced(self):
+        return self.num_ops - self.num_batches
+
+    def add(self, op, doc):
+        """Queue the write operation `op`, whose document is `doc` (used to estimate its size)."""
+        with self._lock:
+            if not self._ops:
+                self._oldest = time.monotonic()
+            self._ops.append(op)
+            self._docs.append(doc)
+            self._bytes += len(bson.BSON.encode(doc))
+
+            if len(self._ops) >= self.max_ops or self._bytes >= self.max_bytes:
+                self.flush()
+
+    def flush(self):
+        """Send all the queued writes."""
+        with self._lock:
+            if not self._ops:
+                return
+            items = self.before_flush(self._docs) if self.before_flush else self._docs
+
+            ops, self._ops, self._docs = self._ops, [], []
+            self._bytes = 0
+            self._oldest = None
+
+            error = None
+            failed = set()
+            try:
+                self.collection.bulk_write(ops, ordered=False)
+            except pymongo.errors.BulkWriteError as e:
+                # the unordered batch still applies all the non-failing writes, so only complain
+                # about the ones which did fail, once the applied ones are accounted for
+                failed = {write_error['index'] for write_error in e.details['writeErrors']}
+                error = RuntimeError("Failed %s of %s buffered writes: %s" % (
+                    len(e.details['writeErrors']), len(ops), e.details['writeErrors'][:5]))
+            finally:
+                self.num_ops += len(ops)
+                self.num_batches += 1
+
+            if self.on_flush:
+                self.on_flush([item for i, item in enumerate(items) if i not in failed])
+            if error:
+                raise error
+
+    def close(self):
+        """Send all the queued writes, and stop the background flushing. Nothing may be added
+        afterwards."""
+        self._closed.set()
+        self._flusher.join()
+        atexit.unregister(self.flush)
+        self.flush()
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.max_delay / 2):
+            with self._lock:
+                if self._oldest is None or time.monotonic() - self._oldest < self.max_delay:
+                    continue
+                try:
+                    self.flush()
+                except Exception as e:
+                    # nobody is there to handle it, and the thread has to keep flushing
+                    eprint("Failed to flush buffered writes to %s: %s" % (self.collection.name, e))